@@ -0,0 +1,337 @@
+# bench.py
+# reproducible benchmarks of the v1 routes at realistic data sizes.
+#
+#   python -m benchmarks.bench --size 100k --seed-data
+#   python -m benchmarks.bench --size 100k --save-baseline
+#   python -m benchmarks.bench --size 100k --compare --max-regression 0.2
+#   python -m benchmarks.bench --size 100k --http http://localhost:5000 --concurrency 16
+#
+# run from the backend folder against a dedicated database: seeding
+# replaces every question and category of --database-url.
+import argparse
+import csv
+import io
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from settings import DB_USER, DB_PASSWORD
+
+DEFAULT_DATABASE_URL = "postgresql://{}:{}@{}/{}".format(DB_USER, DB_PASSWORD, 'localhost:5433', 'trivia_bench')
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+SCENARIOS = ('list', 'category', 'search', 'quiz', 'create', 'delete')
+
+# words of the synthetic questions, the search scenario looks them up
+WORDS = ('river', 'mountain', 'painter', 'novel', 'planet', 'football', 'empire', 'opera',
+         'volcano', 'ocean', 'desert', 'composer', 'galaxy', 'island', 'battle', 'temple',
+         'poet', 'glacier', 'dynasty', 'element', 'marathon', 'sculptor', 'canyon', 'festival')
+
+
+def parse_size(text):
+    '''10k -> 10000, 1M -> 1000000'''
+    multipliers = {'k': 1000, 'm': 1000000}
+    suffix = text[-1].lower()
+    if suffix in multipliers:
+        return int(float(text[:-1]) * multipliers[suffix])
+    return int(text)
+
+
+def generate_questions(count, categories, rng):
+    '''yields question rows as dicts'''
+    for index in range(count):
+        words = rng.sample(WORDS, 4)
+        yield {
+            'question': f'Which {words[0]} of the {words[1]} is known for its {words[2]} ({index})?',
+            'answer': words[3].title(),
+            'difficulty': rng.randint(1, 5),
+            'category': rng.randint(1, categories)
+        }
+
+
+def seed(engine, size, categories, seed_value, chunk=50000):
+    '''
+    replace the questions and categories of engine with a synthetic dataset.
+    PostgreSQL is loaded with COPY, other databases with executemany
+    '''
+    from models import Question, Category, DataVersion
+
+    rng = random.Random(seed_value)
+    postgres = engine.dialect.name == 'postgresql'
+
+    with engine.begin() as connection:
+        connection.execute(Question.__table__.delete())
+        connection.execute(Category.__table__.delete())
+        connection.execute(Category.__table__.insert(),
+                           [{'id': id, 'type': f'Category {id}'} for id in range(1, categories + 1)])
+
+    rows = generate_questions(size, categories, rng)
+    while True:
+        batch = [row for _, row in zip(range(chunk), rows)]
+        if not batch:
+            break
+
+        if postgres:
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerows((row['question'], row['answer'], row['difficulty'], row['category']) for row in batch)
+            buffer.seek(0)
+            raw = engine.raw_connection()
+            try:
+                raw.cursor().copy_expert(
+                    'COPY questions (question, answer, difficulty, category) FROM STDIN WITH CSV', buffer)
+                raw.commit()
+            finally:
+                raw.close()
+        else:
+            with engine.begin() as connection:
+                connection.execute(Question.__table__.insert(), batch)
+
+    with engine.begin() as connection:
+        # a new data version: cached responses and ETags of the old data are stale
+        table = DataVersion.__table__
+        connection.execute(table.update().where(table.c.name == 'questions')
+                                         .values(version=table.c.version + 1))
+        if postgres:
+            connection.execute('ANALYZE questions')
+            connection.execute('ANALYZE categories')
+
+
+class Scenarios:
+    '''
+    the requests of every scenario as (method, path, json body),
+    the same requests drive the test client and the http load mode
+    '''
+
+    def __init__(self, size, categories, rng):
+        self.size = size
+        self.categories = categories
+        self.rng = rng
+        self.created = []
+        self._lock = threading.Lock()
+
+    def list(self):
+        page = self.rng.randint(1, max(1, min(self.size // 10, 100)))
+        return 'GET', f'/api/v1/questions?page={page}', None
+
+    def category(self):
+        return 'GET', f'/api/v1/categories/{self.rng.randint(1, self.categories)}/questions', None
+
+    def search(self):
+        return 'POST', '/api/v1/questions/search', {'searchTerm': ' '.join(self.rng.sample(WORDS, 2))}
+
+    def quiz(self):
+        previous = [self.rng.randint(1, self.size) for _ in range(5)]
+        return 'POST', '/api/v1/quizzes', {
+            'previous_questions': previous,
+            'quiz_category': {'id': self.rng.randint(0, self.categories)}
+        }
+
+    def create(self):
+        return 'POST', '/api/v1/questions', {
+            'question': 'Benchmark question?',
+            'answer': 'Benchmark answer',
+            'difficulty': self.rng.randint(1, 5),
+            'category': self.rng.randint(1, self.categories)
+        }
+
+    def delete(self):
+        # delete the questions the create scenario added, the dataset keeps its size
+        with self._lock:
+            id = self.created.pop() if self.created else 0
+        return 'DELETE', f'/api/v1/questions/{id}', None
+
+    def remember(self, scenario, status, body):
+        if scenario == 'create' and status == 200:
+            with self._lock:
+                self.created.append(json.loads(body)['id'])
+
+
+class TestClientDriver:
+    '''in-process requests through the flask test client'''
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def __call__(self, method, path, body):
+        response = self.client.open(path, method=method, json=body)
+        return response.status_code, response.data
+
+
+class HTTPDriver:
+    '''requests to a running server'''
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+
+    def __call__(self, method, path, body):
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        request = urllib.request.Request(self.base_url + path, data=data, method=method,
+                                         headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as error:
+            return error.code, error.read()
+
+
+def percentile(sorted_values, fraction):
+    '''
+    nearest-rank percentile of an already sorted list: the smallest value
+    with at least fraction of the values at or below it
+    '''
+    if not sorted_values:
+        return 0.0
+    # rounded first, 0.07 * 100 is 7.000000000000001 in floating point
+    rank = math.ceil(round(fraction * len(sorted_values), 9))
+    index = max(0, min(len(sorted_values) - 1, rank - 1))
+    return sorted_values[index]
+
+
+def run_scenario(name, scenarios, driver, requests, concurrency, warmup):
+    '''runs requests of a scenario, returns its latency and throughput report'''
+    build = getattr(scenarios, name)
+
+    for _ in range(warmup):
+        method, path, body = build()
+        status, data = driver(method, path, body)
+        scenarios.remember(name, status, data)
+
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    remaining = [requests]
+
+    def worker():
+        while True:
+            with lock:
+                if remaining[0] == 0:
+                    return
+                remaining[0] -= 1
+                method, path, body = build()
+            start = time.perf_counter()
+            status, data = driver(method, path, body)
+            elapsed = time.perf_counter() - start
+            scenarios.remember(name, status, data)
+            with lock:
+                latencies.append(elapsed)
+                if status >= 500:
+                    errors[0] += 1
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'throughput': len(latencies) / duration if duration else 0.0,
+        'p50': percentile(latencies, 0.50) * 1000,
+        'p95': percentile(latencies, 0.95) * 1000,
+        'p99': percentile(latencies, 0.99) * 1000
+    }
+
+
+def compare(results, baseline, max_regression):
+    '''
+    regressions of results against baseline: p95 / p99 latency higher,
+    or throughput lower, by more than max_regression (0.2 = 20%)
+    '''
+    regressions = []
+    for name, result in results.items():
+        reference = baseline.get(name)
+        if reference is None:
+            continue
+        for metric in ('p95', 'p99'):
+            if reference[metric] and result[metric] > reference[metric] * (1 + max_regression):
+                regressions.append(f'{name} {metric}: {result[metric]:.2f}ms > {reference[metric]:.2f}ms')
+        if reference['throughput'] and result['throughput'] < reference['throughput'] * (1 - max_regression):
+            regressions.append(f"{name} throughput: {result['throughput']:.1f}/s < {reference['throughput']:.1f}/s")
+    return regressions
+
+
+def print_report(results):
+    print(f"{'scenario':<10}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, result in results.items():
+        print(f"{name:<10}{result['requests']:>10}{result['errors']:>8}{result['throughput']:>10.1f}"
+              f"{result['p50']:>10.2f}{result['p95']:>10.2f}{result['p99']:>10.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='benchmark the v1 routes')
+    parser.add_argument('--database-url', default=DEFAULT_DATABASE_URL)
+    parser.add_argument('--size', default='10k', help='number of questions: 10k, 100k, 1M...')
+    parser.add_argument('--categories', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=42, help='random seed of the dataset and the requests')
+    parser.add_argument('--seed-data', action='store_true', help='replace the data with a synthetic dataset first')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--requests', type=int, default=500, help='timed requests per scenario')
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--http', metavar='URL', help='load a running server instead of the test client')
+    parser.add_argument('--cache', action='store_true', help='keep the response cache on')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--compare', action='store_true', help='exit with 1 when a scenario regressed')
+    parser.add_argument('--max-regression', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    from flaskr import create_app
+    from models import db
+
+    size = parse_size(args.size)
+    # the benchmark client would be rate limited
+    app = create_app({'DATABASE_URL': args.database_url, 'RESPONSE_CACHE': 'memory' if args.cache else 'off',
+                      'RATE_LIMIT': 'off', 'MAX_CONCURRENT_REQUESTS': 0})
+
+    if args.seed_data:
+        with app.app_context():
+            start = time.perf_counter()
+            seed(db.engine, size, args.categories, args.seed)
+            print(f'seeded {size} questions in {time.perf_counter() - start:.1f}s')
+
+    driver = HTTPDriver(args.http) if args.http else TestClientDriver(app)
+    scenarios = Scenarios(size, args.categories, random.Random(args.seed))
+
+    results = {}
+    for name in args.scenarios.split(','):
+        results[name] = run_scenario(name, scenarios, driver, args.requests, args.concurrency, args.warmup)
+    print_report(results)
+
+    # latencies only compare at the same dataset size and concurrency
+    key = f'{size}x{args.concurrency}'
+    stored = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            stored = json.load(baseline_file)
+
+    if args.save_baseline:
+        stored[key] = results
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(stored, baseline_file, indent=2, sort_keys=True)
+        print(f'baseline saved to {args.baseline}')
+
+    if args.compare:
+        if key not in stored:
+            print(f'no baseline for {size} questions at concurrency {args.concurrency} in {args.baseline}')
+            return 1
+        regressions = compare(results, stored[key], args.max_regression)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,17 +3,88 @@ import os
 from flask import Flask, request, abort, jsonify
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 import random
 
 from models import setup_db, Question, Category
+from .search import init_search, CachedSearch
+from .quiz_sessions import init_quiz_sessions
+from .sampler import init_sampler
+from .counts import init_counter
+from .cache import init_cache
+from .metrics import init_metrics
+from .serializer import init_serializer
+from .ratelimit import init_rate_limit
+from .group_commit import init_group_commit
+from .suggest import init_suggest
+from .profiling import init_profiling
+from .startup import StartupTimer, engines, install_fork_guard
 
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
-    setup_db(app)
+    # load settings, test_config overrides them
+    app.config.from_object('settings')
+    if test_config is not None:
+        app.config.from_mapping(test_config)
 
-    with app.app_context():
+    # client address and scheme from the headers of the trusted proxies
+    hops = app.config['PROXY_FIX_HOPS']
+    if hops > 0:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops, x_proto=hops)
+
+    # every phase is timed, see GET /api/v1/ready
+    timer = StartupTimer(app.config['STARTUP_BUDGET_MS'])
+    app.extensions['startup'] = timer
+
+    # no connection is opened unless migrations run
+    with timer.phase('database'):
+        setup_db(app, app.config['DATABASE_URL'])
+        # connections inherited through a fork are never reused
+        for bind, engine in engines(app):
+            install_fork_guard(engine)
+
+    with app.app_context(), timer.phase('services'):
+
+        # full-text search engine for the configured database
+        search = init_search(app)
+
+        # uniform random questions of the quiz
+        init_sampler(app)
+
+        # total_questions of the list and search routes
+        init_counter(app)
+
+        # server-side quiz sessions
+        init_quiz_sessions(app)
+
+        # response cache of the GET routes
+        cache = init_cache(app)
+
+        # fast JSON encoder of the read routes
+        init_serializer(app)
+
+        # per-request SQL metrics, Server-Timing header
+        metrics = init_metrics(app)
+        if metrics is not None and cache is not None:
+            metrics.registry.collectors.append(cache.collect)
+        if metrics is not None and isinstance(search, CachedSearch):
+            metrics.registry.collectors.append(search.collect)
+
+        # prefix completions of the search box
+        init_suggest(app)
+
+        # group commits of the inserts of concurrent requests
+        init_group_commit(app)
+
+        # per-client rate limits and load shedding of the api
+        limiter = init_rate_limit(app)
+        if metrics is not None and limiter is not None:
+            metrics.registry.collectors.append(limiter.collect)
+
+        # on-demand profiles of admitted requests
+        init_profiling(app)
 
         # import blueprints
         from .api.v1 import api1
@@ -46,6 +117,8 @@ def create_app(test_config=None):
 
 
 
+    timer.finish(app)
+
     """
     @TODO: Set up CORS. Allow '*' for origins. Delete the sample route after completing the TODOs
     """
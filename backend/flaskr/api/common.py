@@ -0,0 +1,160 @@
+# common.py
+# helpers shared by the api blueprints
+from sqlalchemy import func, select
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+
+from models import db, Question, Category
+
+QUESTIONS_PER_PAGE = 10
+
+# keys of question.format(), in the order of the projections
+QUESTION_FIELDS = ('id', 'question', 'answer', 'category', 'difficulty')
+
+
+def validate_question(data):
+    '''
+    check the fields of a new question: question, answer, difficulty and
+    category are required, difficulty goes from 1 to 5.
+    returns (question, answer, category, difficulty),
+    raises ValueError with the reason otherwise
+    '''
+    for field in ('question', 'answer', 'difficulty', 'category'):
+        if not data.get(field):
+            raise ValueError(f'{field} is required')
+
+    try:
+        difficulty = int(data['difficulty'])
+        category = int(data['category'])
+    except (TypeError, ValueError):
+        raise ValueError('difficulty and category must be integers')
+
+    if not 1 <= difficulty <= 5:
+        raise ValueError('difficulty must be between 1 and 5')
+
+    return data['question'], data['answer'], category, difficulty
+
+
+def int_arg(request, name):
+    '''
+    integer value of the ?name= argument, None when absent,
+    raises ValueError when it is not an integer
+    '''
+    value = request.args.get(name)
+    if value is None:
+        return None
+    return int(value)
+
+
+def page_offset(request):
+    '''
+    row offset of the ?page= argument, None for pages below 1
+    '''
+    page = request.args.get('page', 1, type=int)
+
+    if page < 1:
+        return None
+
+    return (page - 1) * QUESTIONS_PER_PAGE
+
+
+class random_order(FunctionElement):
+    '''
+    ORDER BY expression of a random order in the sql of the database:
+    random() for PostgreSQL and sqlite, rand() for MySQL, NEWID() for SQL Server
+    '''
+    name = 'random_order'
+
+
+@compiles(random_order)
+def _random_order(element, compiler, **kw):
+    return 'random()'
+
+
+@compiles(random_order, 'mysql')
+def _random_order_mysql(element, compiler, **kw):
+    return 'rand()'
+
+
+@compiles(random_order, 'mssql')
+def _random_order_mssql(element, compiler, **kw):
+    return 'NEWID()'
+
+
+def question_selection(*criteria):
+    '''
+    Core projection of the formatted question columns ordered by id,
+    rows come back as plain tuples without ORM instances
+    '''
+    table = Question.__table__
+    selection = select([table.c[field] for field in QUESTION_FIELDS]).order_by(table.c.id)
+
+    for criterion in criteria:
+        selection = selection.where(criterion)
+
+    return selection
+
+
+def format_rows(rows):
+    '''question_selection rows as question.format() dicts'''
+    return [dict(zip(QUESTION_FIELDS, row)) for row in rows]
+
+
+def category_types(*criteria):
+    '''{category id: type} of the categories, ordered by id'''
+    table = Category.__table__
+    selection = select([table.c.id, table.c.type]).order_by(table.c.id)
+
+    for criterion in criteria:
+        selection = selection.where(criterion)
+
+    return {id: type for id, type in db.session.execute(selection)}
+
+
+def paginate_questions(request, selection):
+    '''
+    paginate a question_selection inside the database.
+
+    two modes are supported:
+        - ?page=N     LIMIT/OFFSET pagination (default, page 1)
+        - ?after_id=N keyset pagination on questions.id, every page
+                      costs the same as the first one
+    returns the formatted questions of the requested page
+    '''
+    after_id = request.args.get('after_id', None, type=int)
+
+    table = Question.__table__
+
+    if after_id is not None:
+        # keyset mode: seek past the cursor on the primary key
+        selection = selection.where(table.c.id > after_id) \
+                             .order_by(None).order_by(table.c.id)
+    else:
+        offset = page_offset(request)
+
+        # pages start at 1, anything lower is an empty page
+        if offset is None:
+            return []
+
+        selection = selection.offset(offset)
+
+    return format_rows(db.session.execute(selection.limit(QUESTIONS_PER_PAGE)))
+
+
+def next_cursor(current_questions):
+    '''
+    cursor to send back as ?after_id= to fetch the next page,
+    None when the current page is the last one
+    '''
+    if len(current_questions) < QUESTIONS_PER_PAGE:
+        return None
+
+    return current_questions[-1]['id']
+
+
+def count_questions(selection):
+    '''
+    total rows matched by a question_selection, as a real COUNT(*)
+    '''
+    statement = selection.with_only_columns([func.count(Question.__table__.c.id)]).order_by(None)
+    return db.session.execute(statement).scalar()
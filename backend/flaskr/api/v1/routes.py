@@ -4,22 +4,26 @@
 from models import db
 from models import Question, Category
 from . import api1
-from flask import abort, request, jsonify, current_app
-from sqlalchemy import func
+from ...cache import cached
+from ...conditional import conditional
+from ...bulk import BulkImport, iter_ndjson, iter_csv, question_filter, update_values, bulk_delete, bulk_update
+from ...export import export_selection, stream_rows, to_ndjson, to_csv
+from ...serializer import json_response
+from ...startup import warm_pools
+from ..common import QUESTIONS_PER_PAGE, validate_question, page_offset, paginate_questions, next_cursor
+from ..common import question_selection, category_types, int_arg
+from flask import abort, request, jsonify, current_app, Response, stream_with_context, g
+from sqlalchemy.exc import SQLAlchemyError
 
 import random
 
-QUESTIONS_PER_PAGE = 10
+# cookie set after a write, its requests read from the primary for a while
+PRIMARY_COOKIE = 'trivia_primary'
 
-def paginate_questions(request, selection):
-    page = request.args.get('page', 1, type=int)
-    start = (page -1) * QUESTIONS_PER_PAGE
-    end = start + QUESTIONS_PER_PAGE
-
-    questions = [question.format() for question in selection]
-    current_questions = questions[start:end]
-
-    return current_questions
+@api1.before_request
+def route_reads():
+    '''GET requests read from the replica, unless the client wrote recently'''
+    g.read_replica = request.method in ('GET', 'HEAD') and PRIMARY_COOKIE not in request.cookies
 
 """
 @TODO: Use the after_request decorator to set Access-Control-Allow
@@ -27,11 +31,16 @@ def paginate_questions(request, selection):
 @api1.after_request
 def after_request(response):
     '''defining extra headers'''
+    # read-after-write: keep the client on the primary until the replica caught up
+    if g.get('wrote_primary') and current_app.config.get('DB_REPLICA_URL'):
+        response.set_cookie(PRIMARY_COOKIE, '1', max_age=current_app.config['DB_REPLICA_STICKY_SECONDS'])
     response.headers.add('Access-Control-Allow-Headers',
                          'Content-Type,Authorization,true')
     response.headers.add('Access-Control-Allow-Methods',
                          'GET,PATCH,POST,DELETE,OPTIONS')
-    response.headers.add('Content-Type', 'application/json')
+    # streamed exports keep their own content type
+    if response.mimetype == 'application/json':
+        response.headers.add('Content-Type', 'application/json')
     return response
 
 """
@@ -40,22 +49,22 @@ Create an endpoint to handle GET requests
 for all available categories.
 """
 @api1.route('/categories')
+@conditional('public, max-age=60')
+@cached
 def get_categories():
     '''get all categories'''
-    categories = Category.query.order_by(Category.id).all()
-    
     # create category dictionnaire 
-    categories_dictionairy = {category.id: category.type for category in categories}
+    categories_dictionairy = category_types()
 
     # return 404 error when categories length is 0
-    if len(categories) == 0:
+    if len(categories_dictionairy) == 0:
         abort(404)
         
     # return categorie data
-    return jsonify({
+    return json_response({
         'success': True,
         'categories': categories_dictionairy,
-        'total_categories': len(Category.query.all())
+        'total_categories': len(categories_dictionairy)
     })
 
 """
@@ -71,31 +80,66 @@ ten questions per page and pagination at the bottom of the screen for three page
 Clicking on the page numbers should update the questions.
 """
 @api1.route('/questions')
+@conditional('no-cache')
+@cached
 def get_questions():
     ''' Get all Question '''
-    questions = Question.query.order_by(Question.id).all()
+    questions = question_selection()
 
     ''' Paginate question Question '''
     current_questions = paginate_questions(request, questions)
 
-    ''' Get all catégories'''
-    categories = Category.query.all()
-    
     # create categories disctionnary for all actegorie
-    categories_dictionairy = {category.id: category.type for category in categories}
+    categories_dictionairy = category_types()
 
     # return 404 error when current_questions is not available
     if len(current_questions) == 0:
         abort(404)
+
+    # exact, estimated or cached total, see COUNT_MODE
+    total_questions, exact = current_app.extensions['counter'].total(questions)
     
     # return questions data
-    return jsonify({
+    return json_response({
         'success': True,
         'questions': current_questions,
-        'total_questions': len(Question.query.all()),
+        'total_questions': total_questions,
+        'total_questions_exact': exact,
+        'next_after_id': next_cursor(current_questions),
         'categories': categories_dictionairy
     })
 
+@api1.route('/questions/export')
+def export_questions():
+    '''
+    stream every question as NDJSON (default) or CSV (?format=csv),
+    optionally filtered by ?category= and an inclusive ?min_id= / ?max_id= range
+    '''
+    export_format = request.args.get('format', 'ndjson')
+
+    # return 400 for unknown formats
+    if export_format not in ('ndjson', 'csv'):
+        abort(400)
+
+    # return 400 for filters that are not integers: dropping one would
+    # export the whole table into a shard
+    try:
+        selection = export_selection(
+            category=int_arg(request, 'category'),
+            min_id=int_arg(request, 'min_id'),
+            max_id=int_arg(request, 'max_id'))
+    except ValueError:
+        abort(400)
+
+    batches = stream_rows(selection, current_app.config['EXPORT_BATCH_SIZE'])
+
+    # stream the rows as they are read from the server-side cursor
+    if export_format == 'csv':
+        return Response(stream_with_context(to_csv(batches)), mimetype='text/csv')
+
+    return Response(stream_with_context(to_ndjson(batches)), mimetype='application/x-ndjson')
+
+
 """
 @TODO:
 Create an endpoint to DELETE question using a question ID.
@@ -130,6 +174,70 @@ def delete_question(question_id):
         abort(422)
 
 
+@api1.route('/questions', methods=['DELETE'])
+def delete_questions():
+    '''
+    delete every question matching the ids, category and/or difficulty
+    of the request body in one statement
+    '''
+    body = request.get_json()
+
+    # return 400 if body is not available
+    if not body:
+        abort(400)
+
+    # return 400 when no valid filter is given
+    try:
+        where = question_filter(body)
+    except ValueError:
+        abort(400)
+
+    try:
+        deleted = bulk_delete(where)
+    except:
+        # rollback and unprocessable when database has error
+        db.session.rollback()
+        abort(422)
+
+    return jsonify({
+        'success': True,
+        'deleted': deleted
+    })
+
+
+@api1.route('/questions', methods=['PATCH'])
+def update_questions():
+    '''
+    set the category and/or difficulty given in "set" on every question
+    matching the ids, category and/or difficulty of the request body
+    in one statement
+    '''
+    body = request.get_json()
+
+    # return 400 if body is not available
+    if not body:
+        abort(400)
+
+    # return 400 when the filter or the new values are not valid
+    try:
+        where = question_filter(body)
+        values = update_values(body.get('set'))
+    except ValueError:
+        abort(400)
+
+    try:
+        updated = bulk_update(where, values)
+    except:
+        # rollback and unprocessable when database has error
+        db.session.rollback()
+        abort(422)
+
+    return jsonify({
+        'success': True,
+        'updated': updated
+    })
+
+
 """
 @TODO:
 Create an endpoint to POST a new question,
@@ -149,49 +257,94 @@ def post_new_question():
     if not body:
         abort(400)
     
-    # verify if body has question, answer, difficulty anbd category attribut
-    if (body.get('question') and body.get('answer') and body.get('difficulty') and body.get('category')):
-        
-        # create data for a post question
-        new_question = body.get('question')
-        new_answer = body.get('answer')
-        new_category = body.get('category')
-        new_difficulty = body.get('difficulty')
-
-        # return 400 if difficulty greater than 6
-        if not 1 <= int(new_difficulty) < 6 :
-            abort(400)
-        
-        try:
-            # create new question on database
+    # verify if body has valid question, answer, difficulty and category attributs
+    try:
+        new_question, new_answer, new_category, new_difficulty = validate_question(body)
+    except ValueError:
+        abort(400)
+
+    try:
+        # create new question on database, in a group commit when enabled
+        committer = current_app.extensions.get('group_commit')
+        if committer is not None:
+            created = committer.insert({
+                'question': new_question,
+                'answer': new_answer,
+                'category': new_category,
+                'difficulty': new_difficulty
+            })
+        else:
             question = Question(new_question, new_answer, new_category, new_difficulty)
-            question.insert()
-
-            # get all questions order by id 
-            questions = Question.query.order_by(Question.id).all()
-            
-            # return 404 if questions is not available
-            if len(questions) == 0:
-                abort(404)
-            
-            # paginate questions
-            current_questions = paginate_questions(request, questions)
-           
-            # return question data for front
+            created = question.insert()
+
+        # the legacy full page payload is only built when asked for
+        if request.args.get('response') != 'full':
+            # return only the created question and the total
+            total_questions, exact = current_app.extensions['counter'].total(question_selection())
             return jsonify({
                 'success': True,
-                'id': question.id,
-                'question': question.question,
-                'questions': current_questions,
-                'total_questions': len(questions)
+                'id': created['id'],
+                'question': created['question'],
+                'created': created,
+                'total_questions': total_questions,
+                'total_questions_exact': exact
             })
-        except:
-            # rollback and unprocessable when database has error
-            db.session.rollback()
-            abort(422)
+
+        # get all questions order by id 
+        questions = question_selection()
+        
+        # paginate questions
+        current_questions = paginate_questions(request, questions)
+
+        # return 404 if questions is not available
+        if len(current_questions) == 0:
+            abort(404)
+       
+        # return question data for front
+        total_questions, exact = current_app.extensions['counter'].total(questions)
+        return jsonify({
+            'success': True,
+            'id': created['id'],
+            'question': created['question'],
+            'questions': current_questions,
+            'total_questions': total_questions,
+            'total_questions_exact': exact
+        })
+    except:
+        # rollback and unprocessable when database has error
+        db.session.rollback()
+        abort(422)
+
+
+@api1.route('/questions/bulk', methods=['POST'])
+def bulk_import_questions():
+    '''
+    import questions from a NDJSON (default) or CSV (text/csv or ?format=csv)
+    upload, streamed line by line and inserted in batches
+    '''
+    # decode the upload line by line, never the whole body at once
+    lines = (line.decode('utf-8', 'replace') for line in request.stream)
+
+    if request.mimetype == 'text/csv' or request.args.get('format') == 'csv':
+        try:
+            records = iter_csv(lines)
+        except ValueError:
+            # return 400 when the csv header is missing a field
+            abort(400)
     else:
+        records = iter_ndjson(lines)
+
+    bulk = BulkImport(current_app.config['BULK_BATCH_SIZE'], current_app.config['BULK_MAX_ERRORS'])
+    report = bulk.run(records)
+
+    # return 400 when the upload had no row at all
+    if report['inserted'] == 0 and report['failed'] == 0:
         abort(400)
 
+    # return the import report, rows with errors are listed with their line
+    return jsonify(dict(report, success=True))
+
+
 """
 @TODO:
 Create a POST endpoint to get questions based on a search term.
@@ -215,28 +368,53 @@ def search_questions():
     if body.get('searchTerm'):
         search_term = body.get('searchTerm')
 
-        page = request.args.get('page', 1, type=int)
-        
-        # get questions filter by search term in database
-        selection = Question.query.filter(Question.question.ilike(f'%{search_term}%'))
+        offset = page_offset(request)
+        if offset is None:
+            abort(404)
+
+        # get questions matching the search term from the search engine
+        questions, total_questions, exact = current_app.extensions['search'].search(
+            search_term, offset, QUESTIONS_PER_PAGE)
 
-        # paginate questions filter
-        current_questions = paginate_questions(request, selection)
+        # questions of the page, already formatted
+        current_questions = questions
 
         # return 404 when current_question is not available
         if len(current_questions) == 0:
             abort(404)
         
         # return questions data for front
-        return jsonify({
+        return json_response({
             'success': True,
             'questions': current_questions,
-            'total_questions': len(current_questions)
+            'total_questions': total_questions,
+            'total_questions_exact': exact
         })
     else:
         # return 400 when request are bad
         abort(400)
 
+@api1.route('/questions/suggest')
+def suggest_questions():
+    '''
+    completions of a search prefix: the most used words completing its
+    last word, and the questions starting with it
+    '''
+    prefix = request.args.get('prefix', '')
+    limit = request.args.get('limit', 10, type=int)
+
+    # return 400 when the prefix is missing or the limit out of bounds
+    if not prefix.strip() or not 1 <= limit <= current_app.config['SUGGEST_MAX_RESULTS']:
+        abort(400)
+
+    words, questions = current_app.extensions['suggest'].suggest(prefix, limit)
+    return json_response({
+        'success': True,
+        'prefix': prefix,
+        'words': words,
+        'questions': questions
+    })
+
 """
 @TODO:
 Create a GET endpoint to get questions based on category.
@@ -246,20 +424,21 @@ categories in the left column will cause only questions of that
 category to be shown.
 """
 @api1.route('/categories/<category_id>/questions')
+@conditional('no-cache')
+@cached
 def get_questions_by_category(category_id):
     '''
     get category by given from request 
     '''
-    category = Category.query.filter(Category.id == category_id).one_or_none()
+    categories = category_types(Category.id == category_id)
     
     # return 404 when current_question is not available
-    if category is None:
+    if len(categories) == 0:
         abort(404)
+    category_id, category_type = categories.popitem()
     
-    page = request.args.get('page', 1, type=int)
-
     # get all questions by specific category
-    selection = Question.query.filter(Question.category == category.id).order_by(Question.id)
+    selection = question_selection(Question.category == category_id)
     
     # paginate question 
     current_questions = paginate_questions(request, selection)
@@ -268,12 +447,17 @@ def get_questions_by_category(category_id):
     if len(current_questions) == 0:
         abort(404)
     
+    # exact, estimated or cached total, see COUNT_MODE
+    total_questions, exact = current_app.extensions['counter'].total(selection, category_id)
+
     # return question data
-    return jsonify({
+    return json_response({
         'success': True,
         'questions': current_questions,
-        'total_questions': len(current_questions),
-        'current_category': category.type
+        'total_questions': total_questions,
+        'total_questions_exact': exact,
+        'next_after_id': next_cursor(current_questions),
+        'current_category': category_type
     })
 
 """
@@ -296,7 +480,33 @@ def play_quiz():
     if not body:
         # posting an envalid json should return a 400 error.
         abort(400)
-        
+
+    # optional batch size: "count" questions from one draw instead of one question
+    count = body.get('count')
+    if count is not None and (type(count) != int or not 1 <= count <= current_app.config['QUIZ_MAX_BATCH']):
+        abort(400)
+    prefetch = body.get('prefetch') is True
+
+    # continue a quiz session, its deck was shuffled when the quiz started
+    if body.get('quiz_session'):
+        return _draw_quiz_question(body.get('quiz_session'), count, prefetch)
+
+    # start a quiz session when asked to
+    if body.get('session') is True:
+        category = body.get('quiz_category')
+        previous_questions = body.get('previous_questions', [])
+
+        if category is None or type(previous_questions) != list:
+            abort(400)
+        try:
+            category_id = int(category['id'])
+        except (KeyError, TypeError, ValueError):
+            abort(400)
+
+        token = current_app.extensions['quiz_sessions'].start(
+            category_id, previous_questions)
+        return _draw_quiz_question(token, count, prefetch)
+
     if (body.get('previous_questions') is None or body.get('quiz_category') is None):
         # if previous_questions or quiz_category are missing, return a 400 error
         abort(400)
@@ -305,26 +515,39 @@ def play_quiz():
     
     if type(previous_questions) != list:
         abort(400)
+
+    # played question ids, compared with the ids of the sampler
+    try:
+        previous_questions = [int(id) for id in previous_questions]
+    except (TypeError, ValueError):
+        abort(400)
         
     category = body.get('quiz_category')
     
     # just incase, convert category id to integer
-    category_id = int(category['id'])
-    
-    # insure that there are questions to be played.
-    if category_id == 0:
-        # if category id is 0, query the database for a random object of all questions
-        Questions = Question.query.order_by(func.random())
-    else:
-        # load a random object of questions from the specified category
-        Questions = Question.query.filter(Question.category == category_id).order_by(func.random())
+    try:
+        category_id = int(category['id'])
+    except (KeyError, TypeError, ValueError):
+        abort(400)
+
+    # uniform random questions, without sorting the category (0 for all questions)
+    sampler = current_app.extensions['sampler']
        
-    if not Questions.all():
+    if not sampler.has_questions(category_id):
         # return 404 if questions is no available
         abort(404)
+    elif count is not None:
+        # count distinct unplayed questions from a single random draw
+        questions = sampler.sample(category_id, previous_questions, count)
+        next_request = {
+            'previous_questions': previous_questions + [question.id for question in questions],
+            'quiz_category': category
+        }
+        return jsonify(_quiz_batch(questions, count, prefetch, next_request, len(questions) < count))
     else:
-        # load a random question from our previous query, which is not in the previous_questions list.
-        question = Questions.filter(Question.id.notin_(previous_questions)).first()
+        # load a random question, which is not in the previous_questions list.
+        questions = sampler.sample(category_id, previous_questions)
+        question = questions[0] if questions else None
         
     # Check if questions are finished
     if question is None:
@@ -344,6 +567,113 @@ def play_quiz():
         
 
 
+@api1.route('/cache/stats')
+def get_cache_stats():
+    '''hit, miss and eviction counters of the response cache'''
+    cache = current_app.extensions.get('response_cache')
+
+    # return 404 when the cache is turned off
+    if cache is None:
+        abort(404)
+
+    return jsonify({
+        'success': True,
+        'cache': cache.stats()
+    })
+
+
+@api1.route('/metrics')
+def get_metrics():
+    '''request, SQL and cache metrics of this process in prometheus text format'''
+    metrics = current_app.extensions.get('metrics')
+
+    # return 404 when metrics are turned off
+    if metrics is None:
+        abort(404)
+
+    return Response(metrics.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@api1.route('/ready')
+def get_ready():
+    '''
+    readiness probe of the worker: opens the first connections of its
+    pools, 503 until every database answers
+    '''
+    try:
+        pools = warm_pools(current_app)
+        # the suggest index is built before the worker takes traffic
+        suggester = current_app.extensions['suggest']
+        suggester.ensure_built()
+    except SQLAlchemyError:
+        current_app.logger.exception('database not ready')
+        return jsonify({
+            'success': False,
+            'ready': False,
+            'error': 503,
+            'message': 'database unavailable'
+        }), 503
+
+    return jsonify({
+        'success': True,
+        'ready': True,
+        'startup': current_app.extensions['startup'].report(),
+        'pools': pools,
+        'suggest': suggester.stats()
+    })
+
+
+def _quiz_batch(questions, count, prefetch, next_request, exhausted):
+    '''
+    payload of a batch of quiz questions. with prefetch, it also holds the
+    body of the request for the next batch, which the client can send right
+    away to buffer it while the user answers (None once nothing is left)
+    '''
+    payload = {
+        'success': True,
+        'questions': [question.format() for question in questions]
+    }
+    if prefetch:
+        payload['prefetch'] = None if exhausted else dict(next_request, count=count, prefetch=True)
+    return payload
+
+
+def _draw_quiz_question(token, count=None, prefetch=False):
+    '''next question, or next count questions, of a quiz session'''
+    sessions = current_app.extensions['quiz_sessions']
+
+    if count is not None:
+        try:
+            questions, remaining = sessions.draw_many(token, count)
+        except KeyError:
+            # unknown or expired session
+            abort(404)
+
+        payload = _quiz_batch(questions, count, prefetch, {'quiz_session': token}, remaining == 0)
+        return jsonify(dict(payload, quiz_session=token, remaining=remaining))
+
+    try:
+        question, remaining = sessions.draw(token)
+    except KeyError:
+        # unknown or expired session
+        abort(404)
+
+    # return success message if all questions are played
+    if question is None:
+        return jsonify({
+            'success': True,
+            'quiz_session': token,
+            'remaining': 0
+        })
+
+    return jsonify({
+        'success': True,
+        'question': question.format(),
+        'quiz_session': token,
+        'remaining': remaining
+    })
+
+
 """
 @TODO:
 Create error handlers for all expected errors
@@ -0,0 +1,478 @@
+# asgi.py
+# async variant of the question, category and quiz routes of /api/v1.
+# runs on an ASGI server (uvicorn flaskr.asgi:app) with an asyncpg pool,
+# a worker never blocks on a Postgres round trip and the independent
+# queries of a request (page, count, categories) run concurrently on
+# connections of their own. responses keep the JSON contract of /api/v1
+# so both variants can be A/B tested under load.
+import asyncio
+import json
+import logging
+import re
+import secrets
+from urllib.parse import parse_qs
+
+from sqlalchemy.engine.url import make_url
+
+import settings
+from models import database_path
+from .api.common import QUESTIONS_PER_PAGE
+from .quiz_sessions import candidates, new_session, pick, remaining, session_backend
+
+QUESTION_COLUMNS = 'id, question, answer, category, difficulty'
+
+ERROR_MESSAGES = {
+    400: 'bad request',
+    404: 'resource not found',
+    405: 'method not allowed',
+    422: 'unprocessable',
+    500: 'internal server error'
+}
+
+logger = logging.getLogger(__name__)
+
+CORS_HEADERS = [
+    (b'access-control-allow-origin', b'*'),
+    (b'access-control-allow-headers', b'Content-Type,Authorization,true'),
+    (b'access-control-allow-methods', b'GET,PATCH,POST,DELETE,OPTIONS')
+]
+
+
+class HTTPError(Exception):
+    '''aborts a request with the json error payload of status'''
+
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+
+def error_payload(status):
+    # same body as the error handlers of the flask blueprint, 422 included
+    return {
+        'success': False,
+        'error': 442 if status == 422 else status,
+        'message': ERROR_MESSAGES[status]
+    }
+
+
+def dumps(payload):
+    '''same serialization as flask jsonify: sorted keys, compact, final newline'''
+    return (json.dumps(payload, sort_keys=True, separators=(',', ':')) + '\n').encode('utf-8')
+
+
+def asyncpg_dsn(url):
+    '''asyncpg connection string of a SQLAlchemy database url'''
+    url = make_url(url)
+    url.drivername = 'postgresql'
+    return str(url)
+
+
+def format_question(row):
+    '''same keys as question.format()'''
+    return {
+        'id': row['id'],
+        'question': row['question'],
+        'answer': row['answer'],
+        'category': row['category'],
+        'difficulty': row['difficulty']
+    }
+
+
+class Request:
+
+    def __init__(self, scope, body):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.args = {key: values[0] for key, values in parse_qs(scope['query_string'].decode('latin-1')).items()}
+        self.body = body
+
+    def arg(self, name, default=None):
+        '''integer query argument, default when missing or invalid'''
+        try:
+            return int(self.args[name])
+        except (KeyError, ValueError):
+            return default
+
+    def get_json(self):
+        '''the json body, None when missing or invalid'''
+        try:
+            return json.loads(self.body) if self.body else None
+        except ValueError:
+            return None
+
+
+class AsyncAPI:
+    '''
+    ASGI application. the asyncpg pool is opened on lifespan startup,
+    or by the first request when the server does not send lifespan events
+    '''
+
+    def __init__(self, database_url, pool_size, max_overflow, quiz_sessions, quiz_max_batch):
+        self.dsn = asyncpg_dsn(database_url)
+        self.quiz_max_batch = quiz_max_batch
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.pool = None
+        # created on the event loop of the server
+        self._pool_lock = None
+        # same sessions as the flask app when they are kept in redis
+        self.quiz_sessions = quiz_sessions
+        # (method, path pattern, handler)
+        self.routes = [
+            ('GET', re.compile(r'^/api/v1/categories$'), self.get_categories),
+            ('GET', re.compile(r'^/api/v1/questions$'), self.get_questions),
+            ('GET', re.compile(r'^/api/v1/categories/(?P<category_id>[^/]+)/questions$'),
+             self.get_questions_by_category),
+            ('POST', re.compile(r'^/api/v1/quizzes$'), self.play_quiz)
+        ]
+
+    async def open(self):
+        if self._pool_lock is None:
+            self._pool_lock = asyncio.Lock()
+        async with self._pool_lock:
+            if self.pool is None:
+                try:
+                    import asyncpg
+                except ImportError:
+                    raise RuntimeError('the async api needs the asyncpg package (pip install asyncpg)')
+                self.pool = await asyncpg.create_pool(
+                    self.dsn, min_size=1, max_size=self.pool_size + self.max_overflow)
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+        self._pool_lock = None
+
+    # every query takes a connection of its own, so queries gathered
+    # together run concurrently
+
+    async def fetch(self, query, *args):
+        async with self.pool.acquire() as connection:
+            return await connection.fetch(query, *args)
+
+    async def fetchrow(self, query, *args):
+        async with self.pool.acquire() as connection:
+            return await connection.fetchrow(query, *args)
+
+    async def fetchval(self, query, *args):
+        async with self.pool.acquire() as connection:
+            return await connection.fetchval(query, *args)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await self.open()
+                except Exception as error:
+                    await send({'type': 'lifespan.startup.failed', 'message': str(error)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def http(self, scope, receive, send):
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+
+        request = Request(scope, body)
+        if request.method == 'OPTIONS':
+            # CORS preflight
+            await self.respond(send, 200, b'')
+            return
+
+        try:
+            handler, params = self.match(request)
+            if self.pool is None:
+                await self.open()
+            status, payload = 200, await handler(request, **params)
+        except HTTPError as error:
+            status, payload = error.status, error_payload(error.status)
+        except Exception:
+            # a bug or a lost database: still a json answer, never a dropped connection
+            logger.exception('%s %s failed', request.method, request.path)
+            status, payload = 500, error_payload(500)
+
+        await self.respond(send, status, dumps(payload))
+
+    def match(self, request):
+        '''handler and path parameters of request, 404 or 405 otherwise'''
+        allowed = False
+        for method, pattern, handler in self.routes:
+            found = pattern.match(request.path)
+            if found is None:
+                continue
+            if method == request.method:
+                return handler, found.groupdict()
+            allowed = True
+
+        raise HTTPError(405 if allowed else 404)
+
+    async def respond(self, send, status, body):
+        headers = CORS_HEADERS + [(b'content-length', str(len(body)).encode())]
+        if body:
+            headers.append((b'content-type', b'application/json'))
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def page_questions(self, request, where='', *args):
+        '''
+        formatted questions of the requested page, same ?page= and
+        ?after_id= modes as paginate_questions
+        '''
+        after_id = request.arg('after_id')
+        if after_id is not None:
+            # keyset mode: seek past the cursor on the primary key
+            where = (where + ' AND' if where else 'WHERE') + f' id > ${len(args) + 1}'
+            rows = await self.fetch(
+                f'SELECT {QUESTION_COLUMNS} FROM questions {where} ORDER BY id LIMIT {QUESTIONS_PER_PAGE}',
+                *args, after_id)
+        else:
+            page = request.arg('page', 1)
+            # pages start at 1, anything lower is an empty page
+            if page < 1:
+                return []
+            rows = await self.fetch(
+                f'SELECT {QUESTION_COLUMNS} FROM questions {where} ORDER BY id '
+                f'LIMIT {QUESTIONS_PER_PAGE} OFFSET {(page - 1) * QUESTIONS_PER_PAGE}', *args)
+
+        return [format_question(row) for row in rows]
+
+    @staticmethod
+    def next_cursor(current_questions):
+        if len(current_questions) < QUESTIONS_PER_PAGE:
+            return None
+        return current_questions[-1]['id']
+
+    async def get_categories(self, request):
+        '''get all categories'''
+        categories = await self.fetch('SELECT id, type FROM categories ORDER BY id')
+
+        # return 404 error when there is no category
+        if len(categories) == 0:
+            raise HTTPError(404)
+
+        return {
+            'success': True,
+            'categories': {category['id']: category['type'] for category in categories},
+            'total_categories': len(categories)
+        }
+
+    async def get_questions(self, request):
+        '''page of questions, the total and every category'''
+        # the page, the count and the categories are independent queries
+        current_questions, total_questions, categories = await asyncio.gather(
+            self.page_questions(request),
+            self.fetchval('SELECT count(id) FROM questions'),
+            self.fetch('SELECT id, type FROM categories'))
+
+        # return 404 error when the page is empty
+        if len(current_questions) == 0:
+            raise HTTPError(404)
+
+        return {
+            'success': True,
+            'questions': current_questions,
+            'total_questions': total_questions,
+            'total_questions_exact': True,
+            'next_after_id': self.next_cursor(current_questions),
+            'categories': {category['id']: category['type'] for category in categories}
+        }
+
+    async def get_questions_by_category(self, request, category_id):
+        '''page of the questions of a category'''
+        try:
+            category_id = int(category_id)
+        except ValueError:
+            raise HTTPError(404)
+
+        # the category is looked up while its questions are read
+        category, current_questions, total_questions = await asyncio.gather(
+            self.fetchrow('SELECT type FROM categories WHERE id = $1', category_id),
+            self.page_questions(request, 'WHERE category = $1', category_id),
+            self.fetchval('SELECT count(id) FROM questions WHERE category = $1', category_id))
+
+        # return 404 when the category or the page does not exist
+        if category is None or len(current_questions) == 0:
+            raise HTTPError(404)
+
+        return {
+            'success': True,
+            'questions': current_questions,
+            'total_questions': total_questions,
+            'total_questions_exact': True,
+            'next_after_id': self.next_cursor(current_questions),
+            'current_category': category['type']
+        }
+
+    async def play_quiz(self, request):
+        '''next quiz question, same body and sessions as POST /api/v1/quizzes'''
+        body = request.get_json()
+        if not body:
+            raise HTTPError(400)
+
+        # optional batch size: "count" questions from one draw instead of one question
+        count = body.get('count')
+        if count is not None and (type(count) != int or not 1 <= count <= self.quiz_max_batch):
+            raise HTTPError(400)
+        prefetch = body.get('prefetch') is True
+
+        # continue a quiz session
+        if body.get('quiz_session'):
+            return await self.draw_quiz_question(body.get('quiz_session'), count, prefetch)
+
+        category = body.get('quiz_category')
+        previous_questions = body.get('previous_questions')
+
+        # start a quiz session when asked to
+        if body.get('session') is True:
+            previous_questions = previous_questions if previous_questions is not None else []
+            if category is None or type(previous_questions) != list:
+                raise HTTPError(400)
+            category_id, previous_questions = self.quiz_ids(category, previous_questions)
+            return await self.draw_quiz_question(
+                await self.start_quiz_session(category_id, previous_questions), count, prefetch)
+
+        if previous_questions is None or category is None or type(previous_questions) != list:
+            raise HTTPError(400)
+
+        category_id, previous_questions = self.quiz_ids(category, previous_questions)
+        where, args = ('', ()) if category_id == 0 else ('WHERE category = $1', (category_id,))
+        excluded = ('AND' if where else 'WHERE') + f' id <> ALL(${len(args) + 1}::int[])'
+
+        # whether the category has questions, and random ones not played yet
+        exists, questions = await asyncio.gather(
+            self.fetchval(f'SELECT EXISTS (SELECT 1 FROM questions {where})', *args),
+            self.fetch(f'SELECT {QUESTION_COLUMNS} FROM questions {where} {excluded} ORDER BY random() '
+                       f'LIMIT {count or 1}', *args, previous_questions))
+
+        # return 404 when the category has no question
+        if not exists:
+            raise HTTPError(404)
+
+        if count is not None:
+            next_request = {
+                'previous_questions': previous_questions + [question['id'] for question in questions],
+                'quiz_category': category
+            }
+            return self.quiz_batch(questions, count, prefetch, next_request, len(questions) < count)
+
+        question = questions[0] if questions else None
+
+        # return success message if all questions are played
+        if question is None:
+            return {'success': True}
+
+        return {
+            'success': True,
+            'question': format_question(question)
+        }
+
+    @staticmethod
+    def quiz_ids(category, previous_questions):
+        '''(category id, played ids) as integers, 400 when they are not'''
+        try:
+            return int(category['id']), [int(id) for id in previous_questions]
+        except (KeyError, TypeError, ValueError):
+            raise HTTPError(400)
+
+    async def start_quiz_session(self, category_id, previous_questions):
+        '''start a session over the questions of a category, returns the session token'''
+        where, args = ('', ()) if category_id == 0 else ('WHERE category = $1', (category_id,))
+        excluded = ('AND' if where else 'WHERE') + f' id <> ALL(${len(args) + 1}::int[])'
+        bounds, total = await asyncio.gather(
+            self.fetchrow(f'SELECT min(id) AS low, max(id) AS high FROM questions {where}', *args),
+            self.fetchval(f'SELECT count(*) FROM questions {where} {excluded}', *args, previous_questions))
+
+        token = secrets.token_urlsafe(16)
+        self.quiz_sessions.set(token, new_session(category_id, bounds['low'], bounds['high'], total,
+                                                  previous_questions))
+        return token
+
+    async def draw_questions(self, token, count):
+        '''(questions, remaining questions) of a session, the draws of QuizSessions.draw_many'''
+        session = self.quiz_sessions.get(token)
+        # unknown or expired session
+        if session is None:
+            raise HTTPError(404)
+
+        questions = []
+        while session is not None and len(questions) < count and session['offset'] < session['size']:
+            need = count - len(questions)
+            end, probes = candidates(session, need)
+
+            # questions deleted or moved since the quiz started are not found
+            where, args = ('', ()) if session['category'] == 0 else ('AND category = $2', (session['category'],))
+            rows = await self.fetch(f'SELECT {QUESTION_COLUMNS} FROM questions WHERE id = ANY($1::int[]) {where}',
+                                    [id for position, id in probes], *args)
+            found = {row['id']: row for row in rows}
+
+            chosen, offset = pick(probes, end, found, need)
+            if self.quiz_sessions.advance(token, session['offset'], offset, len(chosen)):
+                questions.extend(found[id] for id in chosen)
+            session = self.quiz_sessions.get(token)
+
+        if not questions:
+            self.quiz_sessions.delete(token)
+        return questions, remaining(session) if session is not None else 0
+
+    @staticmethod
+    def quiz_batch(questions, count, prefetch, next_request, exhausted):
+        '''payload of a batch of quiz questions, with the next batch request when prefetching'''
+        payload = {
+            'success': True,
+            'questions': [format_question(question) for question in questions]
+        }
+        if prefetch:
+            payload['prefetch'] = None if exhausted else dict(next_request, count=count, prefetch=True)
+        return payload
+
+    async def draw_quiz_question(self, token, count=None, prefetch=False):
+        '''next question, or next count questions, of a quiz session'''
+        if count is not None:
+            questions, left = await self.draw_questions(token, count)
+            payload = self.quiz_batch(questions, count, prefetch, {'quiz_session': token}, left == 0)
+            return dict(payload, quiz_session=token, remaining=left)
+
+        questions, left = await self.draw_questions(token, 1)
+
+        # return success message if all questions are played
+        if not questions:
+            return {
+                'success': True,
+                'quiz_session': token,
+                'remaining': 0
+            }
+
+        return {
+            'success': True,
+            'question': format_question(questions[0]),
+            'quiz_session': token,
+            'remaining': left
+        }
+
+
+def create_asgi_app(database_url=database_path):
+    '''async api on database_url, pool and quiz sessions sized by the settings'''
+    return AsyncAPI(database_url,
+                    pool_size=settings.DB_POOL_SIZE,
+                    max_overflow=settings.DB_MAX_OVERFLOW,
+                    quiz_sessions=session_backend(settings.QUIZ_SESSIONS, settings.QUIZ_SESSION_URL,
+                                                  settings.QUIZ_SESSION_TTL, settings.QUIZ_SESSION_MAX),
+                    quiz_max_batch=settings.QUIZ_MAX_BATCH)
+
+
+app = create_asgi_app()
@@ -0,0 +1,237 @@
+# bulk.py
+# bulk question writes.
+# import: rows are parsed from the request stream one by one, validated
+# like POST /questions and inserted in batches, so memory stays bounded
+# by the batch size whatever the upload size.
+# delete / update: one set-based statement in one transaction.
+import csv
+import json
+
+from sqlalchemy import and_, exc, select
+
+from models import db, Question
+from . import changes
+from .api.common import validate_question
+
+CSV_FIELDS = ('question', 'answer', 'difficulty', 'category')
+
+
+def iter_ndjson(lines):
+    '''
+    yields (line number, row dict or None, error message or None)
+    for every non empty line of a NDJSON stream
+    '''
+    for number, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield number, None, 'invalid json'
+            continue
+        if not isinstance(row, dict):
+            yield number, None, 'a row must be a json object'
+            continue
+        yield number, row, None
+
+
+def iter_csv(lines):
+    '''
+    yields (line number, row dict or None, error message or None)
+    for every record of a CSV stream, the first record is the header.
+    raises ValueError right away when the header is missing a field
+    '''
+    reader = csv.DictReader(lines)
+    if reader.fieldnames is None or not set(CSV_FIELDS) <= set(reader.fieldnames):
+        raise ValueError('csv header must contain ' + ','.join(CSV_FIELDS))
+
+    return ((reader.line_num, row, None) for row in reader)
+
+
+def insert_rows(rows):
+    '''insert question rows in the current transaction, returns their ids'''
+    table = Question.__table__
+
+    if db.engine.dialect.name == 'postgresql':
+        # one multi-row INSERT ... RETURNING statement per batch
+        statement = table.insert().values(rows).returning(table.c.id)
+        return [id for (id,) in db.session.execute(statement)]
+
+    return [db.session.execute(table.insert(), row).inserted_primary_key[0] for row in rows]
+
+
+class BulkImport:
+    '''
+    inserts validated rows in batches of batch_size, a failed batch is
+    retried row by row so one bad row never aborts the whole load.
+    keeps at most max_errors error messages, failures are all counted.
+    '''
+
+    def __init__(self, batch_size, max_errors):
+        self.batch_size = batch_size
+        self.max_errors = max_errors
+        self.inserted = 0
+        self.failed = 0
+        self.errors = []
+        # (line number, row values) waiting to be inserted
+        self._batch = []
+
+    def error(self, line, message):
+        self.failed += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({'line': line, 'message': message})
+
+    def add(self, line, row):
+        try:
+            question, answer, category, difficulty = validate_question(row)
+        except ValueError as error:
+            self.error(line, str(error))
+            return
+
+        self._batch.append((line, {
+            'question': question,
+            'answer': answer,
+            'category': category,
+            'difficulty': difficulty
+        }))
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def _commit(self, rows):
+        ids = insert_rows(rows)
+        changes.record(db.session, added=[dict(row, id=id) for row, id in zip(rows, ids)])
+        db.session.commit()
+        self.inserted += len(rows)
+
+    def flush(self):
+        batch, self._batch = self._batch, []
+        if not batch:
+            return
+
+        try:
+            self._commit([row for line, row in batch])
+            return
+        except exc.SQLAlchemyError:
+            db.session.rollback()
+
+        # find the rows the database refused
+        for line, row in batch:
+            try:
+                self._commit([row])
+            except exc.SQLAlchemyError as error:
+                db.session.rollback()
+                self.error(line, 'database error: ' + str(error.orig if hasattr(error, 'orig') else error).strip())
+
+    def run(self, records):
+        '''import every (line, row, error) record, returns the report'''
+        for line, row, error in records:
+            if error is not None:
+                self.error(line, error)
+            else:
+                self.add(line, row)
+        self.flush()
+
+        return {
+            'inserted': self.inserted,
+            'failed': self.failed,
+            'errors': self.errors
+        }
+
+
+def question_filter(body):
+    '''
+    where clause of a bulk statement from the ids, category and
+    difficulty keys of body, raises ValueError when none is given
+    '''
+    table = Question.__table__
+    clauses = []
+
+    if 'ids' in body:
+        # a string or an object would be iterated: "24" is not [2, 4]
+        ids = body['ids']
+        if not isinstance(ids, list) or not all(isinstance(id, int) and not isinstance(id, bool) for id in ids):
+            raise ValueError('ids must be a list of integers')
+        if not ids:
+            raise ValueError('ids is empty')
+        clauses.append(table.c.id.in_(ids))
+
+    try:
+        if 'category' in body:
+            clauses.append(table.c.category == int(body['category']))
+        if 'difficulty' in body:
+            clauses.append(table.c.difficulty == int(body['difficulty']))
+    except (TypeError, ValueError):
+        raise ValueError('category and difficulty must be integers')
+
+    # never touch the whole table by accident
+    if not clauses:
+        raise ValueError('a filter is required')
+
+    return and_(*clauses)
+
+
+def update_values(values):
+    '''
+    new category and/or difficulty of a bulk update,
+    raises ValueError when invalid
+    '''
+    if not isinstance(values, dict) or not values or not set(values) <= {'category', 'difficulty'}:
+        raise ValueError('set must contain category and/or difficulty')
+
+    try:
+        values = {name: int(value) for name, value in values.items()}
+    except (TypeError, ValueError):
+        raise ValueError('category and difficulty must be integers')
+
+    if 'difficulty' in values and not 1 <= values['difficulty'] <= 5:
+        raise ValueError('difficulty must be between 1 and 5')
+
+    return values
+
+
+def bulk_delete(where):
+    '''delete every question matching where, returns the deleted count'''
+    table = Question.__table__
+
+    if db.engine.dialect.name == 'postgresql':
+        # the deleted rows come back from the statement itself
+        result = db.session.execute(table.delete().where(where).returning(*table.c))
+        removed = [dict(row) for row in result]
+        count = len(removed)
+    else:
+        removed = [dict(row) for row in db.session.execute(select([table]).where(where))]
+        count = db.session.execute(table.delete().where(where)).rowcount
+
+    if count:
+        changes.record(db.session, removed=removed)
+    db.session.commit()
+    return count
+
+
+def bulk_update(where, values):
+    '''set values on every question matching where, returns the updated count'''
+    table = Question.__table__
+
+    if db.engine.dialect.name == 'postgresql':
+        # UPDATE ... FROM a self join returns the old values with the new ones
+        old = table.alias('old')
+        statement = table.update().values(values) \
+                                  .where(where).where(table.c.id == old.c.id) \
+                                  .returning(*table.c, old.c.category.label('old_category'),
+                                             old.c.difficulty.label('old_difficulty'))
+        added, removed = [], []
+        for row in db.session.execute(statement):
+            new = {column.name: row[column.name] for column in table.c}
+            added.append(new)
+            removed.append(dict(new, category=row['old_category'], difficulty=row['old_difficulty']))
+        count = len(added)
+    else:
+        removed = [dict(row) for row in db.session.execute(select([table]).where(where))]
+        added = [dict(row, **values) for row in removed]
+        count = db.session.execute(table.update().values(values).where(where)).rowcount
+
+    if count:
+        changes.record(db.session, added=added, removed=removed)
+    db.session.commit()
+    return count
@@ -0,0 +1,188 @@
+# cache.py
+# response cache for the GET routes of the api blueprints.
+# keys contain the data version that every committed question
+# write bumps, so invalidation is exact and never waits for a ttl.
+import threading
+from collections import OrderedDict
+from functools import wraps
+from urllib.parse import urlencode
+
+from flask import current_app, request
+
+from . import changes
+from .changes import data_version
+
+
+def request_key():
+    '''
+    identifies the representation served for the current GET request:
+    data version, endpoint, view arguments and query arguments
+    '''
+    # url encoded: a & or = inside a value never reads as another argument
+    args = urlencode(sorted(request.args.items(multi=True)))
+    view_args = urlencode(sorted((request.view_args or {}).items()))
+    return f'{data_version()}:{request.endpoint}:{view_args}:{args}'
+
+
+class LRUBackend:
+    '''
+    in-process backend, least recently used entries are evicted
+    when the entry count or the total body size goes over its limits
+    '''
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        # a body bigger than the whole cache is never stored
+        if len(value) > self.max_bytes:
+            return
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous)
+            self._entries[key] = value
+            self._size += len(value)
+
+            while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+                key, value = self._entries.popitem(last=False)
+                self._size -= len(value)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'bytes': self._size,
+            'evictions': self.evictions
+        }
+
+
+class RedisBackend:
+    '''
+    shared backend, lets every gunicorn worker reuse the same entries.
+    size limits and eviction are left to redis (maxmemory-policy allkeys-lru),
+    entries of old versions expire after ttl seconds.
+    '''
+
+    def __init__(self, url, ttl, prefix='trivia:cache:'):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('RESPONSE_CACHE=redis needs the redis package (pip install redis)')
+
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, value, ex=self.ttl)
+
+    def clear(self):
+        # entries of old versions are shared with the other workers,
+        # they expire on their own
+        pass
+
+    def stats(self):
+        info = self.client.info('stats')
+        return {
+            'entries': None,
+            'bytes': None,
+            'evictions': info.get('evicted_keys', 0)
+        }
+
+
+class ResponseCache:
+    '''
+    caches the json body of successful responses by
+    data version, endpoint, view arguments and query arguments
+    '''
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def key(self):
+        return request_key()
+
+    def invalidate(self, added=(), removed=()):
+        '''changes feed callback, entries of older versions can never be read again'''
+        self.backend.clear()
+
+    def stats(self):
+        stats = self.backend.stats()
+        stats.update({'hits': self.hits, 'misses': self.misses})
+        return stats
+
+    def collect(self):
+        '''metrics registry collector'''
+        stats = self.stats()
+        for name in ('hits', 'misses', 'evictions'):
+            yield f'trivia_response_cache_{name}_total', 'counter', f'Response cache {name}.', [({}, stats[name])]
+        if stats['entries'] is not None:
+            yield 'trivia_response_cache_entries', 'gauge', 'Response cache entries.', [({}, stats['entries'])]
+            yield 'trivia_response_cache_bytes', 'gauge', 'Response cache size.', [({}, stats['bytes'])]
+
+
+def cached(view):
+    '''
+    serve a GET view from the response cache of the app,
+    only 200 responses are stored
+    '''
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        cache = current_app.extensions.get('response_cache')
+        if cache is None or request.method != 'GET':
+            return view(*args, **kwargs)
+
+        key = cache.key()
+        body = cache.backend.get(key)
+        if body is not None:
+            cache.hits += 1
+            return current_app.response_class(body, mimetype='application/json')
+
+        cache.misses += 1
+        response = current_app.make_response(view(*args, **kwargs))
+        if response.status_code == 200:
+            cache.backend.set(key, response.get_data())
+        return response
+
+    return wrapper
+
+
+def init_cache(app):
+    '''set up the response cache configured by RESPONSE_CACHE'''
+    kind = app.config['RESPONSE_CACHE']
+
+    if kind == 'off':
+        return None
+    elif kind == 'redis':
+        backend = RedisBackend(app.config['RESPONSE_CACHE_URL'], app.config['RESPONSE_CACHE_TTL'])
+    else:
+        backend = LRUBackend(app.config['RESPONSE_CACHE_MAX_ENTRIES'], app.config['RESPONSE_CACHE_MAX_BYTES'])
+
+    cache = ResponseCache(backend)
+    changes.subscribe('response_cache', cache.invalidate)
+    app.extensions['response_cache'] = cache
+    return cache
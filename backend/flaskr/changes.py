@@ -0,0 +1,122 @@
+# changes.py
+# feed of committed question changes, used to keep in-process indexes current,
+# and the data version counter shared by every process
+from flask import current_app, g, has_app_context
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, object_session
+
+from models import db, Question, DataVersion
+
+def subscribe(name, callback):
+    '''
+    register callback(added, removed) to run after every commit that
+    touched the questions table. both arguments are lists of formatted
+    questions (question.format()):
+        - removed: rows as they were before the transaction
+        - added: rows as they are after the transaction
+    an updated question shows up in both lists, subscribers apply
+    removed before added.
+    callbacks belong to the current app, they only see the commits of its
+    sessions. registering again under the same name replaces the previous
+    callback
+    '''
+    current_app.extensions.setdefault('changes', {})[name] = callback
+
+
+def _subscribers(session):
+    '''name -> callback of the app of session'''
+    # the app committing, else the app the flask-sqlalchemy session was opened for
+    app = current_app if has_app_context() else getattr(session, 'app', None)
+    if app is None:
+        return {}
+    return app.extensions.get('changes', {})
+
+
+def data_version():
+    '''
+    write counter of the questions table, read once per request.
+    it is bumped in the same transaction as the writes, so every
+    process sees a new version exactly when the writes are committed.
+    '''
+    if 'data_version' not in g:
+        g.data_version = db.session.query(DataVersion.version) \
+                                   .filter(DataVersion.name == 'questions') \
+                                   .scalar() or 0
+    return g.data_version
+
+
+def _bump_data_version(session, connection=None):
+    # once per transaction is enough, the writes are committed together
+    if session.info.get('data_version_bumped'):
+        return
+
+    statement = DataVersion.__table__.update() \
+                                     .where(DataVersion.name == 'questions') \
+                                     .values(version=DataVersion.version + 1)
+    (connection or session).execute(statement)
+    session.info['data_version_bumped'] = True
+
+
+def record(session, added=(), removed=(), connection=None):
+    '''
+    queue question changes on a session, they are published when the
+    session commits and dropped when it rolls back.
+    ORM writes are recorded automatically, set-based statements
+    that bypass the ORM must call this before committing.
+    '''
+    _bump_data_version(session, connection)
+
+    # id -> [state before the transaction, state after it]
+    pending = session.info.setdefault('question_changes', {})
+
+    for question in removed:
+        states = pending.setdefault(question['id'], [question, None])
+        states[1] = None
+
+    for question in added:
+        states = pending.setdefault(question['id'], [None, None])
+        states[1] = question
+
+
+def _previous_state(target):
+    '''formatted question with the values it had before the flush'''
+    previous = target.format()
+    for attr in inspect(target).attrs:
+        if attr.key in previous and attr.history.deleted:
+            previous[attr.key] = attr.history.deleted[0]
+    return previous
+
+
+@event.listens_for(Question, 'after_insert')
+def _after_insert(mapper, connection, target):
+    record(object_session(target), added=[target.format()], connection=connection)
+
+
+@event.listens_for(Question, 'after_update')
+def _after_update(mapper, connection, target):
+    record(object_session(target), removed=[_previous_state(target)], added=[target.format()],
+           connection=connection)
+
+
+@event.listens_for(Question, 'after_delete')
+def _after_delete(mapper, connection, target):
+    record(object_session(target), removed=[target.format()], connection=connection)
+
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    session.info.pop('data_version_bumped', None)
+    pending = session.info.pop('question_changes', None)
+    if not pending:
+        return
+
+    removed = [before for before, after in pending.values() if before is not None]
+    added = [after for before, after in pending.values() if after is not None]
+    for callback in list(_subscribers(session).values()):
+        callback(added, removed)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _after_rollback(session, previous_transaction):
+    session.info.pop('question_changes', None)
+    session.info.pop('data_version_bumped', None)
@@ -0,0 +1,44 @@
+# conditional.py
+# strong ETags and Cache-Control for the GET routes of the api blueprints.
+# the ETag comes from the data version, so a matching If-None-Match is
+# answered with a 304 without loading or serializing any row.
+import hashlib
+from functools import wraps
+
+from flask import current_app, request
+
+from .cache import request_key
+
+
+def current_etag():
+    '''strong ETag of the representation served for the current request'''
+    return hashlib.sha1(request_key().encode('utf-8')).hexdigest()
+
+
+def conditional(cache_control):
+    '''
+    answer If-None-Match with a 304 when the ETag still matches,
+    tag successful responses with their ETag and cache_control
+    '''
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET':
+                return view(*args, **kwargs)
+
+            etag = current_etag()
+            if request.if_none_match.contains(etag):
+                response = current_app.response_class(status=304)
+            else:
+                response = current_app.make_response(view(*args, **kwargs))
+                # errors are never tagged
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = cache_control
+            return response
+
+        return wrapper
+
+    return decorator
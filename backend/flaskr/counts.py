@@ -0,0 +1,174 @@
+# counts.py
+# total_questions of the list and search routes without scanning the table.
+# three modes:
+#   - exact: COUNT(*) of the selection, a scan of every matching row
+#   - estimated: row estimates of the PostgreSQL planner (pg_class.reltuples
+#     for the whole table), exact when the estimate is small
+#   - cached: counts per category kept in memory, built once and updated
+#     from the committed changes feed, rebuilt in the background after the
+#     writes of other processes
+# every count comes with a flag telling whether it is exact.
+import json
+import threading
+import time
+
+from sqlalchemy import func, text
+
+from models import db, Question
+from . import changes
+from .api.common import count_questions
+from .changes import data_version
+
+
+class QuestionCounter:
+    '''
+    (count, exact) of the questions, of a category or of a selection,
+    in the mode of COUNT_MODE
+    '''
+
+    def __init__(self, app, mode, exact_below, refresh_seconds):
+        self.app = app
+        self.mode = mode
+        self.exact_below = exact_below
+        self.refresh_seconds = refresh_seconds
+        self._lock = threading.RLock()
+        # category -> questions, None until built
+        self._counts = None
+        # data version the counts match, counting the writes of this process
+        self._version = None
+        self._refreshed_at = 0.0
+        self._refreshing = False
+
+    def install(self):
+        changes.subscribe('counter', self._apply_changes)
+
+    # cached counts
+
+    def _apply_changes(self, added, removed):
+        with self._lock:
+            if self._counts is None:
+                return
+            for question in removed:
+                self._counts[question['category']] = self._counts.get(question['category'], 0) - 1
+            for question in added:
+                self._counts[question['category']] = self._counts.get(question['category'], 0) + 1
+            # every committed transaction of this process bumped the version once
+            self._version += 1
+
+    def _load(self):
+        '''category -> questions, from the table'''
+        rows = db.session.query(Question.category, func.count(Question.id)).group_by(Question.category)
+        return dict(rows)
+
+    def _build(self):
+        self._version = data_version()
+        self._counts = self._load()
+        self._refreshed_at = time.monotonic()
+
+    def _refresh(self):
+        '''
+        count outside the lock and swap the counts in, unless a write of
+        this process came through the feed meanwhile: the next list
+        refreshes again
+        '''
+        with self._lock:
+            version = self._version
+        current = data_version()
+        counts = self._load()
+
+        with self._lock:
+            if self._version != version:
+                return
+            self._counts = counts
+            self._version = current
+
+    def _run_refresh(self):
+        with self.app.app_context():
+            try:
+                self._refresh()
+            except Exception:
+                # the counts stay as they were, the next list tries again
+                self.app.logger.exception('question counts refresh failed')
+            finally:
+                db.session.remove()
+                self._refreshing = False
+
+    def _cached(self, category_id):
+        with self._lock:
+            if self._counts is None:
+                self._build()
+            elif (data_version() != self._version and not self._refreshing
+                  and time.monotonic() - self._refreshed_at >= self.refresh_seconds):
+                # another process wrote, its changes never came through the feed
+                self._refreshing = True
+                self._refreshed_at = time.monotonic()
+                threading.Thread(target=self._run_refresh, name='counter-refresh', daemon=True).start()
+
+            # counts of another process's writes are stale until the refresh
+            exact = data_version() == self._version
+            if category_id is None:
+                return sum(self._counts.values()), exact
+            return self._counts.get(category_id, 0), exact
+
+    # planner estimates
+
+    def _postgres(self):
+        return db.engine.dialect.name == 'postgresql'
+
+    def _estimate(self, selection):
+        '''planner row estimate of selection, None when unknown'''
+        if selection is None:
+            # the table statistics, -1 (or 0) before the first ANALYZE
+            estimate = db.session.execute(text(
+                "SELECT reltuples FROM pg_class WHERE oid = 'questions'::regclass")).scalar()
+            return int(estimate) if estimate and estimate > 0 else None
+
+        connection = db.session.connection()
+        statement = selection.order_by(None).compile(dialect=connection.dialect)
+        plan = connection.execute(f'EXPLAIN (FORMAT JSON) {statement}', statement.params).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+
+    def _estimated(self, selection):
+        if self._postgres():
+            estimate = self._estimate(selection)
+            # small counts are cheap, and estimates are off the most there
+            if estimate is not None and estimate >= self.exact_below:
+                return estimate, False
+        return None
+
+    # public api
+
+    def total(self, selection, category_id=None):
+        '''
+        (count, exact) of a list route: selection is the question_selection
+        of every question, or of the questions of category_id
+        '''
+        if self.mode == 'cached':
+            return self._cached(category_id)
+
+        if self.mode == 'estimated':
+            estimate = self._estimated(None if category_id is None else selection)
+            if estimate is not None:
+                return estimate
+
+        return count_questions(selection), True
+
+    def matches(self, selection):
+        '''(count, exact) of any question_selection, such as a search'''
+        if self.mode in ('estimated', 'cached'):
+            estimate = self._estimated(selection)
+            if estimate is not None:
+                return estimate
+
+        return count_questions(selection), True
+
+
+def init_counter(app):
+    '''total counts in the mode of COUNT_MODE: 'exact', 'estimated' or 'cached' '''
+    counter = QuestionCounter(app, app.config['COUNT_MODE'], app.config['COUNT_EXACT_BELOW'],
+                              app.config['COUNT_REFRESH_SECONDS'])
+    counter.install()
+    app.extensions['counter'] = counter
+    return counter
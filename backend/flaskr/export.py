@@ -0,0 +1,72 @@
+# export.py
+# streaming question export. rows are read through a server-side cursor
+# (stream_results) in batches and written to the response as they come,
+# memory stays bounded by the batch size whatever the table size.
+import csv
+import io
+import json
+
+from sqlalchemy import select
+
+from models import Question, read_engine
+
+EXPORT_FIELDS = ('id', 'question', 'answer', 'difficulty', 'category')
+
+
+def export_selection(category=None, min_id=None, max_id=None):
+    '''
+    questions to export ordered by id, optionally limited to a category
+    and an inclusive id range so exports can run as parallel shards
+    '''
+    table = Question.__table__
+    selection = select([table.c[field] for field in EXPORT_FIELDS]).order_by(table.c.id)
+
+    if category is not None:
+        selection = selection.where(table.c.category == category)
+    if min_id is not None:
+        selection = selection.where(table.c.id >= min_id)
+    if max_id is not None:
+        selection = selection.where(table.c.id <= max_id)
+
+    return selection
+
+
+def stream_rows(selection, batch_size):
+    '''
+    yields batches of rows of selection read with a server-side cursor,
+    on a connection of its own (to the replica when there is one)
+    so it can outlive the request session
+    '''
+    connection = read_engine().connect().execution_options(stream_results=True)
+    try:
+        result = connection.execute(selection)
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        connection.close()
+
+
+def to_ndjson(batches):
+    '''one json object per question, same keys as question.format()'''
+    for rows in batches:
+        yield ''.join(json.dumps(dict(zip(EXPORT_FIELDS, row))) + '\n' for row in rows)
+
+
+def to_csv(batches):
+    '''a header line, then one record per question'''
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+
+    for rows in batches:
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+    # header of an empty export
+    if buffer.getvalue():
+        yield buffer.getvalue()
@@ -0,0 +1,199 @@
+# group_commit.py
+# write-behind inserts for POST /questions.
+# request handlers queue their row and wait, a writer thread of the
+# worker inserts every queued row in one transaction (one fsync) once
+# the batch is full or its oldest row waited max_wait_ms. a handler
+# returns once the transaction of its row is committed, with its id.
+# rows only share a commit when the worker serves requests concurrently
+# (gunicorn gthread, gevent): the row of a single threaded worker
+# (wsgi.multithread false, gunicorn sync) is committed without waiting.
+import os
+import queue
+import threading
+import time
+
+from flask import g, request
+from sqlalchemy import exc
+
+from models import db
+from . import changes
+from .bulk import insert_rows
+from .metrics import Histogram
+
+# rows per committed transaction
+BATCH_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class PendingInsert:
+    '''
+    a queued row, its id or its error once the writer is done with it.
+    a row is either claimed by the writer or cancelled by its request,
+    never both: a request that gave up never has its row committed.
+    a row that does not wait is committed as soon as it is taken
+    '''
+
+    def __init__(self, row, wait=True):
+        self.row = row
+        self.wait = wait
+        self.id = None
+        self.error = None
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+        self._claimed = False
+        self._cancelled = False
+
+    def claim(self):
+        '''the writer takes the row for a batch, False when it was cancelled'''
+        with self._lock:
+            if self._cancelled:
+                return False
+            self._claimed = True
+            return True
+
+    def cancel(self):
+        '''the request gives up on the row, False when the writer already has it'''
+        with self._lock:
+            if self._claimed:
+                return False
+            self._cancelled = True
+            return True
+
+
+class GroupCommitter:
+    '''
+    coalesces the inserts of concurrent requests into group commits of
+    at most max_batch rows, a row waits at most max_wait_ms for others
+    '''
+
+    def __init__(self, app, max_batch, max_wait_ms, timeout):
+        self.app = app
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.timeout = timeout
+        self.batches = Histogram('trivia_group_commit_batch_size', 'Rows per group commit.', buckets=BATCH_BUCKETS)
+        self.failed_batches = 0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._writer = None
+        self._pid = None
+
+    def _ensure_writer(self):
+        # started on first use: a thread of the gunicorn master does not survive the fork
+        with self._lock:
+            if self._writer is None or self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._writer = threading.Thread(target=self._run, name='group-commit', daemon=True)
+                self._pid = os.getpid()
+                self._writer.start()
+
+    def insert(self, row):
+        '''
+        insert a validated question row, returns it formatted with its id
+        once committed. raises the database error of the row
+        '''
+        self._ensure_writer()
+        # no other request of this worker can come with a row to share the commit
+        pending = PendingInsert(row, wait=request.environ.get('wsgi.multithread', False))
+        self._queue.put(pending)
+
+        if not pending.done.wait(self.timeout):
+            if pending.cancel():
+                # still queued, the writer will skip it
+                raise TimeoutError('group commit did not complete in time')
+            # being committed: its outcome is the answer, not a timeout
+            pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+
+        # the client wrote, its next reads go to the primary
+        g.wrote_primary = True
+        return dict(row, id=pending.id)
+
+    def _collect(self):
+        '''
+        the next batch: waits for a first row, then for the others.
+        rows cancelled by their request are left out
+        '''
+        batch = []
+        while not batch:
+            pending = self._queue.get()
+            if pending.claim():
+                batch.append(pending)
+
+        deadline = time.monotonic() + (self.max_wait if batch[0].wait else 0)
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            try:
+                pending = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if pending.claim():
+                batch.append(pending)
+        return batch
+
+    def _commit(self, batch):
+        rows = [pending.row for pending in batch]
+        ids = insert_rows(rows)
+        changes.record(db.session, added=[dict(row, id=id) for row, id in zip(rows, ids)])
+        db.session.commit()
+        for pending, id in zip(batch, ids):
+            pending.id = id
+
+    def _write(self, batch):
+        try:
+            self._commit(batch)
+        except exc.SQLAlchemyError:
+            db.session.rollback()
+            self.failed_batches += 1
+
+            # one bad row fails its own request only
+            for pending in batch:
+                try:
+                    self._commit([pending])
+                except exc.SQLAlchemyError as error:
+                    db.session.rollback()
+                    pending.error = error
+
+        self.batches.observe((), len(batch))
+        for pending in batch:
+            pending.done.set()
+
+    def _run(self):
+        with self.app.app_context():
+            while True:
+                batch = self._collect()
+                try:
+                    self._write(batch)
+                except Exception as error:
+                    # never leave a request waiting, never stop the writer
+                    self.app.logger.exception('group commit failed')
+                    db.session.rollback()
+                    for pending in batch:
+                        if not pending.done.is_set():
+                            pending.error = error
+                            pending.done.set()
+                finally:
+                    db.session.remove()
+
+    def collect(self):
+        '''metrics registry collector'''
+        yield 'trivia_group_commit_queue_depth', 'gauge', 'Rows waiting for a group commit.', \
+            [({}, self._queue.qsize())]
+        yield 'trivia_group_commit_failed_batches_total', 'counter', \
+            'Group commits retried row by row after an error.', [({}, self.failed_batches)]
+
+
+def init_group_commit(app):
+    '''write-behind inserts of POST /questions, when GROUP_COMMIT'''
+    if not app.config['GROUP_COMMIT']:
+        return None
+
+    committer = GroupCommitter(app, app.config['GROUP_COMMIT_MAX_BATCH'], app.config['GROUP_COMMIT_MAX_WAIT_MS'],
+                               app.config['DB_POOL_TIMEOUT'])
+    app.extensions['group_commit'] = committer
+
+    metrics = app.extensions.get('metrics')
+    if metrics is not None:
+        metrics.registry.add(committer.batches)
+        metrics.registry.collectors.append(committer.collect)
+    return committer
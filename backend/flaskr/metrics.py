@@ -0,0 +1,230 @@
+# metrics.py
+# per-request SQL instrumentation and prometheus metrics.
+# SQLAlchemy cursor events count the queries, DB time and rows of the
+# current request, the totals feed per endpoint histograms rendered in
+# prometheus text format, and a Server-Timing header on every response.
+import threading
+import time
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# request durations, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _labels(names, values):
+    return ','.join(f'{name}="{value}"' for name, value in zip(names, values))
+
+
+class Counter:
+    '''monotonic counter with labels'''
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield self.name, _labels(self.labels, labels), value
+
+
+class Histogram:
+    '''cumulative histogram with labels'''
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # labels -> [bucket counts..., sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self._lock:
+            values = self._values.get(labels)
+            if values is None:
+                values = self._values[labels] = [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    values[index] += 1
+            values[-2] += value
+            values[-1] += 1
+
+    def samples(self):
+        with self._lock:
+            values = sorted((labels, list(counts)) for labels, counts in self._values.items())
+        for labels, counts in values:
+            label_text = _labels(self.labels, labels)
+            prefix = label_text + ',' if label_text else ''
+            for bound, count in zip(self.buckets, counts):
+                yield f'{self.name}_bucket', f'{prefix}le="{bound}"', count
+            yield f'{self.name}_bucket', f'{prefix}le="+Inf"', counts[-1]
+            yield f'{self.name}_sum', label_text, counts[-2]
+            yield f'{self.name}_count', label_text, counts[-1]
+
+
+class Registry:
+    '''
+    metrics of the process. collectors are callables returning
+    (name, kind, help, [(labels dict, value)]) tuples, read at render time
+    '''
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        '''prometheus text exposition format'''
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{{{labels}}} {value}' if labels else f'{name} {value}')
+
+        for collector in self.collectors:
+            for name, kind, help, samples in collector():
+                lines.append(f'# HELP {name} {help}')
+                lines.append(f'# TYPE {name} {kind}')
+                for labels, value in samples:
+                    label_text = ','.join(f'{key}="{item}"' for key, item in sorted(labels.items()))
+                    lines.append(f'{name}{{{label_text}}} {value}' if label_text else f'{name} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+class RequestMetrics:
+    '''the metrics recorded for every request'''
+
+    def __init__(self):
+        self.registry = Registry()
+        labels = ('endpoint', 'method')
+        self.duration = self.registry.add(Histogram(
+            'trivia_request_duration_seconds', 'Request latency.', labels))
+        self.db_duration = self.registry.add(Histogram(
+            'trivia_request_db_seconds', 'Time spent in SQL statements per request.', labels))
+        self.queries = self.registry.add(Counter(
+            'trivia_db_queries_total', 'SQL statements executed.', labels))
+        self.rows = self.registry.add(Counter(
+            'trivia_db_rows_total', 'Rows reported by the driver for SQL statements.', labels))
+        self.responses = self.registry.add(Counter(
+            'trivia_responses_total', 'Responses by status code.', labels + ('status',)))
+
+    def start(self):
+        g.metrics = {'start': time.perf_counter(), 'queries': 0, 'db': 0.0, 'rows': 0, 'serialize': 0.0}
+
+    def finish(self, response):
+        stats = g.pop('metrics', None)
+        if stats is None:
+            return response
+
+        total = time.perf_counter() - stats['start']
+        labels = (request.endpoint or 'unmatched', request.method)
+        self.duration.observe(labels, total)
+        self.db_duration.observe(labels, stats['db'])
+        self.queries.inc(labels, stats['queries'])
+        self.rows.inc(labels, stats['rows'])
+        self.responses.inc(labels + (response.status_code,))
+
+        # DB time versus JSON serialization time, in milliseconds
+        response.headers['Server-Timing'] = ', '.join((
+            f"db;desc=\"{stats['queries']} queries\";dur={stats['db'] * 1000:.2f}",
+            f"serialize;dur={stats['serialize'] * 1000:.2f}",
+            f"total;dur={total * 1000:.2f}"))
+        return response
+
+
+def _current_stats():
+    if has_request_context():
+        return g.get('metrics')
+    return None
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    if _current_stats() is not None:
+        context._metrics_start = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    stats = _current_stats()
+    start = getattr(context, '_metrics_start', None)
+    if stats is None or start is None:
+        return
+
+    stats['db'] += time.perf_counter() - start
+    stats['queries'] += 1
+    # drivers that do not know the row count report -1
+    if cursor.rowcount > 0:
+        stats['rows'] += cursor.rowcount
+
+
+def timed_json_encoder(encoder):
+    '''json encoder class adding its encoding time to the request metrics'''
+
+    class TimedJSONEncoder(encoder):
+
+        def encode(self, o):
+            stats = _current_stats()
+            if stats is None:
+                return super().encode(o)
+
+            start = time.perf_counter()
+            try:
+                return super().encode(o)
+            finally:
+                stats['serialize'] += time.perf_counter() - start
+
+    return TimedJSONEncoder
+
+
+def timed_dumps(dumps):
+    '''serializer dumps function adding its encoding time to the request metrics'''
+
+    def timed(payload):
+        stats = _current_stats()
+        if stats is None:
+            return dumps(payload)
+
+        start = time.perf_counter()
+        try:
+            return dumps(payload)
+        finally:
+            stats['serialize'] += time.perf_counter() - start
+
+    return timed
+
+
+def init_metrics(app):
+    '''record the metrics of every request of app, when METRICS_ENABLED'''
+    if not app.config['METRICS_ENABLED']:
+        return None
+
+    metrics = RequestMetrics()
+    app.before_request(metrics.start)
+    app.after_request(metrics.finish)
+    app.json_encoder = timed_json_encoder(app.json_encoder)
+    serializer = app.extensions.get('json_serializer')
+    if serializer is not None:
+        serializer.dumps = timed_dumps(serializer.dumps)
+    app.extensions['metrics'] = metrics
+    return metrics
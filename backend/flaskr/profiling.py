@@ -0,0 +1,229 @@
+# profiling.py
+# on-demand profiles of single requests of the api, without a redeploy.
+# a request is profiled when it carries the X-Profile-Token header with
+# the PROFILE_SECRET, or when it is drawn at PROFILE_SAMPLE_RATE. the
+# profile covers the request until its teardown (streamed bodies too) and
+# is written to PROFILE_DIR, named after the endpoint and the request id:
+#   - collapsed: stacks of the request thread sampled every
+#     PROFILE_INTERVAL_MS, one "frame;frame;frame count" line per stack,
+#     the input of flamegraph.pl, speedscope or inferno
+#   - pstats: every call through cProfile (python -m pstats, snakeviz),
+#     exact but slows the request down
+# one request at a time is profiled per process, the oldest files are
+# removed past PROFILE_MAX_FILES.
+import cProfile
+import hmac
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+
+from flask import current_app, g, request
+
+# extension of the files of each format
+EXTENSIONS = {'collapsed': '.collapsed', 'pstats': '.prof'}
+
+# characters kept in the endpoint and request id of the file names
+UNSAFE = re.compile(r'[^A-Za-z0-9_.-]')
+
+
+def parse_endpoints(text):
+    '''"play_quiz, get_questions" -> {'api1.play_quiz', 'api1.get_questions'}'''
+    names = filter(None, (name.strip() for name in text.split(',')))
+    return {name if '.' in name else f'api1.{name}' for name in names}
+
+
+def frame_name(frame):
+    '''module:function of a frame, without the spaces and ; of the collapsed format'''
+    return '{}:{}'.format(frame.f_globals.get('__name__', '?'), frame.f_code.co_name).replace(';', ':')
+
+
+def collapse(frame):
+    '''the stack of frame from its root, as frame;frame;frame'''
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class StackSampler:
+    '''
+    counts the stacks of one thread, sampled from a thread of its own
+    every interval seconds. the profiled thread runs at full speed
+    '''
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[collapse(frame)] += 1
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, path):
+        with open(path, 'w', encoding='utf8') as output:
+            for stack, count in self.stacks.most_common():
+                output.write(f'{stack} {count}\n')
+
+
+class DeterministicProfile:
+    '''cProfile of the calls of the current thread'''
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def write(self, path):
+        self.profile.dump_stats(path)
+
+
+class Profiler:
+    '''
+    picks the requests to profile, runs their profile and keeps at most
+    max_files profiles in directory
+    '''
+
+    def __init__(self, directory, output, secret, sample_rate, endpoints, interval_ms, max_files):
+        self.directory = directory
+        self.output = output
+        self.secret = secret
+        self.sample_rate = sample_rate
+        # endpoints that may be profiled, every api endpoint when empty
+        self.endpoints = endpoints
+        self.interval = interval_ms / 1000
+        self.max_files = max_files
+        self.written = 0
+        self.skipped = 0
+        # a single profile at a time: cProfile allows one per process
+        self._busy = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def requested(self):
+        '''True when the request carries the secret, or is drawn by the sample rate'''
+        token = request.headers.get('X-Profile-Token')
+        if token and self.secret and hmac.compare_digest(token.encode(), self.secret.encode()):
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def _new_profile(self):
+        if self.output == 'pstats':
+            return DeterministicProfile()
+        return StackSampler(threading.get_ident(), self.interval)
+
+    def start(self):
+        '''before_request hook'''
+        if request.blueprint != 'api1':
+            return None
+        if self.endpoints and request.endpoint not in self.endpoints:
+            return None
+        if not self.requested():
+            return None
+
+        if not self._busy.acquire(blocking=False):
+            # another request of the process is being profiled
+            self.skipped += 1
+            return None
+
+        g.profile_id = request.headers.get('X-Request-Id') or uuid.uuid4().hex
+        g.profile = self._new_profile()
+        g.profile.start()
+        return None
+
+    def tag(self, response):
+        '''after_request hook, tells the client the id of its profile'''
+        if 'profile' in g:
+            response.headers['X-Profile-Id'] = g.profile_id
+        return response
+
+    def finish(self, error=None):
+        '''teardown_request hook, runs after streamed responses too'''
+        profile = g.pop('profile', None)
+        if profile is None:
+            return
+        try:
+            profile.stop()
+            endpoint = UNSAFE.sub('_', request.endpoint or 'unknown')
+            profile_id = UNSAFE.sub('_', g.pop('profile_id'))[:64]
+            name = '{}-{}-{}{}'.format(time.strftime('%Y%m%dT%H%M%SZ', time.gmtime()), endpoint, profile_id,
+                                       EXTENSIONS[self.output])
+            profile.write(os.path.join(self.directory, name))
+            self.written += 1
+            self._prune()
+        except OSError:
+            # a full disk never fails the request
+            current_app.logger.exception('request profile not written')
+        finally:
+            self._busy.release()
+
+    def _prune(self):
+        '''remove the oldest profiles of directory past max_files, of every worker'''
+        extension = EXTENSIONS[self.output]
+        profiles = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(extension):
+                try:
+                    profiles.append((entry.stat().st_mtime, entry.path))
+                except FileNotFoundError:
+                    # pruned by another worker
+                    continue
+        if len(profiles) <= self.max_files:
+            return
+
+        profiles.sort()
+        for mtime, path in profiles[:len(profiles) - self.max_files]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def collect(self):
+        '''metrics registry collector'''
+        yield 'trivia_profiles_written_total', 'counter', 'Request profiles written.', [({}, self.written)]
+        yield 'trivia_profiles_skipped_total', 'counter', \
+            'Requests not profiled because another profile was running.', [({}, self.skipped)]
+
+
+def init_profiling(app):
+    '''
+    request profiles when PROFILE_ENABLED, in the PROFILE_OUTPUT format
+    ('collapsed' or 'pstats')
+    '''
+    if not app.config['PROFILE_ENABLED']:
+        return None
+
+    output = 'pstats' if app.config['PROFILE_OUTPUT'] == 'pstats' else 'collapsed'
+    profiler = Profiler(app.config['PROFILE_DIR'], output, app.config['PROFILE_SECRET'],
+                        app.config['PROFILE_SAMPLE_RATE'], parse_endpoints(app.config['PROFILE_ENDPOINTS']),
+                        app.config['PROFILE_INTERVAL_MS'], app.config['PROFILE_MAX_FILES'])
+    app.before_request(profiler.start)
+    app.after_request(profiler.tag)
+    app.teardown_request(profiler.finish)
+    app.extensions['profiler'] = profiler
+
+    metrics = app.extensions.get('metrics')
+    if metrics is not None:
+        metrics.registry.collectors.append(profiler.collect)
+    return profiler
@@ -0,0 +1,333 @@
+# quiz_sessions.py
+# server-side quiz sessions. the questions of the category are played in
+# the order of a pseudo-random permutation of its id range, keyed by a
+# seed: a session is a few numbers (seed, offset in the permutation),
+# whatever the size of the category, and every next question is found by
+# a primary key lookup of the next positions.
+# sessions live in a backend: 'memory' (per process) or 'redis', shared
+# by every worker and by the async api.
+import hashlib
+import json
+import math
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import func
+
+from models import db, Question
+
+# positions read past the ones the density of the category asks for,
+# so a draw seldom needs a second query
+PROBE_SLACK = 4
+
+# rounds of the feistel network of the permutation
+ROUNDS = 4
+
+
+class TTLStore:
+    '''
+    in-process key/value store bounded by a time to live and a max size.
+    reading a key refreshes its ttl, the least recently used keys are
+    dropped first when the store is full.
+    '''
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        # key -> (deadline, value), least recently used first
+        self._items = OrderedDict()
+
+    def _purge(self, now):
+        # keys are ordered by last use and share the same ttl,
+        # so expired keys are always at the front
+        while self._items:
+            key, (deadline, value) = next(iter(self._items.items()))
+            if deadline > now:
+                break
+            del self._items[key]
+
+    def get(self, key):
+        with self._lock:
+            now = time.monotonic()
+            self._purge(now)
+            item = self._items.get(key)
+            if item is None:
+                return None
+            self._items[key] = (now + self.ttl, item[1])
+            self._items.move_to_end(key)
+            return item[1]
+
+    def set(self, key, value):
+        with self._lock:
+            now = time.monotonic()
+            self._purge(now)
+            self._items[key] = (now + self.ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def __len__(self):
+        return len(self._items)
+
+
+def _round(seed, round, value):
+    '''round function of the feistel network'''
+    digest = hashlib.blake2b(f'{seed}:{round}:{value}'.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big')
+
+
+def permute(position, size, seed):
+    '''
+    the position-th value of a pseudo-random permutation of range(size)
+    keyed by seed: a feistel network over the smallest even number of
+    bits holding size, cycle walked until the value is in range
+    '''
+    bits = max(2, (size - 1).bit_length())
+    bits += bits % 2
+    half = bits // 2
+    mask = (1 << half) - 1
+
+    value = position
+    while True:
+        left, right = value >> half, value & mask
+        for round in range(ROUNDS):
+            left, right = right, left ^ (_round(seed, round, right) & mask)
+        value = (left << half) | right
+        if value < size:
+            return value
+
+
+def new_session(category_id, low, high, total, excluded=()):
+    '''
+    state of a session over the ids low..high (None for an empty
+    category) of a category that holds total questions not excluded
+    '''
+    size = 0 if low is None else high - low + 1
+    return {
+        'category': category_id,
+        'seed': secrets.randbits(64),
+        'low': low or 0,
+        'size': size,
+        'total': total,
+        # played before the session started
+        'excluded': sorted(id for id in set(excluded) if size and low <= id <= high),
+        # next position of the permutation, questions drawn so far
+        'offset': 0,
+        'drawn': 0
+    }
+
+
+def candidates(session, need):
+    '''
+    (end, [(position, id)]) of the next positions of the permutation,
+    enough to find need questions at the density of the category.
+    the excluded ids are left out, end is the first position not read
+    '''
+    density = max(session['total'], 1) / max(session['size'], 1)
+    end = min(session['size'], session['offset'] + math.ceil(need / density) + PROBE_SLACK)
+    excluded = set(session['excluded'])
+    probes = []
+    for position in range(session['offset'], end):
+        id = session['low'] + permute(position, session['size'], session['seed'])
+        if id not in excluded:
+            probes.append((position, id))
+    return end, probes
+
+
+def pick(probes, end, found, need):
+    '''
+    (ids, next offset): the first need probed ids that were found, the
+    offset moves past the last one taken so the others are drawn later
+    '''
+    chosen = []
+    for position, id in probes:
+        if id in found:
+            chosen.append(id)
+            if len(chosen) == need:
+                return chosen, position + 1
+    return chosen, end
+
+
+def remaining(session):
+    '''questions left in a session, as counted when it started'''
+    if session['offset'] >= session['size']:
+        return 0
+    return max(0, session['total'] - session['drawn'])
+
+
+class MemorySessions:
+    '''sessions of this process, at most max_sessions'''
+
+    def __init__(self, ttl, max_sessions):
+        self.store = TTLStore(ttl, max_sessions)
+        self._lock = threading.Lock()
+
+    def set(self, token, session):
+        self.store.set(token, dict(session))
+
+    def get(self, token):
+        session = self.store.get(token)
+        return None if session is None else dict(session)
+
+    def advance(self, token, offset, end, drawn):
+        '''
+        move a session read at offset to end, False when another draw
+        of the session moved it first
+        '''
+        with self._lock:
+            session = self.store.get(token)
+            if session is None or session['offset'] != offset:
+                return False
+            session['offset'] = end
+            session['drawn'] += drawn
+            return True
+
+    def delete(self, token):
+        self.store.delete(token)
+
+
+# compare and set of the offset of a session, atomic across the workers
+ADVANCE_SCRIPT = '''
+local offset = redis.call('HGET', KEYS[1], 'offset')
+if not offset or tonumber(offset) ~= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'offset', ARGV[2])
+redis.call('HINCRBY', KEYS[1], 'drawn', ARGV[3])
+redis.call('PEXPIRE', KEYS[1], ARGV[4])
+return 1
+'''
+
+
+class RedisSessions:
+    '''
+    shared sessions, a session started on a worker continues on any
+    other. expired after ttl seconds without a draw, sized by redis
+    '''
+
+    def __init__(self, url, ttl, prefix='trivia:quiz:'):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('QUIZ_SESSIONS=redis needs the redis package (pip install redis)')
+
+        self.client = redis.Redis.from_url(url)
+        self.script = self.client.register_script(ADVANCE_SCRIPT)
+        self.ttl_ms = int(ttl * 1000)
+        self.prefix = prefix
+
+    def set(self, token, session):
+        fixed = {name: value for name, value in session.items() if name not in ('offset', 'drawn')}
+        pipeline = self.client.pipeline()
+        pipeline.hset(self.prefix + token, mapping={
+            'session': json.dumps(fixed), 'offset': session['offset'], 'drawn': session['drawn']})
+        pipeline.pexpire(self.prefix + token, self.ttl_ms)
+        pipeline.execute()
+
+    def get(self, token):
+        pipeline = self.client.pipeline()
+        pipeline.hgetall(self.prefix + token)
+        pipeline.pexpire(self.prefix + token, self.ttl_ms)
+        values, _ = pipeline.execute()
+        if not values:
+            return None
+        return dict(json.loads(values[b'session']), offset=int(values[b'offset']), drawn=int(values[b'drawn']))
+
+    def advance(self, token, offset, end, drawn):
+        return bool(int(self.script(keys=[self.prefix + token], args=[offset, end, drawn, self.ttl_ms])))
+
+    def delete(self, token):
+        self.client.delete(self.prefix + token)
+
+
+def session_backend(kind, url, ttl, max_sessions):
+    '''the QUIZ_SESSIONS backend, redis or memory'''
+    if kind == 'redis':
+        return RedisSessions(url, ttl)
+    return MemorySessions(ttl, max_sessions)
+
+
+class QuizSessions:
+    '''
+    quiz sessions stored under a random session token
+    '''
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    @staticmethod
+    def _selection(query, category_id):
+        if category_id != 0:
+            query = query.filter(Question.category == category_id)
+        return query
+
+    def start(self, category_id, previous_questions=()):
+        '''
+        start a session over the questions of a category (0 for all
+        categories) not in previous_questions, returns its token
+        '''
+        low, high = self._selection(db.session.query(func.min(Question.id), func.max(Question.id)), category_id).one()
+        counted = self._selection(db.session.query(func.count(Question.id)), category_id)
+        excluded = set(previous_questions)
+        if excluded:
+            counted = counted.filter(Question.id.notin_(excluded))
+
+        token = secrets.token_urlsafe(16)
+        self.backend.set(token, new_session(category_id, low, high, counted.scalar(), excluded))
+        return token
+
+    def draw(self, token):
+        '''
+        the next question of a session.
+        returns (question or None when the session is over, remaining questions),
+        raises KeyError for unknown or expired sessions
+        '''
+        questions, remaining = self.draw_many(token, 1)
+        return (questions[0] if questions else None), remaining
+
+    def draw_many(self, token, count):
+        '''
+        the next count questions of a session.
+        returns (questions, fewer than count when the session runs out, remaining questions),
+        raises KeyError for unknown or expired sessions
+        '''
+        session = self.backend.get(token)
+        if session is None:
+            raise KeyError(token)
+
+        questions = []
+        while session is not None and len(questions) < count and session['offset'] < session['size']:
+            need = count - len(questions)
+            end, probes = candidates(session, need)
+
+            # questions deleted or moved since the quiz started are not found
+            ids = [id for position, id in probes]
+            found = {}
+            if ids:
+                query = self._selection(Question.query, session['category']).filter(Question.id.in_(ids))
+                found = {question.id: question for question in query}
+
+            chosen, offset = pick(probes, end, found, need)
+            # concurrent draws of a session never get the same question
+            if self.backend.advance(token, session['offset'], offset, len(chosen)):
+                questions.extend(found[id] for id in chosen)
+            session = self.backend.get(token)
+
+        if not questions:
+            self.backend.delete(token)
+        return questions, remaining(session) if session is not None else 0
+
+
+def init_quiz_sessions(app):
+    '''server-side quiz sessions, in the QUIZ_SESSIONS backend'''
+    sessions = QuizSessions(session_backend(app.config['QUIZ_SESSIONS'], app.config['QUIZ_SESSION_URL'],
+                                            app.config['QUIZ_SESSION_TTL'], app.config['QUIZ_SESSION_MAX']))
+    app.extensions['quiz_sessions'] = sessions
+    return sessions
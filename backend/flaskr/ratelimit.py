@@ -0,0 +1,219 @@
+# ratelimit.py
+# admission control of the api blueprint.
+# every client has a token bucket refilled at a steady rate, a request
+# takes the tokens its route costs or gets a 429. on top of it, a process
+# wide limit on the requests in flight sheds load with a 503 before the
+# connection pool of the worker runs dry and requests queue on it.
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from flask import g, jsonify, request
+
+
+def parse_costs(text):
+    '''"search_questions=5,play_quiz=3" -> {'api1.search_questions': 5, 'api1.play_quiz': 3}'''
+    costs = {}
+    for item in filter(None, (part.strip() for part in text.split(','))):
+        name, cost = item.split('=')
+        name = name.strip()
+        costs[name if '.' in name else f'api1.{name}'] = float(cost)
+    return costs
+
+
+class MemoryBuckets:
+    '''
+    in-process token buckets, one per client. the least recently seen
+    clients are dropped past max_clients, they come back with a full bucket
+    '''
+
+    def __init__(self, max_clients):
+        self.max_clients = max_clients
+        self._lock = threading.Lock()
+        # client -> (tokens, time of the last refill)
+        self._buckets = OrderedDict()
+
+    def take(self, client, cost, rate, burst):
+        '''
+        takes cost tokens from the bucket of client, returns 0 when it
+        had them, else the seconds before it will
+        '''
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(client, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+
+            wait = 0.0
+            if tokens >= cost:
+                tokens -= cost
+            else:
+                wait = (cost - tokens) / rate
+
+            self._buckets[client] = (tokens, now)
+            if len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+
+        return wait
+
+
+# refill and take in one round trip, atomic across the workers.
+# the bucket expires once it would be full again
+TAKE_SCRIPT = '''
+local rate, burst, cost, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens, updated = tonumber(bucket[1]) or burst, tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= cost then
+    tokens = tokens - cost
+else
+    wait = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil((burst - tokens) / rate * 1000) + 1000)
+return tostring(wait)
+'''
+
+
+class RedisBuckets:
+    '''shared token buckets, every gunicorn worker draws from the same ones'''
+
+    def __init__(self, url, prefix='trivia:ratelimit:'):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('RATE_LIMIT=redis needs the redis package (pip install redis)')
+
+        self.client = redis.Redis.from_url(url)
+        self.script = self.client.register_script(TAKE_SCRIPT)
+        self.prefix = prefix
+
+    def take(self, client, cost, rate, burst):
+        # the clock of the worker: keep the servers in sync (ntp)
+        return float(self.script(keys=[self.prefix + client], args=[rate, burst, cost, time.time()]))
+
+
+class ConcurrencyLimit:
+    '''requests in flight in this process, never waits for a slot'''
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self.in_flight >= self.limit:
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+
+class RateLimiter:
+    '''
+    admission of the requests of the api blueprint: per-client token
+    buckets (429) and a limit on the requests in flight (503)
+    '''
+
+    def __init__(self, buckets, rate, burst, costs, concurrency, api_keys=()):
+        self.buckets = buckets
+        # keys of the clients with a bucket of their own
+        self.api_keys = frozenset(api_keys)
+        self.rate = rate
+        self.burst = burst
+        self.costs = costs
+        self.concurrency = concurrency
+        self.rejected = {429: 0, 503: 0}
+
+    def client(self):
+        '''
+        the api key of the request when it is a known one, else its address:
+        a client making up a new key per request never gets a new bucket
+        '''
+        api_key = request.headers.get('X-API-Key')
+        if api_key and api_key in self.api_keys:
+            return f'key:{api_key}'
+        return f'ip:{request.remote_addr}'
+
+    def cost(self):
+        return self.costs.get(request.endpoint, 1)
+
+    def _reject(self, status, message, retry_after):
+        self.rejected[status] += 1
+        response = jsonify({
+            'success': False,
+            'error': status,
+            'message': message
+        })
+        response.status_code = status
+        response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+        return response
+
+    def admit(self):
+        '''before_request hook, a response when the request is rejected'''
+        if request.blueprint != 'api1':
+            return None
+
+        # probes and metrics (cost 0) are always answered,
+        # a cost over the burst could never be paid
+        cost = min(self.cost(), self.burst)
+        if cost == 0:
+            return None
+
+        if self.buckets is not None:
+            wait = self.buckets.take(self.client(), cost, self.rate, self.burst)
+            if wait:
+                return self._reject(429, 'too many requests', wait)
+
+        if self.concurrency is not None:
+            if not self.concurrency.acquire():
+                return self._reject(503, 'server busy', 1)
+            g.admitted = True
+
+        return None
+
+    def release(self, error=None):
+        '''teardown_request hook, runs after streamed responses too'''
+        if g.pop('admitted', False):
+            self.concurrency.release()
+
+    def collect(self):
+        '''metrics registry collector'''
+        yield 'trivia_rate_limited_total', 'counter', 'Requests rejected by admission control.', \
+            [({'status': status}, count) for status, count in sorted(self.rejected.items())]
+        if self.concurrency is not None:
+            yield 'trivia_requests_in_flight', 'gauge', 'Requests of the api in flight.', \
+                [({}, self.concurrency.in_flight)]
+
+
+def init_rate_limit(app):
+    '''
+    set up the admission control of RATE_LIMIT ('memory', 'redis' or 'off'
+    for the token buckets) and MAX_CONCURRENT_REQUESTS (0 for no limit)
+    '''
+    kind = app.config['RATE_LIMIT']
+    if kind == 'off':
+        buckets = None
+    elif kind == 'redis':
+        buckets = RedisBuckets(app.config['RATE_LIMIT_URL'])
+    else:
+        buckets = MemoryBuckets(app.config['RATE_LIMIT_MAX_CLIENTS'])
+
+    limit = app.config['MAX_CONCURRENT_REQUESTS']
+    concurrency = ConcurrencyLimit(limit) if limit > 0 else None
+
+    if buckets is None and concurrency is None:
+        return None
+
+    api_keys = filter(None, (key.strip() for key in app.config['RATE_LIMIT_API_KEYS'].split(',')))
+    limiter = RateLimiter(buckets, app.config['RATE_LIMIT_RATE'], app.config['RATE_LIMIT_BURST'],
+                          parse_costs(app.config['RATE_LIMIT_COSTS']), concurrency, api_keys)
+    app.before_request(limiter.admit)
+    app.teardown_request(limiter.release)
+    app.extensions['rate_limiter'] = limiter
+    return limiter
@@ -0,0 +1,330 @@
+# sampler.py
+# uniform random questions for the quiz without ORDER BY random().
+# the question ids of every category are kept in compact in-memory arrays,
+# a draw picks random positions and rejects played questions, so its cost
+# does not depend on the table size. tables too large for memory are
+# sampled by probing random ids of the primary key range instead.
+# the writes of other processes are caught up with in a background
+# thread, requests keep drawing from the current arrays meanwhile.
+import random
+import threading
+import time
+from array import array
+
+from sqlalchemy import func
+
+from models import db, Question
+from . import changes
+from .api.common import random_order
+from .changes import data_version
+
+# random ids probed per missing question, and probing rounds before
+# the remaining questions are drawn with ORDER BY random()
+PROBES_PER_QUESTION = 4
+PROBE_ROUNDS = 8
+
+
+class QuestionSampler:
+    '''
+    uniform sampling without replacement of the questions of a category
+    (0 for every category), excluding the previous questions.
+    built on first use, kept current through the committed changes feed,
+    and refreshed in the background when another process wrote (at most
+    every refresh_seconds).
+    '''
+
+    def __init__(self, app, max_ids, refresh_seconds, rng=None):
+        self.app = app
+        self.max_ids = max_ids
+        self.refresh_seconds = refresh_seconds
+        self.rng = rng or random.SystemRandom()
+        self._lock = threading.RLock()
+        # category -> array of question ids, deleted ids stay until compaction
+        self._ids = {}
+        # category -> ids removed from its array
+        self._deleted = {}
+        # None until built, 'memory' or 'probe'
+        self.mode = None
+        # highest id of the arrays, the ids above it are new
+        self._max_id = 0
+        # data version the arrays match, counting the writes of this process
+        self._version = None
+        self._refreshed_at = 0.0
+        self._refreshing = False
+
+    def install(self):
+        changes.subscribe('sampler', self._apply_changes)
+
+    # in-memory arrays
+
+    def _add(self, id, category):
+        deleted = self._deleted.get(category)
+        if deleted and id in deleted:
+            # still in the array
+            deleted.discard(id)
+            return
+        self._ids.setdefault(category, array('q')).append(id)
+        self._max_id = max(self._max_id, id)
+
+    def _remove(self, id, category):
+        ids = self._ids.get(category)
+        if ids is None:
+            return
+        deleted = self._deleted.setdefault(category, set())
+        deleted.add(id)
+
+        # compact once a quarter of the array is deleted
+        if len(deleted) * 4 > len(ids):
+            self._ids[category] = array('q', (id for id in ids if id not in deleted))
+            deleted.clear()
+
+    def _apply_changes(self, added, removed):
+        with self._lock:
+            if self._version is not None:
+                # every committed transaction of this process bumped the version once
+                self._version += 1
+            if self.mode != 'memory':
+                return
+            for question in removed:
+                self._remove(question['id'], question['category'])
+            for question in added:
+                self._add(question['id'], question['category'])
+
+    def _load(self, total):
+        '''(mode, arrays of the ids by category, highest id) of a table of total questions'''
+        if total > self.max_ids:
+            return 'probe', {}, 0
+
+        ids = {}
+        for id, category in db.session.query(Question.id, Question.category).yield_per(10000):
+            ids.setdefault(category, array('q')).append(id)
+        return 'memory', ids, max((max(category_ids) for category_ids in ids.values()), default=0)
+
+    def _swap(self, version, mode, ids, max_id):
+        self.mode, self._ids, self._deleted, self._max_id = mode, ids, {}, max_id
+        self._version = version
+
+    def _build(self):
+        '''load the arrays, or switch to probing when the table is too large'''
+        version = data_version()
+        self._swap(version, *self._load(db.session.query(func.count(Question.id)).scalar()))
+        self._refreshed_at = time.monotonic()
+
+    def _refresh(self):
+        '''
+        catch up with the writes of other processes. the queries run
+        outside the lock: the questions above the highest known id are
+        appended, and only the categories whose count still differs
+        (deletes, moves, ids committed out of order) are reloaded. the
+        result is dropped when a write of this process came through the
+        feed meanwhile, the next request refreshes again
+        '''
+        with self._lock:
+            version, mode, max_id = self._version, self.mode, self._max_id
+        current = data_version()
+        counts = dict(db.session.query(Question.category, func.count(Question.id)).group_by(Question.category))
+
+        total = sum(counts.values())
+        if mode != 'memory' or total > self.max_ids:
+            # in or into probe mode, or back to memory
+            loaded = self._load(total)
+            with self._lock:
+                if self._version == version:
+                    self._swap(current, *loaded)
+            return
+
+        added = db.session.query(Question.id, Question.category).filter(Question.id > max_id) \
+                                                                .order_by(Question.id).all()
+        with self._lock:
+            if self._version != version:
+                return
+            for id, category in added:
+                self._add(id, category)
+            stale = [category for category in set(counts).union(self._ids)
+                     if counts.get(category, 0) != self.size(category)]
+
+        reloaded = {}
+        for category in stale:
+            rows = db.session.query(Question.id).filter(Question.category == category).order_by(Question.id)
+            reloaded[category] = array('q', (id for (id,) in rows))
+
+        with self._lock:
+            if self._version != version:
+                return
+            for category, ids in reloaded.items():
+                self._deleted.pop(category, None)
+                if ids:
+                    self._ids[category] = ids
+                    self._max_id = max(self._max_id, max(ids))
+                else:
+                    self._ids.pop(category, None)
+            self._version = current
+
+    def _run_refresh(self):
+        with self.app.app_context():
+            try:
+                self._refresh()
+            except Exception:
+                # the arrays stay as they were, the next request tries again
+                self.app.logger.exception('quiz sampler refresh failed')
+            finally:
+                db.session.remove()
+                self._refreshing = False
+
+    def _ensure_current(self):
+        if self.mode is None:
+            self._build()
+        elif (data_version() != self._version and not self._refreshing
+              and time.monotonic() - self._refreshed_at >= self.refresh_seconds):
+            # another process wrote, its changes never came through the feed.
+            # requests go on drawing from the current arrays meanwhile
+            self._refreshing = True
+            self._refreshed_at = time.monotonic()
+            threading.Thread(target=self._run_refresh, name='sampler-refresh', daemon=True).start()
+
+    def size(self, category_id):
+        '''questions in the arrays of a category, 0 for every category'''
+        if category_id == 0:
+            return sum(len(ids) - len(self._deleted.get(category, ())) for category, ids in self._ids.items())
+        return len(self._ids.get(category_id, ())) - len(self._deleted.get(category_id, ()))
+
+    def _random_id(self, category_id):
+        '''uniform position of the arrays of a category, deleted ids included'''
+        if category_id != 0:
+            ids = self._ids[category_id]
+            return ids[self.rng.randrange(len(ids))], category_id
+
+        # every category: a position of the arrays put end to end
+        position = self.rng.randrange(sum(len(ids) for ids in self._ids.values()))
+        for category, ids in self._ids.items():
+            if position < len(ids):
+                return ids[position], category
+            position -= len(ids)
+
+    def sample_ids(self, category_id, excluded, count):
+        '''
+        up to count distinct ids drawn uniformly from the arrays of a
+        category, without the excluded ids. random positions are drawn and
+        rejected when deleted, excluded or already drawn; when most of the
+        category is excluded, the remaining ids are drawn from a scan.
+        '''
+        chosen = []
+        if self.size(category_id) == 0:
+            return chosen
+
+        seen = set()
+        attempts = 8 * count + 32
+        while len(chosen) < count and attempts:
+            attempts -= 1
+            id, category = self._random_id(category_id)
+            if id in seen or id in excluded or id in self._deleted.get(category, ()):
+                continue
+            seen.add(id)
+            chosen.append(id)
+
+        if len(chosen) < count:
+            # every draw of the loop was uniform over the ids left at that
+            # time, drawing the rest from the ids left keeps it uniform
+            categories = self._ids if category_id == 0 else {category_id: self._ids[category_id]}
+            left = [id for category, ids in categories.items() for id in ids
+                    if id not in seen and id not in excluded and id not in self._deleted.get(category, ())]
+            chosen += self.rng.sample(left, min(count - len(chosen), len(left)))
+
+        return chosen
+
+    # database access
+
+    @staticmethod
+    def _selection(category_id):
+        selection = Question.query
+        if category_id != 0:
+            selection = selection.filter(Question.category == category_id)
+        return selection
+
+    def has_questions(self, category_id):
+        '''whether a category (0 for every category) has questions'''
+        with self._lock:
+            self._ensure_current()
+            if self.mode == 'memory':
+                return self.size(category_id) > 0
+
+        return db.session.query(self._selection(category_id).exists()).scalar()
+
+    def _fetch(self, category_id, ids):
+        '''questions of ids still in the category, in the order of ids'''
+        if not ids:
+            return []
+        questions = {question.id: question for question in Question.query.filter(Question.id.in_(ids))}
+        return [questions[id] for id in ids
+                if id in questions and category_id in (0, questions[id].category)]
+
+    def _sample_memory(self, category_id, excluded, count):
+        questions = []
+        excluded = set(excluded)
+        while len(questions) < count:
+            with self._lock:
+                ids = self.sample_ids(category_id, excluded, count - len(questions))
+            if not ids:
+                break
+
+            # ids deleted or moved by another process since the last build
+            # are skipped, never drawn again by this request
+            questions += self._fetch(category_id, ids)
+            excluded.update(ids)
+
+        return questions
+
+    def _sample_probe(self, category_id, excluded, count):
+        '''
+        random ids of the primary key range, kept when they exist in the
+        category and are not excluded: every question has the same chance
+        whatever the gaps of the range
+        '''
+        low, high = db.session.query(func.min(Question.id), func.max(Question.id)).one()
+        if low is None:
+            return []
+
+        questions = []
+        excluded = set(excluded)
+        probed = set()
+        for _ in range(PROBE_ROUNDS):
+            need = count - len(questions)
+            if need == 0:
+                return questions
+
+            ids = []
+            for _ in range(PROBES_PER_QUESTION * need):
+                id = self.rng.randint(low, high)
+                if id not in excluded and id not in probed:
+                    probed.add(id)
+                    ids.append(id)
+            questions += self._fetch(category_id, ids)[:need]
+
+        # a sparse category: draw the rest in the database
+        need = count - len(questions)
+        if need:
+            played = excluded.union(question.id for question in questions)
+            questions += self._selection(category_id).filter(Question.id.notin_(played)) \
+                                                     .order_by(random_order()).limit(need).all()
+        return questions
+
+    def sample(self, category_id, excluded=(), count=1):
+        '''
+        up to count distinct random questions of a category (0 for every
+        category) that are not in excluded, fewer when the category runs out
+        '''
+        with self._lock:
+            self._ensure_current()
+            mode = self.mode
+
+        if mode == 'memory':
+            return self._sample_memory(category_id, excluded, count)
+        return self._sample_probe(category_id, excluded, count)
+
+
+def init_sampler(app):
+    '''random question sampler of the quiz'''
+    sampler = QuestionSampler(app, app.config['QUIZ_SAMPLER_MAX_IDS'], app.config['QUIZ_SAMPLER_REFRESH_SECONDS'])
+    sampler.install()
+    app.extensions['sampler'] = sampler
+    return sampler
@@ -0,0 +1,406 @@
+# search.py
+# search over questions. a question matches when its text contains the
+# search term, case insensitive, like the ILIKE '%term%' the api always
+# ran: "itle" finds "title". the questions whose words start with the
+# words of the term come first.
+# PostgreSQL runs the ILIKE on a pg_trgm GIN index and ranks with the
+# generated tsvector column, other databases (sqlite, tests) use an
+# in-process trigram index that returns the same matches, rebuilt in the
+# background after the writes of other processes.
+# either engine sits behind a cache of the ordered ids matching the
+# popular terms, kept current through the committed changes feed.
+import re
+import threading
+import time
+from array import array
+from collections import Counter, OrderedDict
+
+from flask import current_app
+from sqlalchemy import func, literal_column, select
+from sqlalchemy.engine.url import make_url
+
+from models import db, Question
+from . import changes
+from .changes import data_version
+from .api.common import question_selection, format_rows
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+# escape character of the LIKE patterns
+LIKE_ESCAPE = '/'
+
+
+def tokenize(text):
+    '''lowercased word tokens of a text'''
+    return [token.lower() for token in TOKEN_RE.findall(text or '')]
+
+
+def like_pattern(term):
+    '''LIKE pattern of the texts containing term, its % and _ taken literally'''
+    for character in (LIKE_ESCAPE, '%', '_'):
+        term = term.replace(character, LIKE_ESCAPE + character)
+    return f'%{term}%'
+
+
+def trigrams(text):
+    '''set of the 3 character substrings of text'''
+    return {text[position:position + 3] for position in range(len(text) - 2)}
+
+
+def _fetch_in_order(ids):
+    '''formatted questions by primary key, keeping the order of ids'''
+    if not ids:
+        return []
+    rows = db.session.execute(question_selection(Question.id.in_(ids)))
+    questions = {question['id']: question for question in format_rows(rows)}
+    return [questions[id] for id in ids if id in questions]
+
+
+class PostgresSearch:
+    '''
+    ILIKE search on the trigram index. matches are ranked with ts_rank of
+    the words of the term as prefixes, then by id.
+    '''
+    vector = literal_column('questions.search_vector')
+
+    def install(self):
+        # the trigram index comes from migrations/v0006_question_trigram_index.py,
+        # the tsvector column from migrations/v0004_question_search_vector.py
+        pass
+
+    def current(self, version):
+        '''the database is always current'''
+        return True
+
+    def _where(self, term):
+        return Question.question.ilike(like_pattern(term), escape=LIKE_ESCAPE)
+
+    def _ranked(self, selection, term):
+        tokens = tokenize(term)
+        selection = selection.order_by(None)
+        if tokens:
+            query = func.to_tsquery('simple', ' & '.join(f'{token}:*' for token in tokens))
+            selection = selection.order_by(func.ts_rank(self.vector, query).desc())
+        return selection.order_by(Question.id)
+
+    def match(self, term, limit=None):
+        '''ids of the questions containing term, best score first, at most limit'''
+        if not term:
+            return []
+
+        statement = self._ranked(select([Question.id]).where(self._where(term)), term).limit(limit)
+        return [id for (id,) in db.session.execute(statement)]
+
+    def count(self, term):
+        '''(total matches, whether it is exact), from the counter of the app'''
+        if not term:
+            return 0, True
+        return current_app.extensions['counter'].matches(question_selection(self._where(term)))
+
+    def search(self, term, offset, limit):
+        '''
+        returns (formatted questions of the page, total matches, whether
+        the total is exact), the total comes from the counter of the app
+        '''
+        if not term:
+            return [], 0, True
+
+        selection = question_selection(self._where(term))
+
+        total, exact = current_app.extensions['counter'].matches(selection)
+        rows = db.session.execute(self._ranked(selection, term).offset(offset).limit(limit))
+
+        return format_rows(rows), total, exact
+
+
+class InvertedIndexSearch:
+    '''
+    in-process trigram index with the same matching rules as PostgresSearch.
+    built on first use, kept current through the committed changes feed,
+    and rebuilt in the background when another process wrote (at most
+    every refresh_seconds). searches use the current index meanwhile.
+    '''
+
+    def __init__(self, app, refresh_seconds):
+        self.app = app
+        self.refresh_seconds = refresh_seconds
+        self._lock = threading.RLock()
+        self._built = False
+        # data version the index matches, counting the writes of this process
+        self._version = None
+        self._refreshed_at = 0.0
+        self._refreshing = False
+        # trigram -> question ids whose lowercased text contains it
+        self._trigrams = {}
+        # question id -> lowercased text, to check the candidates
+        self._texts = {}
+        # question id -> {token: occurrences}, to rank the matches
+        self._documents = {}
+
+    def install(self):
+        changes.subscribe('search', self._apply_changes)
+
+    def _add(self, id, text):
+        self._remove(id)
+        text = (text or '').lower()
+        self._texts[id] = text
+        self._documents[id] = Counter(tokenize(text))
+        for trigram in trigrams(text):
+            self._trigrams.setdefault(trigram, set()).add(id)
+
+    def _remove(self, id):
+        text = self._texts.pop(id, None)
+        if text is None:
+            return
+        del self._documents[id]
+        for trigram in trigrams(text):
+            ids = self._trigrams[trigram]
+            ids.discard(id)
+            if not ids:
+                del self._trigrams[trigram]
+
+    def _load(self):
+        rows = db.session.query(Question.id, Question.question).yield_per(1000)
+        for id, text in rows:
+            self._add(id, text)
+
+    def _build(self):
+        self._version = data_version()
+        self._load()
+        self._built = True
+        self._refreshed_at = time.monotonic()
+
+    def _apply_changes(self, added, removed):
+        with self._lock:
+            if not self._built:
+                return
+            for question in removed:
+                self._remove(question['id'])
+            for question in added:
+                self._add(question['id'], question['question'])
+            # every committed transaction of this process bumped the version once
+            self._version += 1
+
+    def _refresh(self):
+        '''
+        load a new index outside the lock and swap it in, unless a write of
+        this process came through the feed meanwhile: the next search
+        refreshes again
+        '''
+        with self._lock:
+            version = self._version
+        current = data_version()
+        index = InvertedIndexSearch(self.app, self.refresh_seconds)
+        index._load()
+
+        with self._lock:
+            if self._version != version:
+                return
+            self._trigrams, self._texts, self._documents = index._trigrams, index._texts, index._documents
+            self._version = current
+
+    def _run_refresh(self):
+        with self.app.app_context():
+            try:
+                self._refresh()
+            except Exception:
+                # the index stays as it was, the next search tries again
+                self.app.logger.exception('search index refresh failed')
+            finally:
+                db.session.remove()
+                self._refreshing = False
+
+    def _ensure_current(self):
+        if not self._built:
+            self._build()
+        elif (data_version() != self._version and not self._refreshing
+              and time.monotonic() - self._refreshed_at >= self.refresh_seconds):
+            # another process wrote, its changes never came through the feed
+            self._refreshing = True
+            self._refreshed_at = time.monotonic()
+            threading.Thread(target=self._run_refresh, name='search-refresh', daemon=True).start()
+
+    def current(self, version):
+        '''whether the index has every write up to the data version'''
+        with self._lock:
+            return self._built and self._version == version
+
+    def _candidates(self, needle):
+        '''ids of the questions holding every trigram of needle, every id below 3 characters'''
+        grams = trigrams(needle)
+        if not grams:
+            return list(self._texts)
+        postings = sorted((self._trigrams.get(trigram, ()) for trigram in grams), key=len)
+        return set(postings[0]).intersection(*postings[1:])
+
+    def _score(self, id, tokens):
+        '''occurrences of the words of the question starting with a token of the term'''
+        return sum(count for word, count in self._documents[id].items()
+                   for token in tokens if word.startswith(token))
+
+    def match(self, term, limit=None):
+        '''ids of the questions containing term, best score first, at most limit'''
+        needle = (term or '').lower()
+        if not needle:
+            return []
+
+        tokens = tokenize(needle)
+        with self._lock:
+            self._ensure_current()
+
+            scores = {id: self._score(id, tokens) for id in self._candidates(needle)
+                      if needle in self._texts[id]}
+
+        return sorted(scores, key=lambda id: (-scores[id], id))[:limit]
+
+    def count(self, term):
+        '''(total matches, True): every match is known'''
+        return len(self.match(term)), True
+
+    def search(self, term, offset, limit):
+        '''
+        returns (formatted questions of the page, total matches, True):
+        every match is known, the total is always exact
+        '''
+        ids = self.match(term)
+        return _fetch_in_order(ids[offset:offset + limit]), len(ids), True
+
+
+def search_key(term):
+    '''
+    cache key of a search term: matching is case insensitive, so the
+    lowercased term. spaces and punctuation are part of the match
+    '''
+    return (term or '').lower()
+
+
+def could_match(term, text):
+    '''whether a question text contains the (lowercased) term'''
+    return term in (text or '').lower()
+
+
+class CachedSearch:
+    '''
+    search engine wrapper caching the ordered ids matching a lowercased
+    term, at most max_ids per term. a page is a slice of the ids and a
+    primary key fetch. an entry is dropped when a committed question of
+    this process could match its term, or had matched it. the feed only
+    carries the writes of this process: a write of another worker is only
+    seen as a new data version, and drops every entry.
+    '''
+
+    # changes larger than this clear the cache instead of checking every entry
+    MAX_CHECKED_CHANGES = 1000
+
+    def __init__(self, engine, max_entries, max_ids):
+        self.engine = engine
+        self.max_entries = max_entries
+        self.max_ids = max_ids
+        self._lock = threading.Lock()
+        # term -> (term, ids, truncated, total, exact)
+        self._entries = OrderedDict()
+        # data version the entries match, counting the writes of this process
+        self._version = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def install(self):
+        self.engine.install()
+        changes.subscribe('search_cache', self._apply_changes)
+
+    def _apply_changes(self, added, removed):
+        with self._lock:
+            if self._version is not None:
+                # every committed transaction of this process bumped the version once
+                self._version += 1
+
+            if len(added) + len(removed) > self.MAX_CHECKED_CHANGES:
+                self.invalidations += len(self._entries)
+                self._entries.clear()
+                return
+
+            texts = [question['question'] for question in list(added) + list(removed)]
+            for term, entry in list(self._entries.items()):
+                if any(could_match(entry[0], text) for text in texts):
+                    del self._entries[term]
+                    self.invalidations += 1
+
+    def _lookup(self, term):
+        '''(cached entry of term or None, version of the cache at the lookup)'''
+        with self._lock:
+            version = data_version()
+            if version != self._version:
+                # another process wrote, its changes never came through the feed
+                self._entries.clear()
+                self._version = version
+
+            entry = self._entries.get(term)
+            if entry is not None:
+                self._entries.move_to_end(term)
+                self.hits += 1
+            return entry, self._version
+
+    def _store(self, term, entry, version):
+        '''
+        cache the entry computed after the lookup at version, unless a
+        commit came through the feed meanwhile or the engine is behind
+        the writes of another process: the ids could miss them
+        '''
+        if not self.engine.current(version):
+            return
+        with self._lock:
+            if version != self._version:
+                return
+            self._entries[term] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def search(self, term, offset, limit):
+        '''same as the search of the engine, from the cached ids when possible'''
+        term = search_key(term)
+        if not term:
+            return [], 0, True
+
+        entry, version = self._lookup(term)
+        if entry is None:
+            self.misses += 1
+            ids = self.engine.match(term, self.max_ids + 1)
+            truncated = len(ids) > self.max_ids
+            ids = array('q', ids[:self.max_ids])
+            total, exact = self.engine.count(term) if truncated else (len(ids), True)
+            entry = (term, ids, truncated, total, exact)
+            self._store(term, entry, version)
+
+        ids, truncated, total, exact = entry[1:]
+        if truncated and offset + limit > len(ids):
+            # a page past the cached ids
+            questions, total, exact = self.engine.search(term, offset, limit)
+            return questions, total, exact
+
+        return _fetch_in_order(list(ids[offset:offset + limit])), total, exact
+
+    def collect(self):
+        '''metrics registry collector'''
+        for name in ('hits', 'misses', 'invalidations'):
+            yield f'trivia_search_cache_{name}_total', 'counter', f'Search cache {name}.', \
+                [({}, getattr(self, name))]
+        yield 'trivia_search_cache_entries', 'gauge', 'Search cache entries.', [({}, len(self._entries))]
+
+
+def init_search(app):
+    '''pick the search engine for the configured database'''
+    backend = make_url(app.config['SQLALCHEMY_DATABASE_URI']).get_backend_name()
+
+    if backend == 'postgresql':
+        engine = PostgresSearch()
+    else:
+        engine = InvertedIndexSearch(app, app.config['SEARCH_REFRESH_SECONDS'])
+
+    # ids of the popular terms, 0 entries turns the cache off
+    if app.config['SEARCH_CACHE_MAX_ENTRIES'] > 0:
+        engine = CachedSearch(engine, app.config['SEARCH_CACHE_MAX_ENTRIES'], app.config['SEARCH_CACHE_MAX_IDS'])
+
+    engine.install()
+    app.extensions['search'] = engine
+    return engine
@@ -0,0 +1,88 @@
+# serializer.py
+# fast JSON responses for the read routes. orjson encodes the payload
+# straight to bytes, the output is byte for byte what jsonify would
+# return, and jsonify is used whenever that cannot be guaranteed.
+import json
+
+from flask import current_app, jsonify
+
+
+class OrjsonSerializer:
+    '''
+    jsonify compatible encoding with orjson: sorted keys, compact separators,
+    ASCII only output and a final newline
+    '''
+
+    def __init__(self, orjson):
+        self.orjson = orjson
+        self.options = orjson.OPT_SORT_KEYS
+
+    def _prepare(self, payload):
+        # orjson sorts integer keys as strings ("10" before "2"), json sorts
+        # them as numbers: maps with integer keys (categories) are encoded
+        # like jsonify and embedded as they are
+        if not isinstance(payload, dict):
+            return payload
+        return {key: self.orjson.Fragment(json.dumps(value, sort_keys=True, separators=(',', ':')))
+                if isinstance(value, dict) and not all(type(item) is str for item in value) else value
+                for key, value in payload.items()}
+
+    def dumps(self, payload):
+        '''the encoded payload, None when jsonify must be used instead'''
+        try:
+            body = self.orjson.dumps(self._prepare(payload), option=self.options)
+        except TypeError:
+            # nested non string keys, types orjson does not know
+            return None
+
+        # jsonify escapes non ASCII characters, and DEL (0x7f) as \u007f
+        if not body.isascii() or b'\x7f' in body:
+            return None
+
+        return body + b'\n'
+
+
+def json_response(payload, status=200):
+    '''response of payload, same bytes as jsonify(payload)'''
+    serializer = current_app.extensions.get('json_serializer')
+    config = current_app.config
+
+    body = None
+    # jsonify pretty prints in debug mode
+    if serializer is not None and not (config['JSONIFY_PRETTYPRINT_REGULAR'] or current_app.debug):
+        body = serializer.dumps(payload)
+
+    if body is None:
+        response = jsonify(payload)
+    else:
+        response = current_app.response_class(body, mimetype=config['JSONIFY_MIMETYPE'])
+
+    response.status_code = status
+    return response
+
+
+def init_serializer(app):
+    '''
+    pick the serializer of JSON_SERIALIZER: 'orjson', 'stdlib' (jsonify)
+    or 'auto' (orjson when it is installed)
+    '''
+    kind = app.config['JSON_SERIALIZER']
+    if kind == 'stdlib' or not (app.config['JSON_SORT_KEYS'] and app.config['JSON_AS_ASCII']):
+        return None
+
+    try:
+        import orjson
+    except ImportError:
+        if kind == 'orjson':
+            raise RuntimeError('JSON_SERIALIZER=orjson needs the orjson package (pip install orjson)')
+        return None
+
+    # Fragment came with orjson 3.9
+    if not hasattr(orjson, 'Fragment'):
+        if kind == 'orjson':
+            raise RuntimeError('JSON_SERIALIZER=orjson needs orjson 3.9 or later')
+        return None
+
+    serializer = OrjsonSerializer(orjson)
+    app.extensions['json_serializer'] = serializer
+    return serializer
@@ -0,0 +1,109 @@
+# startup.py
+# boot time and readiness of the worker processes.
+# the startup of create_app is timed phase by phase against a budget,
+# engines are made safe to share across a fork (gunicorn --preload), and
+# the readiness probe opens the first pool connections of a worker.
+import os
+import time
+from contextlib import contextmanager
+
+from flask_sqlalchemy import get_state
+from sqlalchemy import event, exc
+
+
+class StartupTimer:
+    '''durations of the startup phases of an app, in milliseconds'''
+
+    def __init__(self, budget_ms):
+        self.budget_ms = budget_ms
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.total_ms = None
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = round((time.perf_counter() - start) * 1000, 2)
+
+    def finish(self, app):
+        '''total startup time, a warning is logged when it is over budget'''
+        self.total_ms = round((time.perf_counter() - self.started) * 1000, 2)
+        if self.total_ms > self.budget_ms:
+            app.logger.warning('startup took %.0fms, over the %dms budget: %s',
+                               self.total_ms, self.budget_ms, self.phases)
+        return self.total_ms
+
+    def report(self):
+        return {
+            'total_ms': self.total_ms,
+            'budget_ms': self.budget_ms,
+            'within_budget': self.total_ms is not None and self.total_ms <= self.budget_ms,
+            'phases': self.phases
+        }
+
+
+def engines(app):
+    '''(bind name, engine) of every database of app, None for the primary'''
+    state = get_state(app)
+    binds = [None] + list(app.config.get('SQLALCHEMY_BINDS') or {})
+    return [(bind, state.db.get_engine(app, bind=bind)) for bind in binds]
+
+
+def install_fork_guard(engine):
+    '''
+    a connection opened by another process (the gunicorn master before
+    the fork) is never used: it is dropped and a new one is opened
+    '''
+
+    @event.listens_for(engine, 'connect')
+    def _connect(dbapi_connection, connection_record):
+        connection_record.info['pid'] = os.getpid()
+
+    @event.listens_for(engine, 'checkout')
+    def _checkout(dbapi_connection, connection_record, connection_proxy):
+        if connection_record.info['pid'] != os.getpid():
+            # never close it, the socket belongs to the other process
+            connection_record.connection = connection_proxy.connection = None
+            raise exc.DisconnectionError('connection opened by another process')
+
+
+def dispose_engines(app):
+    '''
+    close the pooled connections of app. the gunicorn master calls it
+    before forking, so workers start without connections of their own
+    '''
+    for bind, engine in engines(app):
+        engine.dispose()
+
+
+def warm_pools(app):
+    '''
+    open the first connections of every pool, up to DB_POOL_WARM per pool.
+    returns {bind name: pool status}, raises SQLAlchemyError when a
+    database cannot be reached
+    '''
+    report = {}
+    for bind, engine in engines(app):
+        pool = engine.pool
+        # pools without a size (sqlite) keep no connection
+        sized = hasattr(pool, 'size')
+        wanted = min(app.config['DB_POOL_WARM'], pool.size()) if sized else 1
+
+        if not sized or pool.checkedin() + pool.checkedout() < wanted:
+            connections = [engine.connect() for _ in range(wanted)]
+            try:
+                for connection in connections:
+                    connection.execute('SELECT 1')
+            finally:
+                for connection in connections:
+                    connection.close()
+
+        report[bind or 'primary'] = {
+            'checked_in': pool.checkedin() if sized else 0,
+            'checked_out': pool.checkedout() if sized else 0,
+            'size': pool.size() if sized else None
+        }
+    return report
@@ -0,0 +1,270 @@
+# suggest.py
+# prefix completions for the search box, served from memory.
+# the words of the questions are kept in a sorted array with the number
+# of questions using them, and the question titles in a sorted array of
+# their normalized text: the completions of a prefix are a contiguous
+# range of each array, found by binary search.
+# built on first use and kept current through the committed changes feed,
+# rebuilt in the background at most every refresh_seconds once another
+# process wrote, suggestions use the current index meanwhile.
+import sys
+import threading
+import time
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from heapq import nsmallest
+
+from models import db, Question
+from . import changes
+from .changes import data_version
+from .search import tokenize
+
+# prefixes whose word completions are kept, short prefixes match
+# large ranges of the vocabulary
+TOP_CACHE_SIZE = 4096
+
+# upper bound of any prefix starting with a given prefix
+MAX_CHAR = '\U0010ffff'
+
+
+def normalize(text):
+    '''lowercased words of text separated by single spaces'''
+    return ' '.join(tokenize(text))
+
+
+class Suggester:
+    '''
+    word and question completions of a prefix. at most max_terms words
+    and max_titles questions are indexed, the memory they use is tracked
+    '''
+
+    def __init__(self, app, max_terms, max_titles, refresh_seconds=5):
+        self.app = app
+        self.max_terms = max_terms
+        self.max_titles = max_titles
+        self.refresh_seconds = refresh_seconds
+        self._lock = threading.RLock()
+        self._built = False
+        # data version the index matches, counting the writes of this process
+        self._version = None
+        self._refreshed_at = 0.0
+        self._refreshing = False
+        # sorted words, and word -> questions using it
+        self._terms = []
+        self._frequency = {}
+        # sorted (normalized title, question id), and id -> question text
+        self._titles = []
+        self._texts = {}
+        # prefix -> (limit, best word completions)
+        self._top = OrderedDict()
+        # bytes of the indexed strings
+        self.bytes = 0
+        # words and titles left out by the bounds
+        self.dropped = 0
+
+    def install(self):
+        changes.subscribe('suggest', self._apply_changes)
+
+    # index maintenance
+
+    def _add_term(self, term):
+        count = self._frequency.get(term)
+        if count is not None:
+            self._frequency[term] = count + 1
+        elif len(self._terms) < self.max_terms:
+            self._frequency[term] = 1
+            insort(self._terms, term)
+            self.bytes += sys.getsizeof(term)
+        else:
+            self.dropped += 1
+
+    def _remove_term(self, term):
+        count = self._frequency.get(term)
+        if count is None:
+            return
+        if count > 1:
+            self._frequency[term] = count - 1
+        else:
+            del self._frequency[term]
+            del self._terms[bisect_left(self._terms, term)]
+            self.bytes -= sys.getsizeof(term)
+
+    def _add(self, id, text):
+        for term in set(tokenize(text)):
+            self._add_term(term)
+
+        if len(self._texts) < self.max_titles:
+            entry = (normalize(text), id)
+            insort(self._titles, entry)
+            self._texts[id] = text
+            self.bytes += sys.getsizeof(entry[0]) + sys.getsizeof(text)
+        else:
+            self.dropped += 1
+
+    def _remove(self, id, text):
+        for term in set(tokenize(text)):
+            self._remove_term(term)
+
+        text = self._texts.pop(id, None)
+        if text is not None:
+            entry = (normalize(text), id)
+            del self._titles[bisect_left(self._titles, entry)]
+            self.bytes -= sys.getsizeof(entry[0]) + sys.getsizeof(text)
+
+    def _load(self):
+        frequency = {}
+        self._texts = {}
+        total = 0
+        rows = db.session.query(Question.id, Question.question).order_by(Question.id).yield_per(10000)
+        for id, text in rows:
+            total += 1
+            for term in set(tokenize(text)):
+                frequency[term] = frequency.get(term, 0) + 1
+            if len(self._texts) < self.max_titles:
+                self._texts[id] = text
+
+        # past max_terms, the rarest words are left out
+        kept = sorted(frequency, key=lambda term: (-frequency[term], term))[:self.max_terms]
+        self.dropped = len(frequency) - len(kept) + total - len(self._texts)
+        self._frequency = {term: frequency[term] for term in kept}
+        self._terms = sorted(kept)
+        self._titles = sorted((normalize(text), id) for id, text in self._texts.items())
+        self.bytes = sum(sys.getsizeof(term) for term in self._terms) + \
+            sum(sys.getsizeof(title) + sys.getsizeof(self._texts[id]) for title, id in self._titles)
+
+    def _build(self):
+        self._version = data_version()
+        self._load()
+        self._built = True
+        self._refreshed_at = time.monotonic()
+
+    def _apply_changes(self, added, removed):
+        with self._lock:
+            if not self._built:
+                return
+            for question in removed:
+                self._remove(question['id'], question['question'])
+            for question in added:
+                self._add(question['id'], question['question'])
+            self._top.clear()
+            # every committed transaction of this process bumped the version once
+            self._version += 1
+
+    def _refresh(self):
+        '''
+        load a new index outside the lock and swap it in, unless a write of
+        this process came through the feed meanwhile: the next suggestion
+        refreshes again
+        '''
+        with self._lock:
+            version = self._version
+        current = data_version()
+        index = Suggester(self.app, self.max_terms, self.max_titles, self.refresh_seconds)
+        index._load()
+
+        with self._lock:
+            if self._version != version:
+                return
+            self._terms, self._frequency = index._terms, index._frequency
+            self._titles, self._texts = index._titles, index._texts
+            self.bytes, self.dropped = index.bytes, index.dropped
+            self._top.clear()
+            self._version = current
+
+    def _run_refresh(self):
+        with self.app.app_context():
+            try:
+                self._refresh()
+            except Exception:
+                # the index stays as it was, the next suggestion tries again
+                self.app.logger.exception('suggest index refresh failed')
+            finally:
+                db.session.remove()
+                self._refreshing = False
+
+    def _ensure_current(self):
+        if not self._built:
+            self._build()
+        elif (data_version() != self._version and not self._refreshing
+              and time.monotonic() - self._refreshed_at >= self.refresh_seconds):
+            # another process wrote, its changes never came through the feed
+            self._refreshing = True
+            self._refreshed_at = time.monotonic()
+            threading.Thread(target=self._run_refresh, name='suggest-refresh', daemon=True).start()
+
+    def ensure_built(self):
+        with self._lock:
+            if not self._built:
+                self._build()
+
+    # lookups
+
+    def _words(self, prefix, limit):
+        '''most used words starting with prefix'''
+        cached = self._top.get(prefix)
+        if cached is not None and cached[0] >= limit:
+            self._top.move_to_end(prefix)
+            return cached[1][:limit]
+
+        start = bisect_left(self._terms, prefix)
+        end = bisect_left(self._terms, prefix + MAX_CHAR, start)
+        frequency = self._frequency
+        words = nsmallest(limit, self._terms[start:end], key=lambda term: (-frequency[term], term))
+
+        self._top[prefix] = (limit, words)
+        if len(self._top) > TOP_CACHE_SIZE:
+            self._top.popitem(last=False)
+        return words
+
+    def _questions(self, prefix, limit):
+        '''questions whose normalized text starts with prefix'''
+        start = bisect_left(self._titles, (prefix,))
+        end = bisect_left(self._titles, (prefix + MAX_CHAR,), start)
+        return [{'id': id, 'question': self._texts[id]} for title, id in self._titles[start:min(end, start + limit)]]
+
+    def suggest(self, prefix, limit):
+        '''
+        (words completing the last word of prefix, questions starting
+        with prefix), at most limit of each
+        '''
+        normalized = normalize(prefix)
+        if not normalized:
+            return [], []
+
+        with self._lock:
+            self._ensure_current()
+
+            words = self._words(normalized.rsplit(' ', 1)[-1], limit)
+            questions = self._questions(normalized, limit)
+        return words, questions
+
+    def stats(self):
+        return {
+            'built': self._built,
+            'terms': len(self._terms),
+            'questions': len(self._titles),
+            'bytes': self.bytes,
+            'dropped': self.dropped
+        }
+
+    def collect(self):
+        '''metrics registry collector'''
+        stats = self.stats()
+        yield 'trivia_suggest_terms', 'gauge', 'Words of the suggest index.', [({}, stats['terms'])]
+        yield 'trivia_suggest_questions', 'gauge', 'Questions of the suggest index.', [({}, stats['questions'])]
+        yield 'trivia_suggest_bytes', 'gauge', 'Size of the strings of the suggest index.', [({}, stats['bytes'])]
+        yield 'trivia_suggest_dropped', 'gauge', 'Words and questions left out by the bounds.', \
+            [({}, stats['dropped'])]
+
+
+def init_suggest(app):
+    '''prefix completions of GET /questions/suggest'''
+    suggester = Suggester(app, app.config['SUGGEST_MAX_TERMS'], app.config['SUGGEST_MAX_QUESTIONS'],
+                          app.config['SUGGEST_REFRESH_SECONDS'])
+    suggester.install()
+    app.extensions['suggest'] = suggester
+
+    metrics = app.extensions.get('metrics')
+    if metrics is not None:
+        metrics.registry.collectors.append(suggester.collect)
+    return suggester
@@ -0,0 +1,24 @@
+# gunicorn.conf.py
+# the app is created once in the master and shared by the forked workers
+# (copy-on-write), workers start serving without importing anything.
+# each worker serves GUNICORN_THREADS requests at a time (gthread): the
+# group commits of POST /questions need concurrent requests in a worker,
+# and the threads of a worker share its DB_POOL_SIZE + DB_MAX_OVERFLOW
+# connections.
+#
+#   BOOT_MODE=production gunicorn -c gunicorn.conf.py wsgi:app
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('GUNICORN_WORKERS', 4))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+preload_app = True
+
+
+def pre_fork(server, worker):
+    # no pooled connection of the master may reach a worker. workers never
+    # dispose themselves: closing a connection copied by the fork would end
+    # the session of the master, the fork guard (flaskr/startup.py) drops it
+    from flaskr.startup import dispose_engines
+    dispose_engines(server.app.wsgi())
@@ -0,0 +1,77 @@
+# migrations
+# versioned schema migrations. every module vNNNN_name.py of this package
+# is a migration with an upgrade(connection) function. pending migrations
+# are applied in version order, each in its own transaction, and recorded
+# in the schema_migrations table. migrations only go forward.
+#
+#   python -m migrations            apply the pending migrations
+#   python -m migrations --status   list applied and pending migrations
+import importlib
+import pkgutil
+
+from sqlalchemy import Column, DateTime, MetaData, String, Table, func, select, text
+
+metadata = MetaData()
+
+schema_migrations = Table(
+    'schema_migrations', metadata,
+    Column('version', String, primary_key=True),
+    Column('name', String, nullable=False),
+    Column('applied_at', DateTime, nullable=False, server_default=func.now()))
+
+# advisory lock held while migrating, workers starting together
+# run the migrations one after the other
+LOCK_KEY = 4242001
+
+
+def available():
+    '''(version, name, module) of every migration, in version order'''
+    migrations = []
+    for info in pkgutil.iter_modules(__path__):
+        if not info.name.startswith('v') or '_' not in info.name:
+            continue
+        version, name = info.name[1:].split('_', 1)
+        migrations.append((version, name, importlib.import_module(f'{__name__}.{info.name}')))
+
+    return sorted(migrations, key=lambda migration: migration[0])
+
+
+def _lock(connection):
+    # released when the transaction ends
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text('SELECT pg_advisory_xact_lock(:key)'), key=LOCK_KEY)
+
+
+def applied(connection):
+    '''versions already applied on the database of connection'''
+    if not connection.dialect.has_table(connection, 'schema_migrations'):
+        return set()
+    return {version for (version,) in connection.execute(select([schema_migrations.c.version]))}
+
+
+def upgrade(engine):
+    '''apply the pending migrations on engine, returns their versions'''
+    with engine.begin() as connection:
+        _lock(connection)
+        schema_migrations.create(connection, checkfirst=True)
+
+    done = []
+    for version, name, module in available():
+        with engine.begin() as connection:
+            _lock(connection)
+            # another process may have applied it while we waited
+            if version in applied(connection):
+                continue
+
+            module.upgrade(connection)
+            connection.execute(schema_migrations.insert().values(version=version, name=name))
+            done.append(version)
+
+    return done
+
+
+def status(engine):
+    '''(version, name, applied) of every migration'''
+    with engine.connect() as connection:
+        versions = applied(connection)
+    return [(version, name, version in versions) for version, name, module in available()]
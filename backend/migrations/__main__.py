@@ -0,0 +1,21 @@
+# run the migrations of the configured database
+import argparse
+
+from sqlalchemy import create_engine
+
+from models import database_path
+from . import upgrade, status
+
+parser = argparse.ArgumentParser(description='apply the schema migrations')
+parser.add_argument('--database-url', default=database_path)
+parser.add_argument('--status', action='store_true', help='list the migrations, apply nothing')
+args = parser.parse_args()
+
+engine = create_engine(args.database_url)
+
+if args.status:
+    for version, name, done in status(engine):
+        print(f"{version} {name} {'applied' if done else 'pending'}")
+else:
+    versions = upgrade(engine)
+    print('applied ' + ', '.join(versions) if versions else 'nothing to apply')
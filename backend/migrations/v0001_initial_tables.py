@@ -0,0 +1,25 @@
+# v0001_initial_tables.py
+# tables of trivia.psql and the data version counter, for empty databases.
+# databases restored from the dump already have the first two.
+from sqlalchemy import Column, Integer, MetaData, String, Table, Text
+
+metadata = MetaData()
+
+Table('categories', metadata,
+      Column('id', Integer, primary_key=True),
+      Column('type', Text))
+
+Table('questions', metadata,
+      Column('id', Integer, primary_key=True),
+      Column('question', Text),
+      Column('answer', Text),
+      Column('difficulty', Integer),
+      Column('category', Integer))
+
+Table('data_versions', metadata,
+      Column('name', String, primary_key=True),
+      Column('version', Integer, nullable=False))
+
+
+def upgrade(connection):
+    metadata.create_all(connection, checkfirst=True)
@@ -0,0 +1,61 @@
+# v0002_question_category_integer.py
+# questions.category becomes an integer referencing categories.id.
+# databases created by db.create_all() before the migrations have it
+# as a varchar column, databases restored from the dump as an integer.
+from sqlalchemy import text
+
+# questions as the models declare it, for the sqlite table rebuild
+SQLITE_QUESTIONS = '''
+CREATE TABLE questions_new (
+    id INTEGER NOT NULL PRIMARY KEY,
+    question TEXT,
+    answer TEXT,
+    difficulty INTEGER,
+    category INTEGER REFERENCES categories (id)
+)
+'''
+
+
+def _upgrade_postgresql(connection):
+    data_type = connection.execute(text(
+        "SELECT data_type FROM information_schema.columns "
+        "WHERE table_schema = current_schema() AND table_name = 'questions' AND column_name = 'category'")).scalar()
+    if data_type != 'integer':
+        # rewrites the whole table under an ACCESS EXCLUSIVE lock: reads
+        # and writes of questions wait until the migration commits
+        connection.execute(text('ALTER TABLE questions ALTER COLUMN category TYPE integer USING category::integer'))
+
+    exists = connection.execute(text(
+        "SELECT 1 FROM pg_constraint "
+        "WHERE conrelid = 'questions'::regclass AND conname = 'questions_category_fkey'")).scalar()
+    if not exists:
+        # the migration runs in one transaction: the VALIDATE scan (which
+        # fails on orphan questions) still happens before the commit, under
+        # the SHARE ROW EXCLUSIVE lock of ADD CONSTRAINT that blocks writes,
+        # and under the ACCESS EXCLUSIVE lock of the rewrite above when it ran
+        connection.execute(text(
+            'ALTER TABLE questions ADD CONSTRAINT questions_category_fkey '
+            'FOREIGN KEY (category) REFERENCES categories (id) NOT VALID'))
+        connection.execute(text('ALTER TABLE questions VALIDATE CONSTRAINT questions_category_fkey'))
+
+
+def _upgrade_sqlite(connection):
+    # sqlite cannot alter a column type or add a constraint: rebuild the table
+    columns = {row['name']: row['type'] for row in connection.execute(text('PRAGMA table_info(questions)'))}
+    foreign_keys = list(connection.execute(text('PRAGMA foreign_key_list(questions)')))
+    if columns.get('category', '').upper() == 'INTEGER' and foreign_keys:
+        return
+
+    connection.execute(text(SQLITE_QUESTIONS))
+    connection.execute(text(
+        'INSERT INTO questions_new (id, question, answer, difficulty, category) '
+        'SELECT id, question, answer, difficulty, CAST(category AS INTEGER) FROM questions'))
+    connection.execute(text('DROP TABLE questions'))
+    connection.execute(text('ALTER TABLE questions_new RENAME TO questions'))
+
+
+def upgrade(connection):
+    if connection.dialect.name == 'postgresql':
+        _upgrade_postgresql(connection)
+    elif connection.dialect.name == 'sqlite':
+        _upgrade_sqlite(connection)
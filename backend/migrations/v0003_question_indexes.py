@@ -0,0 +1,14 @@
+# v0003_question_indexes.py
+# indexes of the category and difficulty filters. (category, id) also
+# returns the questions of a category in id order, so category pages
+# and their keyset cursor need no sort.
+from sqlalchemy import text
+
+
+def upgrade(connection):
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_questions_category_id ON questions (category, id)'))
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_questions_difficulty ON questions (difficulty)'))
+
+    # fresh statistics, the planner picks the new indexes right away
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text('ANALYZE questions'))
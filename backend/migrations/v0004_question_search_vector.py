@@ -0,0 +1,15 @@
+# v0004_question_search_vector.py
+# generated tsvector column and GIN index of the PostgreSQL full-text
+# search (flaskr/search.py). other databases use the in-process index.
+from sqlalchemy import text
+
+
+def upgrade(connection):
+    if connection.dialect.name != 'postgresql':
+        return
+
+    connection.execute(text(
+        "ALTER TABLE questions ADD COLUMN IF NOT EXISTS search_vector tsvector "
+        "GENERATED ALWAYS AS (to_tsvector('simple', coalesce(question, ''))) STORED"))
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_questions_search_vector ON questions USING gin (search_vector)'))
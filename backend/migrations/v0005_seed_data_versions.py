@@ -0,0 +1,10 @@
+# v0005_seed_data_versions.py
+# the write counter row the api reads its data version from. created once
+# here instead of checked by every worker at startup.
+from sqlalchemy import text
+
+
+def upgrade(connection):
+    exists = connection.execute(text("SELECT 1 FROM data_versions WHERE name = 'questions'")).scalar()
+    if not exists:
+        connection.execute(text("INSERT INTO data_versions (name, version) VALUES ('questions', 0)"))
@@ -0,0 +1,14 @@
+# v0006_question_trigram_index.py
+# trigram index of the question texts, serving the substring matches of
+# the PostgreSQL search (flaskr/search.py). pg_trgm is a trusted extension
+# since PostgreSQL 13, the owner of the database can create it.
+from sqlalchemy import text
+
+
+def upgrade(connection):
+    if connection.dialect.name != 'postgresql':
+        return
+
+    connection.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_questions_question_trgm ON questions USING gin (question gin_trgm_ops)'))
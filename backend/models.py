@@ -1,24 +1,169 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
-from flask_sqlalchemy import SQLAlchemy
+from flask import g, has_app_context
+from sqlalchemy import Column, String, Integer, ForeignKey, Index, create_engine, event, orm
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.expression import Select, UpdateBase
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
 import json
 
-from settings import DB_NAME, DB_USER, DB_PASSWORD
+import migrations
 
-database_path = "postgresql://{}:{}@{}/{}".format(DB_USER,DB_PASSWORD,'localhost:5433', DB_NAME)
+from settings import DATABASE_URL
 
-db = SQLAlchemy()
+database_path = DATABASE_URL
+
+"""
+RoutingSession
+    sends SELECT statements to the read replica bind when the request
+    allows it (g.read_replica), everything else to the primary.
+    once a request has written, it keeps reading from the primary.
+"""
+class RoutingSession(SignallingSession):
+
+    def get_bind(self, mapper=None, clause=None):
+        if has_app_context():
+            if isinstance(clause, UpdateBase):
+                g.wrote_primary = True
+            elif isinstance(clause, Select) and use_replica(self.app):
+                return get_state(self.app).db.get_engine(self.app, bind='replica')
+
+        return super().get_bind(mapper, clause)
+
+
+# ORM flushes are writes too
+@event.listens_for(RoutingSession, 'after_flush')
+def _after_flush(session, flush_context):
+    if has_app_context():
+        g.wrote_primary = True
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
+
+
+def use_replica(app):
+    '''True when the current request may read from the replica'''
+    return 'replica' in (app.config.get('SQLALCHEMY_BINDS') or {}) \
+        and g.get('read_replica', False) and not g.get('wrote_primary', False)
+
+
+def read_engine():
+    '''engine for reads outside the session: the replica when configured'''
+    if 'replica' in (db.get_app().config.get('SQLALCHEMY_BINDS') or {}):
+        return db.get_engine(bind='replica')
+    return db.engine
+
+
+"""
+engine_options(config, database_path)
+    connection pool settings of the DB_POOL_* settings
+"""
+def engine_options(config, database_path):
+    options = {
+        'pool_pre_ping': config.get('DB_POOL_PRE_PING', True),
+        'pool_recycle': config.get('DB_POOL_RECYCLE', 1800)
+    }
+
+    url = make_url(database_path)
+    if url.get_backend_name() == 'sqlite':
+        # the pool hands a connection to one thread at a time
+        options['connect_args'] = {'check_same_thread': False}
+        if not is_memory_database(url):
+            # pysqlite opens a file per checkout (NullPool) otherwise,
+            # and every new connection runs the pragmas again
+            options['poolclass'] = QueuePool
+        else:
+            # a single shared connection (StaticPool), it holds the data
+            return options
+
+    options.update({
+        'pool_size': config.get('DB_POOL_SIZE', 5),
+        'max_overflow': config.get('DB_MAX_OVERFLOW', 10),
+        'pool_timeout': config.get('DB_POOL_TIMEOUT', 30)
+    })
+
+    return options
+
+
+def is_memory_database(url):
+    return url.database in (None, '', ':memory:')
+
+
+def sqlite_pragmas(config):
+    '''pragmas of every connection to an embedded sqlite database'''
+    return [
+        # readers never block the writer, nor the writer the readers
+        'PRAGMA journal_mode = WAL',
+        'PRAGMA synchronous = {}'.format(config.get('SQLITE_SYNCHRONOUS', 'NORMAL')),
+        # reads of the file are memory copies instead of read() calls
+        'PRAGMA mmap_size = {:d}'.format(config.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+        # negative: KiB instead of pages
+        'PRAGMA cache_size = {:d}'.format(-config.get('SQLITE_CACHE_SIZE_KB', 64 * 1024)),
+        'PRAGMA busy_timeout = {:d}'.format(config.get('SQLITE_BUSY_TIMEOUT_MS', 5000)),
+        'PRAGMA temp_store = MEMORY',
+        # off by default in sqlite, enforced by PostgreSQL
+        'PRAGMA foreign_keys = ON'
+    ]
+
+
+def install_sqlite_pragmas(engine, config):
+    '''run the sqlite_pragmas of config on every new connection of engine'''
+    pragmas = sqlite_pragmas(config)
+
+    @event.listens_for(engine, 'connect')
+    def _connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for pragma in pragmas:
+                cursor.execute(pragma)
+        finally:
+            cursor.close()
+
+
+def sqlite_absolute_url(database_path):
+    '''
+    a relative sqlite path made absolute from the working directory,
+    as python -m migrations and seed.py read it (flask-sqlalchemy would
+    take it relative to the flaskr package)
+    '''
+    url = make_url(database_path)
+    if url.get_backend_name() != 'sqlite' or is_memory_database(url) or os.path.isabs(url.database):
+        return database_path
+    url.database = os.path.abspath(url.database)
+    return str(url)
 
 """
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service,
+    and applies the pending schema migrations (see migrations/).
+    no connection is kept open afterwards: workers forked from this
+    process (gunicorn --preload) open their own on first use.
+    database_path is a PostgreSQL url or an embedded sqlite database
+    (see the SQLITE_* settings)
 """
 def setup_db(app, database_path=database_path):
+    database_path = sqlite_absolute_url(database_path)
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app.config, database_path)
+
+    # optional read replica, GET requests read from it
+    if app.config.get('DB_REPLICA_URL'):
+        app.config["SQLALCHEMY_BINDS"] = {'replica': app.config['DB_REPLICA_URL']}
+
     db.app = app
     db.init_app(app)
-    db.create_all()
+    if make_url(database_path).get_backend_name() == 'sqlite':
+        install_sqlite_pragmas(db.get_engine(app), app.config)
+    if app.config.get('DB_AUTO_MIGRATE', True):
+        migrations.upgrade(db.engine)
+        db.engine.dispose()
 
 """
 Question
@@ -26,11 +171,16 @@ Question
 """
 class Question(db.Model):
     __tablename__ = 'questions'
+    # created by the migrations, declared here for reference
+    __table_args__ = (
+        Index('ix_questions_category_id', 'category', 'id'),
+        Index('ix_questions_difficulty', 'difficulty'),
+    )
 
     id = Column(Integer, primary_key=True)
     question = Column(String)
     answer = Column(String)
-    category = Column(String)
+    category = Column(Integer, ForeignKey('categories.id'))
     difficulty = Column(Integer)
 
     def __init__(self, question, answer, category, difficulty):
@@ -40,8 +190,16 @@ class Question(db.Model):
         self.difficulty = difficulty
 
     def insert(self):
+        '''
+        insert the question, returns it formatted.
+        the flush runs INSERT ... RETURNING id, so the formatted row
+        is taken before the commit expires it and needs no reload
+        '''
         db.session.add(self)
+        db.session.flush()
+        created = self.format()
         db.session.commit()
+        return created
 
     def update(self):
         db.session.commit()
@@ -77,3 +235,17 @@ class Category(db.Model):
             'id': self.id,
             'type': self.type
             }
+
+"""
+DataVersion
+    write counter of a table, bumped in the same transaction as the writes
+"""
+class DataVersion(db.Model):
+    __tablename__ = 'data_versions'
+
+    name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False)
+
+    def __init__(self, name, version=0):
+        self.name = name
+        self.version = version
@@ -0,0 +1,74 @@
+# seed.py
+# loads the rows of a plain pg_dump file (trivia.psql) into any database,
+# such as an embedded sqlite one that psql cannot restore:
+#   python -m migrations --database-url sqlite:////var/lib/trivia/trivia.db
+#   python seed.py --database-url sqlite:////var/lib/trivia/trivia.db
+# only the COPY blocks are read, tables that already have rows are skipped.
+# PostgreSQL databases are restored with psql, which also sets the sequences.
+import argparse
+import re
+
+from sqlalchemy import column, create_engine, func, select, table
+
+from models import database_path
+
+# COPY public.questions (id, question, answer, difficulty, category) FROM stdin;
+COPY_HEADER = re.compile(r'^COPY (?:\w+\.)?(\w+) \((.*)\) FROM stdin;$')
+
+# escapes of the COPY text format
+ESCAPES = {'t': '\t', 'n': '\n', 'r': '\r', 'b': '\b', 'f': '\f', 'v': '\v', '\\': '\\'}
+ESCAPE = re.compile(r'\\(.)')
+
+
+def copy_value(field):
+    '''a field of a COPY row, None for \\N'''
+    if field == '\\N':
+        return None
+    return ESCAPE.sub(lambda match: ESCAPES.get(match.group(1), match.group(1)), field)
+
+
+def copy_blocks(lines):
+    '''yields (table name, column names, rows) of the COPY blocks of a dump'''
+    lines = iter(lines)
+    for line in lines:
+        header = COPY_HEADER.match(line.rstrip('\n'))
+        if header is None:
+            continue
+
+        columns = [name.strip().strip('"') for name in header.group(2).split(',')]
+        rows = []
+        for row in lines:
+            row = row.rstrip('\n')
+            if row == '\\.':
+                break
+            rows.append(dict(zip(columns, map(copy_value, row.split('\t')))))
+        yield header.group(1), columns, rows
+
+
+def load_dump(engine, path):
+    '''
+    inserts the rows of the dump at path into the tables of engine, in
+    the order of the dump. returns {table name: rows inserted}
+    '''
+    loaded = {}
+    with open(path, encoding='utf8') as dump, engine.begin() as connection:
+        for name, columns, rows in copy_blocks(dump):
+            target = table(name, *map(column, columns))
+            if connection.execute(select([func.count()]).select_from(target)).scalar():
+                loaded[name] = 0
+                continue
+            if rows:
+                connection.execute(target.insert(), rows)
+            loaded[name] = len(rows)
+    return loaded
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='load the rows of a pg_dump file, after the migrations')
+    parser.add_argument('--database-url', default=database_path)
+    parser.add_argument('dump', nargs='?', default='trivia.psql')
+    args = parser.parse_args()
+
+    engine = create_engine(args.database_url)
+    for name, count in load_dump(engine, args.dump).items():
+        print(f'{name}: {count} rows' if count else f'{name}: already loaded, skipped')
@@ -1,8 +1,165 @@
-from dotenv import load_dotenv
 import os
 
-load_dotenv()
+# 'production' reads the settings from the environment only, skips the
+# .env file and the startup migrations (run python -m migrations on deploy)
+BOOT_MODE = os.environ.get("BOOT_MODE", "development")
+if BOOT_MODE != "production":
+    from dotenv import load_dotenv
+    load_dotenv()
+
 DB_NAME = os.environ.get("DB_NAME")
 DB_NAME_TEST = os.environ.get("DB_NAME_TEST")
 DB_USER=os.environ.get("DB_USER")
 DB_PASSWORD = os.environ.get("DB_PASSWORD")
+
+# database of the app, the PostgreSQL server of the DB_* settings by default.
+# sqlite:////path/to/trivia.db runs on an embedded database file instead,
+# for single node deployments (python seed.py loads the questions in it)
+DATABASE_URL = os.environ.get("DATABASE_URL") or \
+    "postgresql://{}:{}@{}/{}".format(DB_USER, DB_PASSWORD, 'localhost:5433', DB_NAME)
+# database of test_flaskr.py, a sqlite url runs the tests without a server
+DATABASE_URL_TEST = os.environ.get("DATABASE_URL_TEST") or \
+    "postgresql://{}:{}@{}/{}".format(DB_USER, DB_PASSWORD, 'localhost:5433', DB_NAME_TEST)
+
+# embedded sqlite, set on every connection: bytes of the database file read
+# through memory-mapped I/O, page cache in KiB, synchronous mode of the WAL
+# journal (NORMAL: a power loss may lose the last commits, never corrupts)
+# and milliseconds a writer waits for the lock of another one
+SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE", 256 * 1024 * 1024))
+SQLITE_CACHE_SIZE_KB = int(os.environ.get("SQLITE_CACHE_SIZE_KB", 64 * 1024))
+SQLITE_SYNCHRONOUS = os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", 5000))
+
+# connection pool of each worker process
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = int(os.environ.get("DB_POOL_TIMEOUT", 30))
+# seconds before a connection is replaced, keep it under the server/proxy idle timeout
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+# test connections on checkout, drops stale sockets
+DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "true").lower() == "true"
+
+# admission control of the api: token buckets of RATE_LIMIT_BURST tokens
+# per client (api key or address) refilled at RATE_LIMIT_RATE tokens per
+# second, 'memory' (per process), 'redis' (shared by every worker) or 'off'.
+# RATE_LIMIT_COSTS gives the tokens of the routes that cost more than 1
+RATE_LIMIT = os.environ.get("RATE_LIMIT", "memory")
+RATE_LIMIT_RATE = float(os.environ.get("RATE_LIMIT_RATE", 20))
+RATE_LIMIT_BURST = float(os.environ.get("RATE_LIMIT_BURST", 60))
+RATE_LIMIT_COSTS = os.environ.get(
+    "RATE_LIMIT_COSTS",
+    "search_questions=5,play_quiz=3,export_questions=10,bulk_import_questions=10,get_ready=0,get_metrics=0")
+RATE_LIMIT_URL = os.environ.get("RATE_LIMIT_URL", "redis://localhost:6379/0")
+RATE_LIMIT_MAX_CLIENTS = int(os.environ.get("RATE_LIMIT_MAX_CLIENTS", 100000))
+# comma separated api keys with a bucket of their own (X-API-Key header),
+# requests with any other key are limited by their address
+RATE_LIMIT_API_KEYS = os.environ.get("RATE_LIMIT_API_KEYS", "")
+# reverse proxies (load balancers) in front of the app that set
+# X-Forwarded-For and X-Forwarded-Proto, 0 when clients connect directly.
+# behind a proxy the address of a request is the one of the proxy unless
+# this is set, and every client shares one rate limit bucket
+PROXY_FIX_HOPS = int(os.environ.get("PROXY_FIX_HOPS", 0))
+# requests of the api in flight per worker before new ones get a 503,
+# 0 for no limit. past the pool size they would wait for a connection
+MAX_CONCURRENT_REQUESTS = int(os.environ.get("MAX_CONCURRENT_REQUESTS", DB_POOL_SIZE + DB_MAX_OVERFLOW))
+
+# optional read replica: GET requests read from it, writes and the
+# requests of a client for DB_REPLICA_STICKY_SECONDS after its last
+# write use the primary
+DB_REPLICA_URL = os.environ.get("DB_REPLICA_URL")
+DB_REPLICA_STICKY_SECONDS = int(os.environ.get("DB_REPLICA_STICKY_SECONDS", 5))
+
+# quiz sessions: 'memory' (per process) or 'redis' (shared by every worker),
+# seconds of inactivity before a session expires, and max number of
+# sessions kept per process in memory
+QUIZ_SESSIONS = os.environ.get("QUIZ_SESSIONS", "memory")
+QUIZ_SESSION_URL = os.environ.get("QUIZ_SESSION_URL", "redis://localhost:6379/0")
+QUIZ_SESSION_TTL = int(os.environ.get("QUIZ_SESSION_TTL", 3600))
+QUIZ_SESSION_MAX = int(os.environ.get("QUIZ_SESSION_MAX", 10000))
+# max questions returned by one POST /quizzes with "count"
+QUIZ_MAX_BATCH = int(os.environ.get("QUIZ_MAX_BATCH", 50))
+# quiz sampler: question ids kept in memory per process, larger tables are
+# sampled by probing random ids; seconds between two rebuilds after the
+# writes of other processes
+QUIZ_SAMPLER_MAX_IDS = int(os.environ.get("QUIZ_SAMPLER_MAX_IDS", 5000000))
+QUIZ_SAMPLER_REFRESH_SECONDS = int(os.environ.get("QUIZ_SAMPLER_REFRESH_SECONDS", 5))
+
+# total_questions of the list and search routes: 'exact' (COUNT(*)),
+# 'estimated' (planner estimates, exact under COUNT_EXACT_BELOW rows) or
+# 'cached' (per category counts kept in memory, rebuilt at most every
+# COUNT_REFRESH_SECONDS after the writes of other processes)
+COUNT_MODE = os.environ.get("COUNT_MODE", "cached")
+COUNT_EXACT_BELOW = int(os.environ.get("COUNT_EXACT_BELOW", 10000))
+COUNT_REFRESH_SECONDS = int(os.environ.get("COUNT_REFRESH_SECONDS", 5))
+
+# search cache: ordered ids of the matches of SEARCH_CACHE_MAX_ENTRIES
+# lowercased terms per process (0 turns it off), at most
+# SEARCH_CACHE_MAX_IDS ids per term, later pages are searched again
+SEARCH_CACHE_MAX_ENTRIES = int(os.environ.get("SEARCH_CACHE_MAX_ENTRIES", 1024))
+SEARCH_CACHE_MAX_IDS = int(os.environ.get("SEARCH_CACHE_MAX_IDS", 10000))
+# seconds between two rebuilds of the in-process search index (databases
+# other than PostgreSQL) after the writes of other processes
+SEARCH_REFRESH_SECONDS = int(os.environ.get("SEARCH_REFRESH_SECONDS", 5))
+
+# prefix completions of GET /questions/suggest: words and questions kept
+# in memory per process, and max completions of each kind per request
+SUGGEST_MAX_TERMS = int(os.environ.get("SUGGEST_MAX_TERMS", 200000))
+SUGGEST_MAX_QUESTIONS = int(os.environ.get("SUGGEST_MAX_QUESTIONS", 1000000))
+SUGGEST_MAX_RESULTS = int(os.environ.get("SUGGEST_MAX_RESULTS", 20))
+# seconds between rebuilds of the suggest index after writes of other processes
+SUGGEST_REFRESH_SECONDS = int(os.environ.get("SUGGEST_REFRESH_SECONDS", 5))
+
+# response cache of the GET routes: 'memory' (per process LRU),
+# 'redis' (shared by every worker, needs the redis package) or 'off'
+RESPONSE_CACHE = os.environ.get("RESPONSE_CACHE", "memory")
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", 1024))
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+RESPONSE_CACHE_URL = os.environ.get("RESPONSE_CACHE_URL", "redis://localhost:6379/0")
+RESPONSE_CACHE_TTL = int(os.environ.get("RESPONSE_CACHE_TTL", 3600))
+
+# bulk import: rows inserted per batch, and max number of row errors
+# listed in the import report (every failed row is still counted)
+BULK_BATCH_SIZE = int(os.environ.get("BULK_BATCH_SIZE", 1000))
+BULK_MAX_ERRORS = int(os.environ.get("BULK_MAX_ERRORS", 100))
+
+# write-behind inserts of POST /questions: concurrent inserts of a worker
+# are committed together, up to GROUP_COMMIT_MAX_BATCH rows per transaction,
+# a row waits at most GROUP_COMMIT_MAX_WAIT_MS for others
+GROUP_COMMIT = os.environ.get("GROUP_COMMIT", "false").lower() == "true"
+GROUP_COMMIT_MAX_BATCH = int(os.environ.get("GROUP_COMMIT_MAX_BATCH", 100))
+GROUP_COMMIT_MAX_WAIT_MS = int(os.environ.get("GROUP_COMMIT_MAX_WAIT_MS", 5))
+
+# export: rows fetched from the server-side cursor per batch
+EXPORT_BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", 1000))
+
+# per-request SQL metrics, /api/v1/metrics and Server-Timing header
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "true").lower() == "true"
+
+# JSON encoder of the read routes: 'orjson', 'stdlib' (flask jsonify)
+# or 'auto' (orjson when installed). both give the same bytes
+JSON_SERIALIZER = os.environ.get("JSON_SERIALIZER", "auto")
+
+# apply the pending schema migrations when the app starts,
+# turn off to run them separately (python -m migrations)
+DB_AUTO_MIGRATE = os.environ.get(
+    "DB_AUTO_MIGRATE", "false" if BOOT_MODE == "production" else "true").lower() == "true"
+
+# startup time of create_app in milliseconds, a warning is logged above it
+STARTUP_BUDGET_MS = int(os.environ.get("STARTUP_BUDGET_MS", 500))
+# connections the readiness probe opens in each pool of a worker
+DB_POOL_WARM = int(os.environ.get("DB_POOL_WARM", 2))
+
+# on-demand request profiles, off unless PROFILE_ENABLED. a request of the
+# api is profiled when its X-Profile-Token header is PROFILE_SECRET, or at
+# PROFILE_SAMPLE_RATE (0 to 1), limited to PROFILE_ENDPOINTS when set
+# ("play_quiz,get_questions"). PROFILE_OUTPUT is 'collapsed' (stacks
+# sampled every PROFILE_INTERVAL_MS, for flame graphs) or 'pstats'
+# (cProfile). the last PROFILE_MAX_FILES profiles are kept in PROFILE_DIR
+PROFILE_ENABLED = os.environ.get("PROFILE_ENABLED", "false").lower() == "true"
+PROFILE_SECRET = os.environ.get("PROFILE_SECRET", "")
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+PROFILE_ENDPOINTS = os.environ.get("PROFILE_ENDPOINTS", "")
+PROFILE_OUTPUT = os.environ.get("PROFILE_OUTPUT", "collapsed")
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", 5))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+PROFILE_MAX_FILES = int(os.environ.get("PROFILE_MAX_FILES", 100))
@@ -1,16 +1,68 @@
 import os
+import asyncio
 import unittest
+from unittest import mock
 import json
 from flask_sqlalchemy import SQLAlchemy
 import math
+import random
+import threading
+import pstats
+import tempfile
+import time
+from array import array
 
-from sqlalchemy import desc, func
+from sqlalchemy import create_engine, desc
+from sqlalchemy.engine.url import make_url
 
 
 from flaskr import create_app
-from models import setup_db, Question, Category
-from settings import DB_NAME_TEST, DB_USER, DB_PASSWORD
+from models import db, Question, Category
+from flaskr.search import InvertedIndexSearch, CachedSearch, search_key
+from flaskr.quiz_sessions import TTLStore, MemorySessions, candidates, new_session, permute, pick, remaining
+from flaskr.sampler import QuestionSampler
+from flaskr.changes import data_version
+from flaskr.counts import QuestionCounter
+from flaskr.suggest import Suggester
+from flaskr.cache import LRUBackend, request_key
+from flaskr.ratelimit import MemoryBuckets, ConcurrencyLimit, parse_costs
+from flaskr.asgi import create_asgi_app
+from flaskr.serializer import OrjsonSerializer
+from flaskr.profiling import StackSampler, parse_endpoints
+from flaskr.group_commit import GroupCommitter, PendingInsert
+from flaskr.api.common import random_order
+from seed import load_dump
+from benchmarks.bench import percentile, compare
+import migrations
 
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+from settings import DATABASE_URL_TEST, DB_NAME, DB_NAME_TEST, DB_USER, DB_PASSWORD
+
+# DATABASE_URL_TEST=sqlite:////tmp/trivia_test.db runs the tests without a server
+SQLITE = make_url(DATABASE_URL_TEST).get_backend_name() == 'sqlite'
+
+
+def setUpModule():
+    """An embedded test database is created from the dump on every run."""
+    if not SQLITE:
+        return
+    path = make_url(DATABASE_URL_TEST).database
+    for name in (path, path + '-wal', path + '-shm'):
+        if os.path.exists(name):
+            os.remove(name)
+
+    engine = create_engine(DATABASE_URL_TEST)
+    migrations.upgrade(engine)
+    load_dump(engine, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'trivia.psql'))
+    engine.dispose()
 
 
 class TriviaTestCase(unittest.TestCase):
@@ -18,10 +70,9 @@ class TriviaTestCase(unittest.TestCase):
 
     def setUp(self):
         """Define test variables and initialize app."""
-        self.app = create_app()
+        self.database_path = DATABASE_URL_TEST
+        self.app = create_app({'DATABASE_URL': self.database_path})
         self.client = self.app.test_client
-        self.database_path = "postgresql://{}:{}@{}/{}".format(DB_USER, DB_PASSWORD,'localhost:5433', DB_NAME_TEST)
-        setup_db(self.app, self.database_path)
 
         # binds the app to the current context
         with self.app.app_context():
@@ -70,6 +121,115 @@ class TriviaTestCase(unittest.TestCase):
         self.assertGreater(len(data['questions']), 0)
     
 
+    def test_count_modes_agree(self):
+        '''
+        tests every count mode gives the real total of the test data,
+        the planner estimates are only used above COUNT_EXACT_BELOW
+        '''
+        with self.app.app_context():
+            total = Question.query.count()
+            in_category = Question.query.filter(Question.category == 1).count()
+
+        for mode in ('exact', 'estimated', 'cached'):
+            self.app.extensions['counter'].mode = mode
+            # a query string of its own, the response cache does not answer
+            data = json.loads(self.client().get('/api/v1/questions?mode=' + mode).data)
+            self.assertEqual(data['total_questions'], total)
+            self.assertTrue(data['total_questions_exact'])
+
+            data = json.loads(self.client().get('/api/v1/categories/1/questions?mode=' + mode).data)
+            self.assertEqual(data['total_questions'], in_category)
+            self.assertTrue(data['total_questions_exact'])
+
+    def test_cached_count_follows_writes(self):
+        '''
+        tests the cached count is updated by a new question, without a rebuild
+        '''
+        before = json.loads(self.client().get('/api/v1/questions').data)['total_questions']
+        response = self.client().post('/api/v1/questions', json={
+            "question": "count test question",
+            "answer": "count test answer",
+            "difficulty": 1,
+            "category": 1
+        })
+        data = json.loads(response.data)
+
+        self.assertEqual(data['total_questions'], before + 1)
+        self.assertTrue(data['total_questions_exact'])
+
+    def test_get_questions_cache_invalidated_by_writes(self):
+        '''
+        tests that cached question pages are refreshed after a new question
+        '''
+        # the second identical request is served from the cache
+        self.client().get('/api/v1/questions')
+        response = self.client().get('/api/v1/questions')
+        total_before = json.loads(response.data)['total_questions']
+        stats = json.loads(self.client().get('/api/v1/cache/stats').data)['cache']
+        self.assertGreaterEqual(stats['hits'], 1)
+
+        # a new question bumps the data version
+        self.client().post('/api/v1/questions', json={
+            "question": "cache test question",
+            "answer": "cache test answer",
+            "difficulty": 1,
+            "category": 1
+        })
+        response = self.client().get('/api/v1/questions')
+        self.assertEqual(json.loads(response.data)['total_questions'], total_before + 1)
+
+    def test_get_questions_if_none_match(self):
+        '''
+        tests conditional GET with the ETag of the questions page
+        '''
+        response = self.client().get('/api/v1/questions')
+        etag = response.headers['ETag']
+        self.assertEqual(response.headers['Cache-Control'], 'no-cache')
+
+        # same version, the client copy is still valid
+        response = self.client().get('/api/v1/questions', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+
+        # another page has another ETag
+        response = self.client().get('/api/v1/questions?page=2', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+    def test_encoded_query_arguments_are_other_requests(self):
+        '''
+        tests an argument value holding an encoded & and = is not cached as other arguments
+        '''
+        # a single after_id argument, "5&page=1", which is invalid
+        response = self.client().get('/api/v1/questions?after_id=5%26page%3D1')
+        etag = response.headers.get('ETag')
+
+        response = self.client().get('/api/v1/questions?page=1&after_id=5')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertGreater(json.loads(response.data)['questions'][0]['id'], 5)
+
+        with self.app.test_request_context('/api/v1/questions?after_id=5%26page%3D1'):
+            encoded = request_key()
+        with self.app.test_request_context('/api/v1/questions?page=1&after_id=5'):
+            self.assertNotEqual(request_key(), encoded)
+
+    def test_metrics(self):
+        '''
+        tests the Server-Timing header and the prometheus metrics
+        '''
+        response = self.client().get('/api/v1/categories')
+        self.assertIn('db;', response.headers['Server-Timing'])
+        self.assertIn('serialize;', response.headers['Server-Timing'])
+
+        response = self.client().get('/api/v1/metrics')
+        text = response.data.decode('utf-8')
+
+        # the categories request is counted with its SQL statements
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        self.assertIn('trivia_request_duration_seconds_count{endpoint="api1.get_categories",method="GET"} 1', text)
+        self.assertIn('trivia_db_queries_total{endpoint="api1.get_categories",method="GET"}', text)
+
     def test_invalid_question_page(self):
         '''
         tests for invalid question page
@@ -91,6 +251,59 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['message'], 'resource not found')
 
 
+    def test_get_questions_after_id_cursor(self):
+        '''
+        tests keyset pagination with the after_id cursor
+        '''
+        # first page gives the cursor for the next one
+        response = self.client().get('/api/v1/questions')
+        data = json.loads(response.data)
+        first_page_ids = [question['id'] for question in data['questions']]
+
+        # ask for the page after the cursor
+        response = self.client().get(f"/api/v1/questions?after_id={data['next_after_id']}")
+        data = json.loads(response.data)
+        next_page_ids = [question['id'] for question in data['questions']]
+
+        # status code should be 200, ids should keep increasing
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(min(next_page_ids), max(first_page_ids))
+        self.assertEqual(next_page_ids, sorted(next_page_ids))
+        # total should be the count of the whole table
+        self.assertEqual(data['total_questions'], Question.query.count())
+
+    def test_export_questions(self):
+        '''
+        tests the NDJSON and CSV exports with filters
+        '''
+        response = self.client().get('/api/v1/questions/export')
+        rows = [json.loads(line) for line in response.data.decode('utf-8').splitlines()]
+
+        # every question is exported in id order
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        self.assertEqual(len(rows), Question.query.count())
+        self.assertEqual([row['id'] for row in rows], sorted(row['id'] for row in rows))
+
+        # a shard of category 2 as csv
+        response = self.client().get(f"/api/v1/questions/export?format=csv&category=2&min_id={rows[0]['id']}")
+        lines = response.data.decode('utf-8').splitlines()
+        self.assertEqual(response.mimetype, 'text/csv')
+        self.assertEqual(lines[0], 'id,question,answer,difficulty,category')
+        self.assertEqual(len(lines) - 1, Question.query.filter(Question.category == 2).count())
+
+    def test_export_with_invalid_filter(self):
+        '''
+        tests that a filter which is not an integer is refused,
+        instead of exporting the whole table
+        '''
+        for query in ('category=abc', 'min_id=1.5', 'max_id='):
+            response = self.client().get(f'/api/v1/questions/export?{query}')
+            data = json.loads(response.data)
+
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(data['message'], 'bad request')
+
     def test_for_deleted_question_by_id(self):
         '''
         test for deleted question by here id
@@ -112,6 +325,55 @@ class TriviaTestCase(unittest.TestCase):
         # check if question are very deleted
         self.assertEqual(question_before_delete - question_after_delete, 1)
     
+    def test_bulk_update_and_delete_questions(self):
+        '''
+        tests PATCH and DELETE on the questions collection
+        '''
+        # create two questions to work on
+        ids = []
+        for text in ('bulk moderation 1', 'bulk moderation 2'):
+            question = Question(text, 'bulk answer', 1, 1)
+            question.insert()
+            ids.append(question.id)
+
+        # move them to category 2 with difficulty 5
+        response = self.client().patch('/api/v1/questions', json={'ids': ids, 'set': {'category': 2, 'difficulty': 5}})
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['updated'], 2)
+        self.assertEqual(Question.query.filter(Question.id.in_(ids), Question.difficulty == 5).count(), 2)
+
+        # delete them in one call
+        response = self.client().delete('/api/v1/questions', json={'ids': ids})
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['deleted'], 2)
+        self.assertEqual(Question.query.filter(Question.id.in_(ids)).count(), 0)
+
+    def test_bulk_delete_without_filter(self):
+        '''
+        tests that a bulk delete needs a filter
+        '''
+        response = self.client().delete('/api/v1/questions', json={'ids': []})
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data['message'], 'bad request')
+
+    def test_bulk_delete_ids_must_be_a_list_of_integers(self):
+        '''
+        tests that ids given as a string, an object, booleans or
+        strings are refused instead of being iterated
+        '''
+        total = Question.query.count()
+        for ids in ('24', {'2': 4}, [True], ['2'], [2.5]):
+            response = self.client().delete('/api/v1/questions', json={'ids': ids})
+            data = json.loads(response.data)
+
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(data['message'], 'bad request')
+        self.assertEqual(Question.query.count(), total)
+
     def test_post_new_question(self):
         '''
         test to post a new question
@@ -124,6 +386,29 @@ class TriviaTestCase(unittest.TestCase):
             "category": 2
         })
         data = json.loads(response.data)
+
+        # check status code, if is 200
+        self.assertEqual(response.status_code, 200)
+        # check if success in data is True
+        self.assertTrue(data['success'])
+        # only the created question and the total are returned
+        self.assertNotIn('questions', data)
+        self.assertEqual(data['created']['id'], data['id'])
+        self.assertEqual(data['created']['answer'], 'answer for test question')
+        self.assertEqual(data['total_questions'], Question.query.count())
+
+    def test_post_new_question_full_response(self):
+        '''
+        test to post a new question, legacy full page response
+        '''
+        # posting data for create new question, with the full page payload
+        response = self.client().post('/api/v1/questions?response=full', json={
+            "question": "question test",
+            "answer": "answer for test question",
+            "difficulty": 2,
+            "category": 2
+        })
+        data = json.loads(response.data)
         
         # check status code, if is 200
         self.assertEqual(response.status_code, 200)
@@ -140,6 +425,38 @@ class TriviaTestCase(unittest.TestCase):
         self.assertGreater(data['total_questions'], 0)
     
 
+    def test_bulk_import_questions(self):
+        '''
+        tests a NDJSON bulk import with a bad row
+        '''
+        total_before = Question.query.count()
+        rows = [
+            json.dumps({"question": "bulk question 1", "answer": "bulk answer", "difficulty": 1, "category": 1}),
+            json.dumps({"question": "bulk question 2", "answer": "bulk answer", "difficulty": 6, "category": 1}),
+            json.dumps({"question": "bulk question 3", "answer": "bulk answer", "difficulty": 5, "category": 2})
+        ]
+        response = self.client().post('/api/v1/questions/bulk', data='\n'.join(rows),
+                                      content_type='application/x-ndjson')
+        data = json.loads(response.data)
+
+        # check the report, the second row is refused without aborting the load
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['inserted'], 2)
+        self.assertEqual(data['failed'], 1)
+        self.assertEqual(data['errors'][0]['line'], 2)
+        self.assertEqual(Question.query.count(), total_before + 2)
+
+    def test_bulk_import_bad_csv_header(self):
+        '''
+        tests a CSV bulk import without the required columns
+        '''
+        response = self.client().post('/api/v1/questions/bulk', data='question,answer\nq,a\n',
+                                      content_type='text/csv')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data['message'], 'bad request')
+
     def test_empty_post_question(self):
         '''
         test posting empty question json
@@ -175,6 +492,13 @@ class TriviaTestCase(unittest.TestCase):
         self.assertGreater(len(data['questions']), 0)
         self.assertGreater(data['total_questions'], 0)
 
+        # the term is matched anywhere in the question, like ILIKE '%term%'
+        response = self.client().post('/api/v1/questions/search', json={'searchTerm': 'ITLE'})
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(all('itle' in question['question'].lower() for question in data['questions']))
+        self.assertIn('title', ' '.join(question['question'].lower() for question in data['questions']))
+
 
     def test_invalid_post_search_questions(self):
         '''
@@ -191,6 +515,43 @@ class TriviaTestCase(unittest.TestCase):
         # check if message in data is 'resource not found'
         self.assertEqual(data['message'], 'resource not found')
 
+    def test_search_questions_total_over_pages(self):
+        '''
+        tests that total_questions counts every match, not the page length
+        '''
+        # more than a page of fixture questions contain a word starting with "the"
+        response = self.client().post('/api/v1/questions/search', json={'searchTerm': 'the'})
+        data = json.loads(response.data)
+
+        # check if status code is 200 and total covers more than one page
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(data['total_questions'], len(data['questions']))
+
+        # the second page continues the first one
+        response = self.client().post('/api/v1/questions/search?page=2', json={'searchTerm': 'the'})
+        data_page_2 = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(data['questions']) + len(data_page_2['questions']), data['total_questions'])
+
+    def test_suggest_questions(self):
+        '''
+        tests the completions of a prefix
+        '''
+        response = self.client().get('/api/v1/questions/suggest?prefix=Which co')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('country', data['words'])
+        self.assertTrue(all(question['question'].lower().startswith('which co') for question in data['questions']))
+        self.assertGreater(len(data['questions']), 0)
+
+    def test_invalid_suggest_questions(self):
+        '''
+        tests a missing prefix and a limit out of bounds
+        '''
+        self.assertEqual(self.client().get('/api/v1/questions/suggest').status_code, 400)
+        self.assertEqual(self.client().get('/api/v1/questions/suggest?prefix=wh&limit=1000').status_code, 400)
+
     def test_bad_post_search_questions(self):
         '''
         test search whit empty value
@@ -211,7 +572,7 @@ class TriviaTestCase(unittest.TestCase):
         test to get questions by category
         '''
         # get one and random category 
-        category = Category.query.order_by(func.random()).first()
+        category = Category.query.order_by(random_order()).first()
 
         # get all questions from database by her category 
         response= self.client().get(f'/api/v1/categories/{category.id}/questions')
@@ -258,7 +619,7 @@ class TriviaTestCase(unittest.TestCase):
         tests playing a quizzes
         '''
         # query db for 2 random questions
-        questions = Question.query.order_by(func.random()).limit(2).all()
+        questions = Question.query.order_by(random_order()).limit(2).all()
         previous_questions = [question.id for question in questions]
 
         # post response json, then load the data
@@ -272,6 +633,122 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['success'])
         self.assertTrue(data['question'])
 
+    def test_play_quiz_session(self):
+        '''
+        tests playing a whole category with a quiz session
+        '''
+        # start a session on category 2
+        response = self.client().post('/api/v1/quizzes', json={
+            'session': True,
+            'quiz_category': {'id': 2}
+        })
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(data['quiz_session'])
+
+        # draw until the deck is empty
+        played = [data['question']['id']]
+        while data['remaining']:
+            response = self.client().post('/api/v1/quizzes', json={'quiz_session': data['quiz_session']})
+            data = json.loads(response.data)
+            played.append(data['question']['id'])
+
+        # every question of the category is played once
+        category_ids = [question.id for question in Question.query.filter(Question.category == 2).all()]
+        self.assertEqual(sorted(played), sorted(category_ids))
+
+        # the next draw ends the quiz, the session is then gone
+        response = self.client().post('/api/v1/quizzes', json={'quiz_session': data['quiz_session']})
+        self.assertNotIn('question', json.loads(response.data))
+        response = self.client().post('/api/v1/quizzes', json={'quiz_session': data['quiz_session']})
+        self.assertEqual(response.status_code, 404)
+
+    def test_play_quiz_session_on_another_worker(self):
+        '''
+        tests a quiz session continues on another worker sharing the session backend
+        '''
+        other = create_app({'DATABASE_URL': self.database_path})
+        other.extensions['quiz_sessions'].backend = self.app.extensions['quiz_sessions'].backend
+
+        response = self.client().post('/api/v1/quizzes', json={'session': True, 'quiz_category': {'id': 2}})
+        data = json.loads(response.data)
+        played = [data['question']['id']]
+
+        response = other.test_client().post('/api/v1/quizzes', json={'quiz_session': data['quiz_session']})
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(data['question']['id'], played)
+
+    def test_play_quiz_batch_with_prefetch(self):
+        '''
+        tests drawing a whole category in batches, following the prefetch hint
+        '''
+        body = {'previous_questions': [], 'quiz_category': {'id': 2}, 'count': 2, 'prefetch': True}
+        played = []
+        while body:
+            response = self.client().post('/api/v1/quizzes', json=body)
+            data = json.loads(response.data)
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(data['questions']), 2)
+            played += [question['id'] for question in data['questions']]
+            body = data['prefetch']
+
+        # every question of the category is played once
+        category_ids = [question.id for question in Question.query.filter(Question.category == 2).all()]
+        self.assertEqual(sorted(played), sorted(category_ids))
+
+    def test_play_quiz_session_batch(self):
+        '''
+        tests drawing the deck of a quiz session in batches
+        '''
+        response = self.client().post('/api/v1/quizzes', json={
+            'session': True,
+            'quiz_category': {'id': 0},
+            'count': 5
+        })
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(data['questions']), 5)
+        self.assertEqual(data['remaining'], Question.query.count() - 5)
+        self.assertNotIn('prefetch', data)
+
+    def test_play_quiz_invalid_count(self):
+        '''
+        tests a batch size out of bounds
+        '''
+        for count in (0, 'two', 1000):
+            response = self.client().post('/api/v1/quizzes', json={
+                'previous_questions': [],
+                'quiz_category': {'id': 1},
+                'count': count
+            })
+            self.assertEqual(response.status_code, 400)
+
+    def test_ready(self):
+        '''
+        tests the readiness probe warms the pool of the worker
+        '''
+        response = self.client().get('/api/v1/ready')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(data['ready'])
+        self.assertGreaterEqual(data['pools']['primary']['checked_in'], 1)
+        self.assertIn('database', data['startup']['phases'])
+
+    def test_play_quiz_invalid_category(self):
+        '''
+        tests playing a quiz with a category id that is not an integer
+        '''
+        for body in ({'previous_questions': [], 'quiz_category': {'id': 'abc'}},
+                     {'previous_questions': [], 'quiz_category': 'Science'},
+                     {'session': True, 'quiz_category': {}}):
+            response = self.client().post('/api/v1/quizzes', json=body)
+            data = json.loads(response.data)
+
+            self.assertEqual(response.status_code, 400)
+            self.assertFalse(data['success'])
+
     def test_failed_play_quiz(self):
         '''
         tests playing a quizzes with empty json
@@ -285,8 +762,982 @@ class TriviaTestCase(unittest.TestCase):
         self.assertFalse(data['success'])
         self.assertEqual(data['message'], 'bad request')
 
+    def test_search_finds_the_questions_of_other_processes(self):
+        '''
+        tests the in-process search index picks up the writes of another process
+        '''
+        if not SQLITE:
+            self.skipTest('PostgreSQL searches the table itself')
+        app = create_app({'DATABASE_URL': self.database_path, 'SEARCH_REFRESH_SECONDS': 0})
+        client = app.test_client()
+        self.assertEqual(client.post('/api/v1/questions/search', json={'searchTerm': 'zebra crossing'}).status_code,
+                         404)
+
+        # another process, with its own engine: its writes never come through the feed
+        other = create_engine(self.database_path)
+        with other.begin() as connection:
+            connection.execute("INSERT INTO questions (question, answer, difficulty, category) "
+                               "VALUES ('Where is the zebra crossing?', 'road', 1, 1)")
+            connection.execute("UPDATE data_versions SET version = version + 1 WHERE name = 'questions'")
+        try:
+            # the first search starts the rebuild, a later one finds the question
+            deadline = time.monotonic() + 5
+            status = None
+            while status != 200 and time.monotonic() < deadline:
+                status = client.post('/api/v1/questions/search', json={'searchTerm': 'zebra crossing'}).status_code
+                time.sleep(0.05)
+            self.assertEqual(status, 200)
+        finally:
+            with other.begin() as connection:
+                connection.execute("DELETE FROM questions WHERE question = 'Where is the zebra crossing?'")
+                connection.execute("UPDATE data_versions SET version = version + 1 WHERE name = 'questions'")
+            other.dispose()
+
+    def test_changes_feed_of_each_app(self):
+        '''
+        tests two apps of a process keep their own changes feed subscribers
+        '''
+        first = create_app({'DATABASE_URL': self.database_path, 'SEARCH_REFRESH_SECONDS': 3600,
+                            'SEARCH_CACHE_MAX_ENTRIES': 0})
+        client = first.test_client()
+        client.post('/api/v1/questions/search', json={'searchTerm': 'title'})
+
+        # a second app must not take the hooks of the first one
+        second = create_app({'DATABASE_URL': self.database_path})
+        self.assertIsNot(first.extensions['changes']['search'], second.extensions['changes']['search'])
+
+        response = client.post('/api/v1/questions', json={
+            'question': 'Which feed is the walrus on?', 'answer': 'first', 'difficulty': 1, 'category': 1})
+        id = json.loads(response.data)['id']
+        try:
+            # the index of the first app got its own write through the feed
+            response = client.post('/api/v1/questions/search', json={'searchTerm': 'walrus'})
+            self.assertEqual(response.status_code, 200)
+        finally:
+            client.delete(f'/api/v1/questions/{id}')
+
+    def test_sampler_catches_up_with_other_processes(self):
+        '''
+        tests the quiz sampler picks up the writes of another process
+        '''
+        sampler = self.app.extensions['sampler']
+        with self.app.app_context():
+            sampler._build()
+
+        # another process, with its own engine: its writes never come through the feed
+        other = create_engine(self.database_path)
+
+        def write(*statements):
+            with other.begin() as connection:
+                for statement in statements:
+                    connection.execute(statement)
+                connection.execute("UPDATE data_versions SET version = version + 1 WHERE name = 'questions'")
+
+        def refresh():
+            with self.app.app_context():
+                sampler._refresh()
+
+        try:
+            write("INSERT INTO questions (question, answer, difficulty, category) VALUES ('sampler a', 'a', 1, 1)",
+                  "INSERT INTO questions (question, answer, difficulty, category) VALUES ('sampler b', 'b', 1, 2)")
+            ids = dict(other.execute("SELECT question, id FROM questions WHERE question LIKE 'sampler _'").fetchall())
+            refresh()
+            self.assertIn(ids['sampler a'], sampler._ids[1])
+            self.assertIn(ids['sampler b'], sampler._ids[2])
+
+            # a delete and a move: only their categories are reloaded
+            untouched = sampler._ids[4]
+            write(f"DELETE FROM questions WHERE id = {ids['sampler a']}",
+                  f"UPDATE questions SET category = 3 WHERE id = {ids['sampler b']}")
+            refresh()
+            self.assertNotIn(ids['sampler a'], sampler._ids[1])
+            self.assertNotIn(ids['sampler b'], sampler._ids[2])
+            self.assertIn(ids['sampler b'], sampler._ids[3])
+            self.assertIs(sampler._ids[4], untouched)
+            with self.app.app_context():
+                self.assertEqual(sampler._version, data_version())
+        finally:
+            write("DELETE FROM questions WHERE question LIKE 'sampler _'")
+            other.dispose()
+
+    def test_sampler_refreshes_off_the_request_path(self):
+        '''
+        tests a write of another process starts one background refresh
+        and the request draws from the current arrays
+        '''
+        sampler = self.app.extensions['sampler']
+        with self.app.app_context():
+            sampler._build()
+            sampler._version -= 1
+        sampler.refresh_seconds = 0
+
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_refresh():
+            started.set()
+            release.wait(5)
+
+        with mock.patch.object(sampler, '_refresh', side_effect=slow_refresh) as refresh:
+            response = self.client().post('/api/v1/quizzes', json={'previous_questions': [], 'quiz_category': {'id': 1}})
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(started.wait(5))
+
+            # the refresh is still running: requests neither wait nor start another one
+            response = self.client().post('/api/v1/quizzes', json={'previous_questions': [], 'quiz_category': {'id': 1}})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(refresh.call_count, 1)
+            release.set()
+
+
+class GroupCommitTestCase(unittest.TestCase):
+    """This class represents the group commit test case"""
+
+    def setUp(self):
+        """Define test variables and initialize app with group commits."""
+        self.database_path = DATABASE_URL_TEST
+        self.app = create_app({'DATABASE_URL': self.database_path, 'GROUP_COMMIT': True,
+                               'GROUP_COMMIT_MAX_WAIT_MS': 100, 'RATE_LIMIT': 'off', 'MAX_CONCURRENT_REQUESTS': 0})
+
+    def post_questions(self, categories):
+        """status code and id of concurrent POST /questions, one per category"""
+        results = [None] * len(categories)
+
+        def post(index):
+            # a threaded server, like the gthread workers of gunicorn.conf.py
+            response = self.app.test_client().post('/api/v1/questions', json={
+                "question": f"group commit question {index}",
+                "answer": "group commit answer",
+                "difficulty": 1,
+                "category": categories[index]
+            }, environ_base={'wsgi.multithread': True})
+            results[index] = (response.status_code, json.loads(response.data).get('id'))
+
+        threads = [threading.Thread(target=post, args=(index,)) for index in range(len(categories))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_inserts_share_a_commit(self):
+        results = self.post_questions([1] * 10)
+
+        self.assertTrue(all(status == 200 for status, id in results))
+        with self.app.app_context():
+            ids = [id for status, id in results]
+            self.assertEqual(Question.query.filter(Question.id.in_(ids)).count(), 10)
+
+        committer = self.app.extensions['group_commit']
+        self.assertLess(committer.batches._values[()][-1], 10)
+
+    def test_bad_row_fails_alone(self):
+        # no category 1000, the foreign key refuses the row
+        results = self.post_questions([1, 1, 1000, 1])
+
+        self.assertEqual(results[2], (422, None))
+        self.assertTrue(all(status == 200 for status, id in results[:2] + results[3:]))
+
+    def test_timed_out_row_is_never_committed(self):
+        committer = GroupCommitter(self.app, max_batch=10, max_wait_ms=0, timeout=0.01)
+        # no writer: the row waits in the queue until its request gives up
+        committer._ensure_writer = lambda: None
+        with self.app.test_request_context():
+            with self.assertRaises(TimeoutError):
+                committer.insert({'question': 'late', 'answer': 'late', 'difficulty': 1, 'category': 1})
+
+        # the writer then skips it
+        committer._queue.put(PendingInsert({'question': 'next'}))
+        self.assertEqual([pending.row['question'] for pending in committer._collect()], ['next'])
+
+    def test_row_of_a_single_threaded_worker_does_not_wait(self):
+        committer = GroupCommitter(self.app, max_batch=10, max_wait_ms=10000, timeout=5)
+        committer._queue.put(PendingInsert({'question': 'alone'}, wait=False))
+
+        started = time.monotonic()
+        self.assertEqual([pending.row['question'] for pending in committer._collect()], ['alone'])
+        self.assertLess(time.monotonic() - started, 1)
+
+    def test_claimed_row_is_not_cancelled(self):
+        pending = PendingInsert({})
+        self.assertTrue(pending.claim())
+        self.assertFalse(pending.cancel())
+
+
+@unittest.skipIf(SQLITE, 'an embedded database has no replica')
+class ReadReplicaTestCase(unittest.TestCase):
+    """This class represents the read replica routing test case,
+    the dev database stands in for the replica of the test database"""
+
+    def setUp(self):
+        """Define test variables and initialize app with a replica."""
+        self.replica_path = "postgresql://{}:{}@{}/{}".format(DB_USER, DB_PASSWORD, 'localhost:5433', DB_NAME)
+        self.database_path = DATABASE_URL_TEST
+        self.app = create_app({'DATABASE_URL': self.database_path, 'DB_REPLICA_URL': self.replica_path})
+
+    def test_reads_use_the_replica_until_a_write(self):
+        with self.app.app_context():
+            replica = db.get_engine(self.app, bind='replica')
+            replica_total = replica.execute('SELECT count(*) FROM questions').scalar()
+
+        client = self.app.test_client()
+
+        # a plain GET reads from the replica
+        data = json.loads(client.get('/api/v1/questions').data)
+        self.assertEqual(data['total_questions'], replica_total)
+
+        # the write goes to the primary, then the client reads its own write
+        response = client.post('/api/v1/questions', json={
+            "question": "replica test question",
+            "answer": "replica test answer",
+            "difficulty": 1,
+            "category": 1
+        })
+        primary_total = json.loads(response.data)['total_questions']
+        data = json.loads(client.get('/api/v1/questions').data)
+        self.assertEqual(data['total_questions'], primary_total)
+
+
+@unittest.skipIf(asyncpg is None or SQLITE, 'the async api needs asyncpg and PostgreSQL')
+class AsyncAPITestCase(unittest.TestCase):
+    """This class checks the async api answers like /api/v1"""
+
+    def setUp(self):
+        """Define test variables and initialize both apps."""
+        self.database_path = DATABASE_URL_TEST
+        self.app = create_app({'DATABASE_URL': self.database_path, 'RESPONSE_CACHE': 'off'})
+        self.async_app = create_asgi_app(self.database_path)
+
+    def async_request(self, method, path, query_string=b'', body=None):
+        """status and json body of a request to the async app"""
+        messages = [{'type': 'http.request', 'body': json.dumps(body).encode() if body is not None else b''}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        async def run():
+            scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query_string}
+            try:
+                await self.async_app(scope, receive, send)
+            finally:
+                await self.async_app.close()
+
+        asyncio.run(run())
+        return sent[0]['status'], json.loads(sent[1]['body'])
+
+    def test_same_responses_as_v1(self):
+        client = self.app.test_client()
+        for path, query_string in (('/api/v1/categories', b''),
+                                   ('/api/v1/questions', b'page=2'),
+                                   ('/api/v1/questions', b'after_id=10'),
+                                   ('/api/v1/questions', b'page=1000'),
+                                   ('/api/v1/categories/1/questions', b''),
+                                   ('/api/v1/categories/1000/questions', b'')):
+            response = client.get(path, query_string=query_string.decode())
+            status, data = self.async_request('GET', path, query_string)
+            self.assertEqual(status, response.status_code)
+            self.assertEqual(data, json.loads(response.data))
+
+    def test_play_quiz(self):
+        status, data = self.async_request('POST', '/api/v1/quizzes', body={
+            'previous_questions': [],
+            'quiz_category': {'id': 1}
+        })
+        self.assertEqual(status, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['question']['category'], 1)
+
+        status, data = self.async_request('POST', '/api/v1/quizzes', body={'previous_questions': []})
+        self.assertEqual(status, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_play_quiz_invalid_ids(self):
+        client = self.app.test_client()
+        for body in ({'previous_questions': [], 'quiz_category': {'id': 'abc'}},
+                     {'previous_questions': [], 'quiz_category': 'Science'},
+                     {'previous_questions': [], 'quiz_category': {}},
+                     {'previous_questions': ['a'], 'quiz_category': {'id': 1}},
+                     {'previous_questions': [None], 'quiz_category': {'id': 1}},
+                     {'session': True, 'quiz_category': {'id': 'abc'}}):
+            response = client.post('/api/v1/quizzes', json=body)
+            status, data = self.async_request('POST', '/api/v1/quizzes', body=body)
+            self.assertEqual(status, 400)
+            self.assertEqual(data, json.loads(response.data))
+
+    def test_unexpected_error_is_a_json_500(self):
+        with mock.patch.object(self.async_app, 'fetch', side_effect=RuntimeError('connection lost')):
+            status, data = self.async_request('GET', '/api/v1/categories')
+        self.assertEqual(status, 500)
+        self.assertEqual(data, {'success': False, 'error': 500, 'message': 'internal server error'})
+
+
+class MigrationsTestCase(unittest.TestCase):
+    """This class represents the schema migrations test case"""
+
+    def setUp(self):
+        """Define test variables and initialize app, which migrates the test database."""
+        self.database_path = DATABASE_URL_TEST
+        self.app = create_app({'DATABASE_URL': self.database_path})
+
+    def test_every_migration_is_applied_once(self):
+        with self.app.app_context():
+            self.assertTrue(all(done for version, name, done in migrations.status(db.engine)))
+            self.assertEqual(migrations.upgrade(db.engine), [])
+
+    @unittest.skipIf(SQLITE, 'reads the PostgreSQL catalog')
+    def test_category_is_an_indexed_integer(self):
+        with self.app.app_context():
+            with db.engine.begin() as connection:
+                data_type = connection.execute(
+                    "SELECT data_type FROM information_schema.columns "
+                    "WHERE table_name = 'questions' AND column_name = 'category'").scalar()
+                self.assertEqual(data_type, 'integer')
+
+                # the test data is tiny, make the planner show the index it can use
+                connection.execute('SET LOCAL enable_seqscan = off')
+                plan = '\n'.join(row[0] for row in connection.execute(
+                    'EXPLAIN SELECT id FROM questions WHERE category = 1 ORDER BY id'))
+                self.assertIn('ix_questions_category_id', plan)
+
+    @unittest.skipUnless(SQLITE, 'reads the sqlite catalog')
+    def test_sqlite_category_is_an_indexed_integer(self):
+        with self.app.app_context():
+            columns = {row['name']: row['type'] for row in db.engine.execute('PRAGMA table_info(questions)')}
+            self.assertEqual(columns['category'].upper(), 'INTEGER')
+
+            plan = '\n'.join(row[-1] for row in db.engine.execute(
+                'EXPLAIN QUERY PLAN SELECT id FROM questions WHERE category = 1 ORDER BY id'))
+            self.assertIn('ix_questions_category_id', plan)
+
+    @unittest.skipUnless(SQLITE, 'reads the sqlite pragmas')
+    def test_sqlite_pragmas(self):
+        with self.app.app_context():
+            self.assertEqual(db.engine.execute('PRAGMA journal_mode').scalar().lower(), 'wal')
+            self.assertEqual(db.engine.execute('PRAGMA foreign_keys').scalar(), 1)
+            self.assertEqual(db.engine.execute('PRAGMA mmap_size').scalar(), self.app.config['SQLITE_MMAP_SIZE'])
+
+
+class StartupTestCase(unittest.TestCase):
+    """This class checks a production boot opens no connection"""
+
+    def test_boot_without_connection(self):
+        app = create_app({'DATABASE_URL': DATABASE_URL_TEST, 'DB_AUTO_MIGRATE': False})
+        report = app.extensions['startup'].report()
+        self.assertTrue(report['within_budget'])
+
+        with app.app_context():
+            self.assertEqual(db.engine.pool.checkedin(), 0)
+            self.assertEqual(db.engine.pool.checkedout(), 0)
+
+    def test_not_ready_without_database(self):
+        if SQLITE:
+            unreachable = 'sqlite:////nonexistent/trivia_test.db'
+        else:
+            unreachable = "postgresql://{}:{}@{}/{}".format(DB_USER, DB_PASSWORD, 'localhost:1', DB_NAME_TEST)
+        app = create_app({'DATABASE_URL': unreachable, 'DB_AUTO_MIGRATE': False})
+
+        response = app.test_client().get('/api/v1/ready')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(data['ready'])
+
+
+class SearchIndexTestCase(unittest.TestCase):
+    """This class represents the in-process search index test case"""
+
+    def setUp(self):
+        """Build a small index without a database."""
+        patcher = mock.patch('flaskr.search.data_version', return_value=0)
+        self.data_version = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.index = InvertedIndexSearch(None, refresh_seconds=0)
+        self.index._built = True
+        self.index._version = 0
+        self.index._add(1, 'Which country won the first ever soccer World Cup in 1930?')
+        self.index._add(2, 'Which is the only team to play in every soccer World Cup tournament?')
+        self.index._add(3, 'What was the title of the 1990 fantasy?')
+
+    def test_match_substrings_like_ilike(self):
+        # the term is found anywhere in the question, case insensitive
+        self.assertEqual(self.index.match('itle'), [3])
+        self.assertEqual(self.index.match('TIT'), [3])
+        self.assertEqual(self.index.match('world cup'), [1, 2])
+        self.assertEqual(self.index.match('cup in'), [1])
+        self.assertEqual(self.index.match('1930?'), [1])
+        self.assertEqual(self.index.match('ry w'), [1])
+        self.assertEqual(self.index.match('soccer title'), [])
+        self.assertEqual(self.index.match('?!'), [])
+        # wildcards of LIKE are plain characters
+        self.assertEqual(self.index.match('%'), [])
+        self.assertEqual(self.index.match('w_rld'), [])
+
+    def test_word_prefix_matches_come_first(self):
+        # "the" starts 2 words of 3, 1 word of 1 and 2, no word of 4
+        self.index._add(4, 'Whose brother won another title?')
+        self.assertEqual(self.index.match('the'), [3, 1, 2, 4])
+        self.assertEqual(self.index.match('itle'), [3, 4])
+
+    def test_committed_changes_update_the_index(self):
+        # a question is updated, another one deleted
+        self.index._apply_changes(
+            added=[{'id': 3, 'question': 'Which soccer player is the best?'}],
+            removed=[{'id': 3}, {'id': 2}])
+        # the version the write of this process bumped
+        self.data_version.return_value = 1
+
+        self.assertEqual(self.index.match('soccer'), [1, 3])
+        self.assertEqual(self.index.match('title'), [])
+
+    def test_writes_of_another_process_rebuild_the_index(self):
+        # a write of this process comes through the feed
+        self.index._apply_changes(added=[{'id': 4, 'question': 'Local question?'}], removed=[])
+        self.data_version.return_value = 1
+        started = threading.Event()
+        with mock.patch.object(self.index, '_run_refresh', side_effect=started.set) as refresh:
+            self.assertEqual(self.index.match('local'), [4])
+            refresh.assert_not_called()
+
+            # another process wrote: the current index answers, a rebuild starts in the background
+            self.data_version.return_value = 2
+            self.assertEqual(self.index.match('local'), [4])
+            self.assertTrue(started.wait(5))
+            self.index.match('local')
+            self.assertEqual(refresh.call_count, 1)
+            self.assertFalse(self.index.current(2))
+
+
+class SearchCacheTestCase(unittest.TestCase):
+    """This class represents the search cache test case, without a database"""
+
+    def setUp(self):
+        """Cache entries as if the terms had been searched."""
+        self.cache = CachedSearch(self.engine(), max_entries=10, max_ids=100)
+        self.cache._version = 0
+        for term, ids in (('world cup', [10, 11]), ('title', [6]), ('the', [4, 6, 10])):
+            self.cache._store(term, (term, array('q', ids), False, len(ids), True), 0)
+
+    @staticmethod
+    def engine():
+        """An index current at version 0."""
+        engine = InvertedIndexSearch(None, refresh_seconds=0)
+        engine._built = True
+        engine._version = 0
+        return engine
+
+    def test_terms_are_lowercased(self):
+        self.assertEqual(search_key('World CUP?'), 'world cup?')
+        # spaces and punctuation are part of the match
+        self.assertEqual(search_key(' world  cup'), ' world  cup')
+
+    def test_only_matching_entries_are_dropped(self):
+        self.cache._apply_changes(added=[{'id': 30, 'question': 'Who won the World Cup in 2018?'}], removed=[])
+        self.assertEqual(list(self.cache._entries), ['title'])
+        self.assertEqual(self.cache._version, 1)
+
+        self.cache._apply_changes(added=[], removed=[{'id': 6, 'question': 'What was the title of the 1990 fantasy?'}])
+        self.assertEqual(list(self.cache._entries), [])
+
+    def test_least_recently_used_term_is_evicted(self):
+        cache = CachedSearch(self.engine(), max_entries=1, max_ids=100)
+        cache._version = 0
+        cache._store('title', ('title', array('q', [6]), False, 1, True), 0)
+        cache._store('the', ('the', array('q', [4]), False, 1, True), 0)
+        self.assertEqual(list(cache._entries), ['the'])
+
+    def test_ids_computed_before_a_commit_are_not_stored(self):
+        # a miss looked up at version 0, a commit of this process comes
+        # through the feed before its ids are stored
+        self.cache._apply_changes(added=[{'id': 31, 'question': 'Which planet is red?'}], removed=[])
+        self.cache._store('planet', ('planet', array('q', []), False, 0, True), 0)
+        self.assertNotIn('planet', self.cache._entries)
+
+    def test_ids_of_an_index_behind_are_not_stored(self):
+        # another process wrote, the index is being rebuilt
+        self.cache.engine._version = None
+        self.cache._store('planet', ('planet', array('q', []), False, 0, True), 0)
+        self.assertNotIn('planet', self.cache._entries)
+
+
+class SuggesterTestCase(unittest.TestCase):
+    """This class represents the suggest index test case"""
+
+    def setUp(self):
+        """Build a small index without a database."""
+        patcher = mock.patch('flaskr.suggest.data_version', return_value=0)
+        self.data_version = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.suggester = Suggester(None, max_terms=100, max_titles=100, refresh_seconds=0)
+        self.suggester._built = True
+        self.suggester._version = 0
+        self.suggester._add(1, 'Which country won the first ever soccer World Cup in 1930?')
+        self.suggester._add(2, 'Which is the only team to play in every soccer World Cup tournament?')
+        self.suggester._add(3, 'What was the title of the 1990 fantasy?')
+
+    def test_most_used_words_first(self):
+        words, questions = self.suggester.suggest('the w', 3)
+        self.assertEqual(words, ['which', 'world', 'was'])
+        self.assertEqual(questions, [])
+
+        words, questions = self.suggester.suggest('WHICH IS', 3)
+        self.assertEqual(words, ['is'])
+        self.assertEqual([question['id'] for question in questions], [2])
+
+    def test_committed_changes_update_the_index(self):
+        self.suggester.suggest('ti', 5)
+        self.suggester._apply_changes(
+            added=[{'id': 3, 'question': 'Who wrote this tiny poem?'}],
+            removed=[{'id': 3, 'question': 'What was the title of the 1990 fantasy?'}])
+        # the version the write of this process bumped
+        self.data_version.return_value = 1
+
+        self.assertEqual(self.suggester.suggest('ti', 5), (['tiny'], []))
+        self.assertEqual(self.suggester.suggest('who', 5)[1], [{'id': 3, 'question': 'Who wrote this tiny poem?'}])
+
+    def test_writes_of_another_process_rebuild_the_index(self):
+        # a write of this process comes through the feed
+        self.suggester._apply_changes(added=[{'id': 4, 'question': 'Local question?'}], removed=[])
+        self.data_version.return_value = 1
+        with mock.patch.object(self.suggester, '_run_refresh') as refresh:
+            self.suggester.suggest('local', 5)
+            refresh.assert_not_called()
+
+            # another process wrote: the current index answers, a thread refreshes it
+            self.data_version.return_value = 2
+            self.assertEqual(self.suggester.suggest('local', 5), (['local'], [{'id': 4, 'question': 'Local question?'}]))
+            self.suggester.suggest('local', 5)
+            refresh.assert_called_once()
+
+    def test_refresh_swaps_the_new_index_in(self):
+        self.suggester.suggest('wh', 5)
+        self.data_version.return_value = 2
+
+        def load(index):
+            index._add(5, 'Where is the Eiffel Tower?')
+        with mock.patch.object(Suggester, '_load', load):
+            self.suggester._refresh()
+
+        self.assertEqual(self.suggester._version, 2)
+        self.assertEqual(self.suggester.suggest('wh', 5), (['where'], [{'id': 5, 'question': 'Where is the Eiffel Tower?'}]))
+
+    def test_refresh_is_dropped_after_a_local_write(self):
+        def load(index):
+            # a write of this process comes through the feed during the load
+            self.suggester._apply_changes(added=[{'id': 4, 'question': 'Local question?'}], removed=[])
+        self.data_version.return_value = 2
+        with mock.patch.object(Suggester, '_load', load):
+            self.suggester._refresh()
+
+        self.assertEqual(self.suggester._version, 1)
+        self.assertEqual(len(self.suggester._texts), 4)
+
+    def test_bounded_index(self):
+        suggester = Suggester(None, max_terms=2, max_titles=1)
+        suggester._built = True
+        suggester._add(1, 'red fox')
+        suggester._add(2, 'blue fox')
+
+        self.assertEqual(suggester.stats()['terms'], 2)
+        self.assertEqual(suggester.stats()['questions'], 1)
+        self.assertEqual(suggester.stats()['dropped'], 2)
+
+
+class QuestionSamplerTestCase(unittest.TestCase):
+    """This class checks the quiz sampler draws uniformly, without a database"""
+
+    def setUp(self):
+        """Arrays of 3 categories, with deleted and excluded questions."""
+        self.sampler = QuestionSampler(None, max_ids=1000, refresh_seconds=0, rng=random.Random(1234))
+        self.sampler.mode = 'memory'
+        self.sampler._version = 0
+        self.sampler._ids = {
+            1: array('q', range(1, 21)),
+            2: array('q', range(21, 31)),
+            3: array('q', range(31, 36))
+        }
+        self.sampler._deleted = {1: {3, 4}, 2: {22}}
+
+    def chi_square_ok(self, counts, expected_ids):
+        """chi-square goodness of fit against the uniform distribution, at the 0.1% level"""
+        self.assertEqual(set(counts), expected_ids)
+        total = sum(counts.values())
+        expected = total / len(expected_ids)
+        statistic = sum((count - expected) ** 2 / expected for count in counts.values())
+        # Wilson-Hilferty approximation of the chi-square quantile
+        df = len(expected_ids) - 1
+        critical = df * (1 - 2 / (9 * df) + 3.09 * math.sqrt(2 / (9 * df))) ** 3
+        self.assertLess(statistic, critical)
+
+    def draw(self, category_id, excluded, count, rounds):
+        counts = {}
+        for _ in range(rounds):
+            ids = self.sampler.sample_ids(category_id, excluded, count)
+            self.assertEqual(len(ids), len(set(ids)))
+            for id in ids:
+                counts[id] = counts.get(id, 0) + 1
+        return counts
+
+    def test_uniform_over_a_category(self):
+        excluded = {1, 2}
+        counts = self.draw(1, excluded, 3, 20000)
+        self.chi_square_ok(counts, set(range(1, 21)) - {3, 4} - excluded)
+
+    def test_uniform_over_every_category(self):
+        excluded = {5, 30}
+        counts = self.draw(0, excluded, 4, 20000)
+        self.chi_square_ok(counts, set(range(1, 36)) - {3, 4, 22} - excluded)
+
+    def test_uniform_when_most_questions_are_excluded(self):
+        # rejection gives up, the rest is drawn from a scan
+        excluded = set(range(1, 18))
+        counts = self.draw(1, excluded, 2, 20000)
+        self.chi_square_ok(counts, {18, 19, 20})
+
+    def test_runs_out_of_questions(self):
+        self.assertEqual(sorted(self.sampler.sample_ids(3, {31}, 10)), [32, 33, 34, 35])
+        self.assertEqual(self.sampler.sample_ids(3, set(range(31, 36)), 1), [])
+        self.assertEqual(self.sampler.sample_ids(4, set(), 1), [])
+
+    def test_committed_changes_update_the_arrays(self):
+        self.sampler._apply_changes(
+            added=[{'id': 36, 'category': 3}, {'id': 21, 'category': 3}],
+            removed=[{'id': 21, 'category': 2}, {'id': 35, 'category': 3}])
+
+        self.assertEqual(sorted(self.sampler.sample_ids(3, set(), 10)), [21, 31, 32, 33, 34, 36])
+        self.assertNotIn(21, self.sampler.sample_ids(2, set(), 10))
+        self.assertEqual(self.sampler._version, 1)
+
+
+class QuestionCounterTestCase(unittest.TestCase):
+    """This class checks the cached counts follow the changes feed, without a database"""
+
+    def setUp(self):
+        self.counter = QuestionCounter(None, 'cached', exact_below=10000, refresh_seconds=5)
+        self.counter._counts = {1: 3, 2: 1}
+        self.counter._version = 7
+
+    def test_committed_changes_update_the_counts(self):
+        # a question moves from category 2 to 1, another one is deleted
+        self.counter._apply_changes(
+            added=[{'id': 10, 'category': 1}],
+            removed=[{'id': 10, 'category': 2}, {'id': 11, 'category': 1}])
+
+        self.assertEqual(self.counter._counts, {1: 3, 2: 0})
+        self.assertEqual(self.counter._version, 8)
+
+    def test_not_built_counts_ignore_changes(self):
+        counter = QuestionCounter(None, 'cached', exact_below=10000, refresh_seconds=5)
+        counter._apply_changes(added=[{'id': 10, 'category': 1}], removed=[])
+        self.assertIsNone(counter._counts)
+
+    def test_writes_of_another_process_refresh_in_the_background(self):
+        with mock.patch('flaskr.counts.data_version', return_value=8), \
+                mock.patch.object(self.counter, '_run_refresh') as refresh:
+            # the last counts answer, marked inexact, while a thread counts again
+            self.assertEqual(self.counter._cached(None), (4, False))
+            self.assertEqual(self.counter._cached(1), (3, False))
+            refresh.assert_called_once()
+
+    def test_refresh_swaps_the_new_counts_in(self):
+        with mock.patch('flaskr.counts.data_version', return_value=9), \
+                mock.patch.object(self.counter, '_load', return_value={1: 5}):
+            self.counter._refresh()
+            self.assertEqual(self.counter._cached(1), (5, True))
+
+    def test_refresh_is_dropped_after_a_local_write(self):
+        def load():
+            # a write of this process comes through the feed during the count
+            self.counter._apply_changes(added=[{'id': 10, 'category': 2}], removed=[])
+            return {1: 5}
+        with mock.patch('flaskr.counts.data_version', return_value=9), \
+                mock.patch.object(self.counter, '_load', load):
+            self.counter._refresh()
+
+        self.assertEqual(self.counter._counts, {1: 3, 2: 2})
+        self.assertEqual(self.counter._version, 8)
+
+
+class TTLStoreTestCase(unittest.TestCase):
+    """This class represents the quiz session store test case"""
+
+    def test_expired_keys_are_dropped(self):
+        store = TTLStore(ttl=0, max_size=10)
+        store.set('a', [1])
+        self.assertIsNone(store.get('a'))
+
+    def test_least_recently_used_key_is_evicted(self):
+        store = TTLStore(ttl=60, max_size=2)
+        store.set('a', [1])
+        store.set('b', [2])
+        store.get('a')
+        store.set('c', [3])
+
+        self.assertEqual(store.get('a'), [1])
+        self.assertIsNone(store.get('b'))
+        self.assertEqual(len(store), 2)
+
+
+class QuizSessionTestCase(unittest.TestCase):
+    """This class checks the quiz session decks, without a database"""
+
+    def test_permutation_visits_every_position_once(self):
+        for size in (1, 2, 7, 100, 1000):
+            values = [permute(position, size, seed=42) for position in range(size)]
+            self.assertEqual(sorted(values), list(range(size)))
+        # another seed, another order
+        self.assertNotEqual([permute(position, 100, 1) for position in range(100)],
+                            [permute(position, 100, 2) for position in range(100)])
+
+    def test_session_size_does_not_depend_on_the_category(self):
+        session = new_session(0, 1, 10000000, 10000000, excluded=[5, 20000000])
+        self.assertLess(len(json.dumps(session)), 200)
+        # ids out of the range can never be drawn
+        self.assertEqual(session['excluded'], [5])
+
+    def test_draws_follow_the_permutation(self):
+        session = new_session(1, 10, 29, 10, excluded=[])
+        end, probes = candidates(session, 2)
+        found = {id for position, id in probes[1:]}
+
+        ids, offset = pick(probes, end, found, 2)
+        self.assertEqual(ids, [probes[1][1], probes[2][1]])
+        # the offset stops past the last question taken
+        self.assertEqual(offset, probes[2][0] + 1)
+
+    def test_concurrent_draws_do_not_share_positions(self):
+        sessions = MemorySessions(ttl=60, max_sessions=10)
+        sessions.set('a', new_session(1, 1, 10, 10))
+
+        self.assertTrue(sessions.advance('a', 0, 3, 3))
+        # a draw that read offset 0 lost the race, it reads the session again
+        self.assertFalse(sessions.advance('a', 0, 2, 2))
+        self.assertEqual(remaining(sessions.get('a')), 7)
+        self.assertFalse(sessions.advance('unknown', 0, 1, 1))
+
+
+class RateLimitTestCase(unittest.TestCase):
+    """This class represents the admission control test case"""
+
+    def test_bucket_refills_at_rate(self):
+        buckets = MemoryBuckets(max_clients=10)
+        # a burst of 10 tokens, 1 token per second
+        self.assertEqual(buckets.take('a', 5, 1, 10), 0)
+        self.assertEqual(buckets.take('a', 5, 1, 10), 0)
+        self.assertAlmostEqual(buckets.take('a', 5, 1, 10), 5, delta=0.1)
+        # every client has its own bucket
+        self.assertEqual(buckets.take('b', 5, 1, 10), 0)
+
+    def test_least_recently_seen_client_is_dropped(self):
+        buckets = MemoryBuckets(max_clients=1)
+        buckets.take('a', 10, 1, 10)
+        buckets.take('b', 10, 1, 10)
+        self.assertEqual(buckets.take('a', 10, 1, 10), 0)
+
+    def test_concurrency_limit(self):
+        limit = ConcurrencyLimit(1)
+        self.assertTrue(limit.acquire())
+        self.assertFalse(limit.acquire())
+        limit.release()
+        self.assertTrue(limit.acquire())
+
+    def test_route_costs(self):
+        self.assertEqual(parse_costs('search_questions=5, api2.play_quiz=3,'),
+                         {'api1.search_questions': 5, 'api2.play_quiz': 3})
+
+    def test_rate_limited_search(self):
+        app = create_app({'DATABASE_URL': DATABASE_URL_TEST, 'RATE_LIMIT_RATE': 0.1, 'RATE_LIMIT_BURST': 10,
+                          'RATE_LIMIT_COSTS': 'search_questions=5', 'RATE_LIMIT_API_KEYS': 'other'})
+        client = app.test_client()
+
+        for _ in range(2):
+            response = client.post('/api/v1/questions/search', json={'searchTerm': 'title'})
+            self.assertEqual(response.status_code, 200)
+
+        response = client.post('/api/v1/questions/search', json={'searchTerm': 'title'})
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(data['message'], 'too many requests')
+        self.assertGreaterEqual(int(response.headers['Retry-After']), 1)
+
+        # another api key has its own bucket
+        response = client.get('/api/v1/categories', headers={'X-API-Key': 'other'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_rotating_unknown_keys_are_limited(self):
+        app = create_app({'DATABASE_URL': DATABASE_URL_TEST, 'RATE_LIMIT_RATE': 0.1, 'RATE_LIMIT_BURST': 10,
+                          'RATE_LIMIT_COSTS': 'search_questions=5', 'RATE_LIMIT_API_KEYS': 'known'})
+        client = app.test_client()
+
+        statuses = [client.post('/api/v1/questions/search', json={'searchTerm': 'title'},
+                                headers={'X-API-Key': f'made-up-{index}'}).status_code for index in range(3)]
+        self.assertEqual(statuses, [200, 200, 429])
+
+    def test_clients_behind_a_proxy_have_their_own_bucket(self):
+        app = create_app({'DATABASE_URL': DATABASE_URL_TEST, 'RATE_LIMIT_RATE': 0.1, 'RATE_LIMIT_BURST': 10,
+                          'RATE_LIMIT_COSTS': 'search_questions=5', 'PROXY_FIX_HOPS': 1})
+        client = app.test_client()
+
+        def search(address):
+            return client.post('/api/v1/questions/search', json={'searchTerm': 'title'},
+                               headers={'X-Forwarded-For': address}).status_code
+
+        self.assertEqual([search('203.0.113.1') for _ in range(3)], [200, 200, 429])
+        # every request comes from the proxy, the forwarded address is the client
+        self.assertEqual(search('203.0.113.2'), 200)
+
+
+class ProfilingTestCase(unittest.TestCase):
+    """This class represents the on-demand request profiles test case"""
+
+    def setUp(self):
+        """Initialize an app profiling the requests with the secret header."""
+        self.directory = tempfile.mkdtemp()
+        self.app = create_app({'DATABASE_URL': DATABASE_URL_TEST, 'RATE_LIMIT': 'off',
+                               'PROFILE_ENABLED': True, 'PROFILE_SECRET': 'secret', 'PROFILE_OUTPUT': 'pstats',
+                               'PROFILE_DIR': self.directory, 'PROFILE_MAX_FILES': 2})
+        self.client = self.app.test_client()
+
+    def profiles(self):
+        return sorted(os.listdir(self.directory))
+
+    def test_only_requests_with_the_secret(self):
+        for token in (None, 'wrong'):
+            headers = {'X-Profile-Token': token} if token else {}
+            response = self.client.get('/api/v1/categories', headers=headers)
+            self.assertNotIn('X-Profile-Id', response.headers)
+        self.assertEqual(self.profiles(), [])
+
+    def test_profile_is_tagged_and_readable(self):
+        response = self.client.get('/api/v1/categories',
+                                   headers={'X-Profile-Token': 'secret', 'X-Request-Id': 'req-1'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['X-Profile-Id'], 'req-1')
+
+        [name] = self.profiles()
+        self.assertTrue(name.endswith('-api1.get_categories-req-1.prof'))
+        stats = pstats.Stats(os.path.join(self.directory, name))
+        self.assertTrue(any(function == 'get_categories' for filename, line, function in stats.stats))
+
+    def test_oldest_profiles_are_removed(self):
+        for index in range(4):
+            self.client.get('/api/v1/categories', headers={'X-Profile-Token': 'secret', 'X-Request-Id': f'req-{index}'})
+            time.sleep(0.01)
+        self.assertEqual(len(self.profiles()), 2)
+        self.assertTrue(self.profiles()[-1].endswith('req-3.prof'))
+
+    def test_endpoint_filter(self):
+        self.assertEqual(parse_endpoints('play_quiz, api2.get_questions,'), {'api1.play_quiz', 'api2.get_questions'})
+
+        self.app.extensions['profiler'].endpoints = parse_endpoints('play_quiz')
+        response = self.client.get('/api/v1/categories', headers={'X-Profile-Token': 'secret'})
+        self.assertNotIn('X-Profile-Id', response.headers)
+
+    def test_stack_sampler_collapses_stacks(self):
+        sampler = StackSampler(threading.get_ident(), 0.001)
+        sampler.start()
+        deadline = time.monotonic() + 0.1
+        while time.monotonic() < deadline:
+            pass
+        sampler.stop()
+
+        stack = sampler.stacks.most_common(1)[0][0]
+        self.assertTrue(any(frame.endswith(':test_stack_sampler_collapses_stacks') for frame in stack.split(';')))
+        self.assertNotIn(' ', stack)
+
+
+class LRUBackendTestCase(unittest.TestCase):
+    """This class represents the response cache backend test case"""
+
+    def test_evicts_least_recently_used_over_limits(self):
+        backend = LRUBackend(max_entries=2, max_bytes=10)
+        backend.set('a', b'1234')
+        backend.set('b', b'1234')
+        backend.get('a')
+        backend.set('c', b'1234')
+
+        # b was the least recently used entry
+        self.assertIsNone(backend.get('b'))
+        self.assertEqual(backend.get('a'), b'1234')
+
+        # going over max_bytes evicts too
+        backend.set('d', b'12345678')
+        self.assertEqual(backend.stats()['entries'], 1)
+        self.assertEqual(backend.stats()['evictions'], 3)
+
+    def test_clear_drops_entries(self):
+        backend = LRUBackend(max_entries=2, max_bytes=10)
+        backend.set('a', b'1')
+        backend.clear()
+
+        self.assertIsNone(backend.get('a'))
+        self.assertEqual(backend.stats()['bytes'], 0)
+
+
+@unittest.skipIf(orjson is None, 'needs orjson')
+class OrjsonSerializerTestCase(unittest.TestCase):
+    """This class checks orjson gives the bytes of jsonify"""
+
+    def setUp(self):
+        self.serializer = OrjsonSerializer(orjson)
+
+    def jsonify_bytes(self, payload):
+        return (json.dumps(payload, sort_keys=True, separators=(',', ':')) + '\n').encode()
+
+    def test_same_bytes_as_jsonify(self):
+        payload = {
+            'success': True,
+            'questions': [{'id': 2, 'question': 'q?', 'answer': 'a', 'category': 1, 'difficulty': 3}],
+            'next_after_id': None,
+            'categories': {id: f'category {id}' for id in range(1, 13)}
+        }
+        self.assertEqual(self.serializer.dumps(payload), self.jsonify_bytes(payload))
+
+    def test_falls_back_when_bytes_would_differ(self):
+        # jsonify escapes non ASCII characters
+        self.assertIsNone(self.serializer.dumps({'question': 'Qu\'est-ce que l\'été ?'}))
+        # and DEL, which orjson writes as a raw byte
+        self.assertIsNone(self.serializer.dumps({'question': 'a\x7fb'}))
+        # nested maps with integer keys
+        self.assertIsNone(self.serializer.dumps({'data': [{1: 'a'}]}))
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    """This class checks the report and the regression gate of the benchmarks"""
+
+    def test_nearest_rank_percentile(self):
+        values = list(range(1, 151))
+        # rank 148.5 is rounded up, not to the even 148
+        self.assertEqual(percentile(values, 0.99), 149)
+        self.assertEqual(percentile(values, 0.5), 75)
+        self.assertEqual(percentile(list(range(1, 101)), 0.07), 7)
+        self.assertEqual(percentile([3], 0.99), 3)
+        self.assertEqual(percentile([1, 2], 0.0), 1)
+        self.assertEqual(percentile([], 0.99), 0.0)
 
+    def test_compare_reports_regressions_past_the_threshold(self):
+        baseline = {
+            'list': {'p95': 10.0, 'p99': 20.0, 'throughput': 100.0},
+            'search': {'p95': 10.0, 'p99': 20.0, 'throughput': 100.0}
+        }
+        results = {
+            # within 20%
+            'list': {'p95': 11.9, 'p99': 23.9, 'throughput': 80.5},
+            'search': {'p95': 12.5, 'p99': 20.0, 'throughput': 79.0},
+            # no baseline yet
+            'quiz': {'p95': 100.0, 'p99': 200.0, 'throughput': 1.0}
+        }
 
+        self.assertEqual(compare(results, baseline, 0.2), [
+            'search p95: 12.50ms > 10.00ms',
+            'search throughput: 79.0/s < 100.0/s'
+        ])
+        self.assertEqual(compare(results, baseline, 0.5), [])
 
 
 # Make the tests conveniently executable
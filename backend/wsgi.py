@@ -0,0 +1,7 @@
+# wsgi.py
+# entry point of the WSGI servers, the app is created at import:
+#
+#   gunicorn -c gunicorn.conf.py wsgi:app
+from flaskr import create_app
+
+app = create_app()
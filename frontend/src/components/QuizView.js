@@ -3,6 +3,9 @@ import $ from 'jquery';
 import '../stylesheets/QuizView.css';
 
 const questionsPerPlay = 5;
+// questions per request: the first one shows quickly, the next batch is
+// fetched in the background while the current one is being answered
+const questionsPerBatch = 2;
 
 class QuizView extends Component {
   constructor(props) {
@@ -16,7 +19,13 @@ class QuizView extends Component {
       currentQuestion: {},
       guess: '',
       forceEnd: false,
+      upcomingQuestions: [],
+      nextRequest: null,
+      waitingForBatch: false,
     };
+    // responses of a game that was restarted are dropped
+    this.game = 0;
+    this.batchInFlight = false;
   }
 
   componentDidMount() {
@@ -42,42 +51,144 @@ class QuizView extends Component {
     this.setState({ [event.target.name]: event.target.value });
   };
 
-  getNextQuestion = () => {
-    const previousQuestions = [...this.state.previousQuestions];
-    if (this.state.currentQuestion.id) {
-      previousQuestions.push(this.state.currentQuestion.id);
-    }
+  // questions still to fetch for the game
+  questionsNeeded = () =>
+    questionsPerPlay -
+    this.state.previousQuestions.length -
+    (this.state.currentQuestion.id ? 1 : 0) -
+    this.state.upcomingQuestions.length;
 
+  postQuiz = (request, background, success) => {
+    const game = this.game;
+    this.batchInFlight = true;
     $.ajax({
       url: '/api/v1/quizzes', //TODO: update request URL
       type: 'POST',
       dataType: 'json',
       contentType: 'application/json',
-      data: JSON.stringify({
-        previous_questions: previousQuestions,
-        quiz_category: this.state.quizCategory,
-      }),
+      data: JSON.stringify(request),
       xhrFields: {
         withCredentials: true,
       },
       crossDomain: true,
       success: (result) => {
-        this.setState({
-          showAnswer: false,
-          previousQuestions: previousQuestions,
-          currentQuestion: result.question,
-          guess: '',
-          forceEnd: result.question ? false : true,
-        });
+        if (game !== this.game) {
+          return;
+        }
+        this.batchInFlight = false;
+        success(result);
         return;
       },
       error: (error) => {
-        alert('Unable to load question. Please try your request again');
+        if (game !== this.game) {
+          return;
+        }
+        this.batchInFlight = false;
+        // a failed prefetch is retried by the next question
+        if (!background || this.state.waitingForBatch) {
+          alert('Unable to load question. Please try your request again');
+        }
+        this.setState({ waitingForBatch: false });
         return;
       },
     });
   };
 
+  // buffers the next batch, with the request hinted by the server
+  prefetchNextBatch = () => {
+    const needed = this.questionsNeeded();
+    if (this.batchInFlight || !this.state.nextRequest || needed <= 0) {
+      return;
+    }
+
+    const request = {
+      ...this.state.nextRequest,
+      count: Math.min(questionsPerBatch, needed),
+    };
+    this.postQuiz(request, true, (result) => {
+      this.setState(
+        (state) => ({
+          upcomingQuestions: [...state.upcomingQuestions, ...result.questions],
+          nextRequest: result.prefetch,
+        }),
+        () => {
+          if (this.state.waitingForBatch) {
+            this.getNextQuestion();
+          }
+        }
+      );
+    });
+  };
+
+  getNextQuestion = () => {
+    const previousQuestions = [...this.state.previousQuestions];
+    if (this.state.currentQuestion.id) {
+      previousQuestions.push(this.state.currentQuestion.id);
+    }
+
+    // questions of the buffered batches are played without a round trip
+    if (this.state.upcomingQuestions.length > 0) {
+      const [currentQuestion, ...upcomingQuestions] = this.state.upcomingQuestions;
+      this.setState(
+        {
+          showAnswer: false,
+          previousQuestions: previousQuestions,
+          currentQuestion: currentQuestion,
+          upcomingQuestions: upcomingQuestions,
+          guess: '',
+          waitingForBatch: false,
+        },
+        this.prefetchNextBatch
+      );
+      return;
+    }
+
+    // the next batch is on its way, it is played once it arrives
+    if (this.batchInFlight) {
+      this.setState({ waitingForBatch: true });
+      return;
+    }
+
+    // the game is over once it is played, or when the server sends no
+    // next request: the category has no question left
+    const count = Math.min(
+      questionsPerBatch,
+      questionsPerPlay - previousQuestions.length
+    );
+    if (
+      count <= 0 ||
+      (this.state.currentQuestion.id && !this.state.nextRequest)
+    ) {
+      this.setState({ previousQuestions: previousQuestions, forceEnd: true });
+      return;
+    }
+    const request = this.state.nextRequest
+      ? { ...this.state.nextRequest, count: count }
+      : {
+          previous_questions: previousQuestions,
+          quiz_category: this.state.quizCategory,
+          count: count,
+          prefetch: true,
+        };
+
+    this.postQuiz(request, false, (result) => {
+      const [currentQuestion, ...upcomingQuestions] = result.questions;
+      this.setState(
+        {
+          showAnswer: false,
+          previousQuestions: previousQuestions,
+          currentQuestion: currentQuestion || {},
+          upcomingQuestions: upcomingQuestions,
+          nextRequest: result.prefetch,
+          guess: '',
+          forceEnd: currentQuestion ? false : true,
+          waitingForBatch: false,
+        },
+        this.prefetchNextBatch
+      );
+    });
+  };
+
   submitGuess = (event) => {
     event.preventDefault();
     let evaluate = this.evaluateAnswer();
@@ -88,6 +199,8 @@ class QuizView extends Component {
   };
 
   restartGame = () => {
+    this.game += 1;
+    this.batchInFlight = false;
     this.setState({
       quizCategory: null,
       previousQuestions: [],
@@ -96,6 +209,9 @@ class QuizView extends Component {
       currentQuestion: {},
       guess: '',
       forceEnd: false,
+      upcomingQuestions: [],
+      nextRequest: null,
+      waitingForBatch: false,
     });
   };
 
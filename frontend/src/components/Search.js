@@ -1,8 +1,10 @@
 import React, { Component } from 'react';
+import $ from 'jquery';
 
 class Search extends Component {
   state = {
     query: '',
+    suggestions: [],
   };
 
   getInfo = (event) => {
@@ -11,8 +13,42 @@ class Search extends Component {
   };
 
   handleInputChange = () => {
+    const query = this.search.value;
     this.setState({
-      query: this.search.value,
+      query: query,
+    });
+    this.loadSuggestions(query);
+  };
+
+  loadSuggestions = (query) => {
+    // suggestions come from memory on the server, one request per keystroke
+    if (this.pendingSuggest) {
+      this.pendingSuggest.abort();
+    }
+    if (query.trim().length < 2) {
+      this.setState({ suggestions: [] });
+      return;
+    }
+
+    this.pendingSuggest = $.ajax({
+      url: `/api/v1/questions/suggest`,
+      type: 'GET',
+      data: { prefix: query, limit: 5 },
+      success: (result) => {
+        // a word completes the last word typed, a question replaces the query
+        const start = query.replace(/\w+$/, '');
+        this.setState({
+          suggestions: result.words
+            .map((word) => start + word)
+            .concat(result.questions.map((question) => question.question)),
+        });
+      },
+      error: (xhr, status) => {
+        // a newer keystroke aborted this request
+        if (status !== 'abort') {
+          this.setState({ suggestions: [] });
+        }
+      },
     });
   };
 
@@ -23,7 +59,13 @@ class Search extends Component {
           placeholder='Search questions...'
           ref={(input) => (this.search = input)}
           onChange={this.handleInputChange}
+          list='search-suggestions'
         />
+        <datalist id='search-suggestions'>
+          {this.state.suggestions.map((suggestion) => (
+            <option key={suggestion} value={suggestion} />
+          ))}
+        </datalist>
         <input type='submit' value='Submit' className='button' />
       </form>
     );